@@ -0,0 +1,28 @@
+#!/usr/bin/env python
+''' collapse_fasta.py --- Collapses identical sequences in an aligned fasta
+
+    - Keeps the first sequence of each set of identical sequences
+    - Writes a tab delimited id map (original id, representative id), so
+      counts can be recovered (see coevo.aln_aux.count_representatives())
+    - Acts as a filter (stdin, stdout)
+    - Streams: only one copy of each distinct sequence is kept in memory
+
+'''
+
+import sys
+
+from coevo.aln_aux.collapse import collapse_fasta
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print >>sys.stderr, "usage: %s id_map.tsv < fasta > collapsed_fasta" % sys.argv[0]
+        sys.exit(1)
+
+    try:
+        with open(sys.argv[1], 'w') as map_fh:
+            counts = collapse_fasta(sys.stdin, sys.stdout, map_fh)
+    except ValueError as err:
+        print >>sys.stderr, err
+        sys.exit(1)
+
+    print >>sys.stderr, 'Kept %d of %d sequences' % (len(counts), sum(counts.itervalues()))
@@ -5,19 +5,26 @@
     - Leaves two spaces between identifier and sequence
     - Each sequence is on its own line
     - Acts as a filter (stdin, stdout)
+    - Streams: if stdin is a file it is read twice (once to count sequences
+      for the header), otherwise formatted sequences are spooled to a
+      temporary file (in $TMPDIR) until the header can be written
 
 '''
 
 import sys
-from Bio import AlignIO
+
+import coevo.aln_aux.formatting as aln_fmt
 
 if __name__ == "__main__":
     if(len(sys.argv) > 1):
         print >>sys.stderr, "usage: %s < fasta > phy" % sys.argv[0]
         sys.exit(1)
 
-    aln = AlignIO.read(sys.stdin, format = "fasta")
-    for seq in aln:
-        seq.id = seq.id[:8]
-        #seq.id = seq.id[:8].ljust(8) + '  '  # explicitly truncate, pad, add two spaces
-    print aln.format('phylip-sequential'),
+    try:
+        if aln_fmt.is_seekable(sys.stdin):
+            aln_fmt.write_phylip_two_pass(sys.stdin, sys.stdout, id_len = 8)
+        else:
+            aln_fmt.write_phylip_spooled(sys.stdin, sys.stdout, id_len = 8)
+    except ValueError as err:
+        print >>sys.stderr, err
+        sys.exit(1)
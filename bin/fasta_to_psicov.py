@@ -4,16 +4,20 @@
     - Removes sequence identifiers
     - PSICOV format: one sequence per line, no whitespace
     - Acts as filter (stdin, stdout)
+    - Streams: reads and writes one sequence at a time
 
 '''
 
 import sys
-from Bio import AlignIO
+
+from coevo.aln_aux.formatting import iter_fasta_alignment, write_psicov
 
 if __name__ == "__main__":
     if(len(sys.argv) > 1):
         print >>sys.stderr, "usage: %s < fasta > psicov" % sys.argv[0]
         sys.exit(1)
-    aln = AlignIO.read(sys.stdin, format = "fasta")
-    aln = '\n'.join([str(seq.seq) for seq in aln])
-    print aln,
+    try:
+        write_psicov(iter_fasta_alignment(sys.stdin), sys.stdout)
+    except ValueError as err:
+        print >>sys.stderr, err
+        sys.exit(1)
@@ -17,13 +17,38 @@
     Can output alignment columns if mappings from resnums to alignment columns
     are specified
 
+    Can skip pairs before any distances are computed: intrachain pairs closer
+    in sequence than --min_sep, or pairs not listed in --pair_file (eg. only
+    pairs in a score file).
+
+    Can aggregate distances over all models of a multi-model file, eg. an NMR
+    ensemble or MD frames (--ensemble). Models are streamed with the fast
+    reader (as with --fast_pdb) and only per-pair minimum, mean, and fraction
+    of models in contact are kept.
+
+    Can get distances for many chain pairs in one run (--pairs). Each chain's
+    coordinates are extracted once. Output is either one table with chain id
+    columns, or one file per chain pair (--out_prefix).
+
+    Can process many pdb files in a pool of worker processes (--batch). Jobs
+    are read from a tab delimited manifest with columns:
+
+        pdb_file  chainL  chainR  mapL  mapR  [out_file]
+
+    Empty fields or '-' leave an option unset. Each job is written to its own
+    file. Failures are reported per row and a throughput summary is printed
+    at the end.
+
 '''
 
+import os
 import sys
+import time
 import getopt
-from itertools import product, combinations
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
-from Bio import SeqUtils
 
 import coevo.pdb_aux as pdb_aux
 import coevo.tab_aux as tab_aux
@@ -45,23 +70,73 @@ def parse_cmd_line(args):
                                    'chainR=',
                                    'mapL=',
                                    'mapR=',
-                                   'dist_atoms='
+                                   'dist_atoms=',
+                                   'cutoff=',
+                                   'fast_pdb',
+                                   'no_cache',
+                                   'pairs=',
+                                   'map=',
+                                   'out_prefix=',
+                                   'min_dists',
+                                   'batch=',
+                                   'processes=',
+                                   'out_dir=',
+                                   'npy=',
+                                   'block_size=',
+                                   'min_sep=',
+                                   'pair_file=',
+                                   'ensemble',
+                                   'contact='
                                     ]
                                   )
     options = dict()
     usage = (
-             'usage: %s [ options ] pdb_file\n\n'
+             'usage: %s [ options ] pdb_file\n'
+             '       %s [ options ] --batch manifest\n\n'
              'Options:\n'
              '\t-h, --help                       show this help message and exit\n'
              '\t-c, --chainL <chain id>          (required) specify single or left chain id\n'
              '\t--chainR <chain id>              specify right chain id\n'
-             '\t-d, --dist_atoms Cb | NoH | Any  specify beta carbon (default), non-hydrogen, or any atom distances\n'
+             '\t-d, --dist_atoms Cb | NoH | Any | Cen\n'
+             '\t                                 specify beta carbon (default), non-hydrogen, any atom, or side chain\n'
+             '\t                                 centroid distances. A comma separated list (eg. Cb,NoH,Any) gets\n'
+             '\t                                 one distance column per definition in a single pass\n'
              '\t--mapL <resn2col_left>           specify a mapping from resnum to alignment columns for left chain\n'
              '\t--mapR <resn2col_right>          specify a mapping from resnum to alignment columns for right chain\n'
-             ) % sys.argv[0]
+             '\t--cutoff <angstroms>             only output residue pairs within cutoff distance (by any\n'
+             '\t                                 definition, all distances of those pairs are output)\n'
+             '\t--block_size <n>                 compute and write distances for n left residues at a time\n'
+             '\t--min_sep <n>                    for intrachain distances, skip pairs with residue numbers closer than n\n'
+             '\t--pair_file <pairtab>            only get distances for pairs in the first two columns of a tab\n'
+             '\t                                 delimited file with header (eg. a score file). If the column names\n'
+             '\t                                 contain "Column", pairs are alignment columns mapped with the maps\n'
+             '\t--ensemble                       aggregate distances over all models (eg. NMR ensembles): output\n'
+             '\t                                 min, mean, and fraction of models in contact for each pair.\n'
+             '\t                                 Models are streamed one at a time, always with the --fast_pdb reader\n'
+             '\t--contact <angstroms>            with --ensemble, distance counted as a contact (default: 8.0)\n'
+             '\t--npy <prefix>                   write a binary distance matrix to <prefix>.dist.npy and\n'
+             '\t                                 <prefix>.index.npz instead of a table (see coevo.tab_aux.distmat)\n'
+             '\t--fast_pdb                       read ATOM records directly instead of using Bio.PDB.PDBParser\n'
+             '\t--no_cache                       do not reuse or save parsed structures (see coevo.cache)\n'
+             '\t--pairs <L:R,L:R,...> | all      get distances for many chain pairs instead of --chainL/--chainR\n'
+             '\t                                 (all: every pair of different chains)\n'
+             '\t--map <chain id>:<resn2col>      with --pairs, specify a mapping for a chain (repeatable). Unless\n'
+             '\t                                 only writing --out_prefix files, map every chain or none\n'
+             '\t--out_prefix <prefix>            with --pairs, write each pair to <prefix>.<L>_<R>.tsv\n'
+             '\t--min_dists                      with --pairs, output the minimum distance over all pairs\n'
+             '\t                                 (eg. for identical chains, see min_dists.py)\n'
+             '\t--batch <manifest>               run the jobs listed in manifest instead of a single pdb_file\n'
+             '\t--processes <n>                  with --batch, number of worker processes (default: all cores)\n'
+             '\t--out_dir <dir>                  with --batch, directory for output files (default: .)\n'
+             ) % (sys.argv[0], sys.argv[0])
 
     # Set defaults
-    options['distance'] = 'Cb'
+    options['dist_atoms'] = ['Cb']
+    options['maps'] = dict()
+    options['processes'] = multiprocessing.cpu_count()
+    options['out_dir'] = '.'
+    options['min_sep'] = 0
+    options['contact'] = 8.0
 
     # Assign options
     for opt, val in optlist:
@@ -72,106 +147,925 @@ def parse_cmd_line(args):
         if opt == '--chainR':
             options['chainR'] = val
         if opt in ('-d', '--dist_atoms'):
-            options['dist_atoms'] = val
+            options['dist_atoms'] = val.split(',')
         if opt in ('--mapL'):
             options['mapL'] = val
         if opt in ('--mapR'):
             options['mapR'] = val
+        if opt == '--cutoff':
+            options['cutoff'] = float(val)
+        if opt == '--fast_pdb':
+            options['fast_pdb'] = True
+        if opt == '--no_cache':
+            options['no_cache'] = True
+        if opt == '--pairs':
+            options['pairs'] = val
+        if opt == '--map':
+            chain_id, map_fn = val.split(':', 1)
+            options['maps'][chain_id] = map_fn
+        if opt == '--out_prefix':
+            options['out_prefix'] = val
+        if opt == '--min_dists':
+            options['min_dists'] = True
+        if opt == '--batch':
+            options['batch'] = val
+        if opt == '--processes':
+            options['processes'] = int(val)
+        if opt == '--out_dir':
+            options['out_dir'] = val
+        if opt == '--npy':
+            options['npy'] = val
+        if opt == '--block_size':
+            options['block_size'] = int(val)
+        if opt == '--min_sep':
+            options['min_sep'] = int(val)
+        if opt == '--pair_file':
+            options['pair_file'] = val
+        if opt == '--ensemble':
+            options['ensemble'] = True
+        if opt == '--contact':
+            options['contact'] = float(val)
 
     # Check arguments and required options
+    for dist_atom in options['dist_atoms']:
+        if dist_atom not in distances.DIST_ATOMS:
+            err = 'Error: unknown distance definition "%s"' % dist_atom
+            sys.exit(err + '\n' + usage)
+
+    if 'cutoff' in options and not options['cutoff'] > 0:
+        err = 'Error: --cutoff must be positive'
+        sys.exit(err + '\n' + usage)
+
+    if 'block_size' in options and options['block_size'] < 1:
+        err = 'Error: --block_size must be at least 1'
+        sys.exit(err + '\n' + usage)
+
+    # modes that do not support every option
+    unsupported = (('npy', ('pairs', 'batch', 'block_size', 'ensemble')),
+                   ('pairs', ('block_size', 'ensemble')),
+                   ('ensemble', ('block_size',))
+                   )
+    for (mode, opts) in unsupported:
+        for opt in opts:
+            if mode in options and opt in options:
+                err = 'Error: --%s can not be used with --%s' % (opt, mode)
+                sys.exit(err + '\n' + usage)
+
+    if 'batch' in options:
+        return options
+
     if len(args) < 1:
         err = 'Error: specify a pdb_file'
         sys.exit(err + '\n' + usage)
     options['pdb_file'] = args[0]
 
-    if 'chainL' not in options:
-        err = 'Error: specify a single or left chain'
+    if 'chainL' not in options and 'pairs' not in options:
+        err = 'Error: specify a single or left chain, or chain pairs'
         sys.exit(err + '\n' + usage)
 
+    if options.get('pairs', 'all') != 'all':
+        for pair in options['pairs'].split(','):
+            chain_ids = pair.split(':')
+            if len(chain_ids) != 2 or '' in chain_ids:
+                err = 'Error: --pairs entry "%s" is not L:R' % pair
+                sys.exit(err + '\n' + usage)
+
     return options
 
 def get_residues(chain):
-    ''' Returns generator over structural residues in chain
+    ''' Returns structural residues in chain
 
-        chain: Bio.PDB.Chain entity
+        chain: CompactStructure over one chain
 
     '''
 
-    return (res
-            for res
-            in distances.get_nonhet_residues(chain)
-            if distances.has_structure_carbon(res)
+    return chain.take_residues(distances.has_structure_carbons(chain))
+
+def make_interchain_pairs(n_res_a, n_res_b):
+    ''' Return index arrays over pairs of residues in two chains.
+
+        n_res_a, n_res_b: number of residues in each chain
+
+        Pairs are ordered like itertools.product()
+
+        Returns a tuple of numpy.ndarrays (idx_a, idx_b)
+
+    '''
+
+    idx_a, idx_b = np.indices((n_res_a, n_res_b))
+    return idx_a.ravel(), idx_b.ravel()
+
+def make_intrachain_pairs(n_res, first_row = 0, n_rows = None):
+    ''' Return index arrays over pairs of residues in a chain
+
+        n_res: number of residues in the chain
+        first_row, n_rows: only get pairs with a left residue in
+                           first_row, ..., first_row + n_rows - 1
+                           [default = all residues]
+
+        Pairs are ordered like itertools.combinations()
+
+        Returns a tuple of numpy.ndarrays (idx_a, idx_b), where idx_a counts
+        from first_row
+
+    '''
+
+    if first_row == 0 and n_rows is None:
+        return np.triu_indices(n_res, k = 1)
+    if n_rows is None:
+        n_rows = n_res - first_row
+
+    rows = np.arange(first_row, first_row + n_rows)
+    return np.nonzero(np.arange(n_res) > rows[:, np.newaxis])
+
+def find_residues(resnums, query_resnums):
+    ''' Find residues by residue number
+
+        resnums: residue numbers of a chain
+        query_resnums: residue numbers to look up
+
+        Returns a numpy.ndarray of indices into resnums, -1 where a query
+        resnum is not in the chain
+
+    '''
+
+    query_resnums = np.asarray(query_resnums, dtype = int)
+    if len(resnums) == 0:
+        return np.full(len(query_resnums), -1, dtype = np.intp)
+
+    sorter = np.argsort(resnums, kind = 'mergesort')
+    pos = np.searchsorted(resnums, query_resnums, sorter = sorter)
+    idx = sorter[np.minimum(pos, len(resnums) - 1)]
+
+    return np.where(resnums[idx] == query_resnums, idx, -1)
+
+def select_pairs(res_a, res_b, intrachain, first_row = 0, min_sep = 0,
+                 pair_resns = None):
+    ''' Return index arrays over the residue pairs to get distances for
+
+        res_a, res_b: CompactStructures over structural residues
+        intrachain, first_row: see calc_pair_distances()
+        min_sep: with intrachain, skip pairs with residue numbers closer
+                 than min_sep
+        pair_resns: if not None, a tuple (left resnums, right resnums) of
+                    the only pairs to keep. With intrachain, pairs match in
+                    either order
+
+        Pairs are enumerated from pair_resns directly when given, so excluded
+        pairs are never expanded. Pairs are in row-major order.
+
+        Returns a tuple of numpy.ndarrays (idx_a, idx_b)
+
+    '''
+
+    if pair_resns is None:
+        if intrachain:
+            idx_a, idx_b = make_intrachain_pairs(len(res_b), first_row, len(res_a))
+        else:
+            idx_a, idx_b = make_interchain_pairs(len(res_a), len(res_b))
+    else:
+        (left_resns, right_resns) = pair_resns
+        if intrachain:
+            # look up both sides in the whole chain, then keep block rows
+            idx_a = find_residues(res_b.resnums, left_resns)
+            idx_b = find_residues(res_b.resnums, right_resns)
+            found = (idx_a >= 0) & (idx_b >= 0) & (idx_a != idx_b)
+            idx_a, idx_b = (np.minimum(idx_a[found], idx_b[found]),
+                            np.maximum(idx_a[found], idx_b[found])
+                            )
+            in_block = (idx_a >= first_row) & (idx_a < first_row + len(res_a))
+            idx_a = idx_a[in_block] - first_row
+            idx_b = idx_b[in_block]
+        else:
+            idx_a = find_residues(res_a.resnums, left_resns)
+            idx_b = find_residues(res_b.resnums, right_resns)
+            found = (idx_a >= 0) & (idx_b >= 0)
+            idx_a = idx_a[found]
+            idx_b = idx_b[found]
+        pair_keys = np.unique(idx_a * len(res_b) + idx_b)
+        idx_a, idx_b = np.divmod(pair_keys, len(res_b))
+
+    if intrachain and min_sep > 0:
+        far = np.abs(res_a.resnums[idx_a] - res_b.resnums[idx_b]) >= min_sep
+        idx_a = idx_a[far]
+        idx_b = idx_b[far]
+
+    return idx_a, idx_b
+
+def prepare_chain(chain, dist_atoms):
+    ''' Extract structural residues and their coordinates from a chain
+
+        chain: CompactStructure over one chain
+        dist_atoms: list of distance definitions (see distances.DIST_ATOMS)
+
+        Atoms used by any atom-based definition are extracted once. Each
+        definition selects its atoms with a mask over them.
+
+        Returns a tuple (residues, coords, offsets, atom_masks, centroids):
+            atom_masks: dict from definition to a boolean mask over coords
+                        (None if the definition uses every extracted atom)
+            centroids: side chain centroids, or None without 'Cen'
+
+    '''
+
+    residues = get_residues(chain)
+
+    atom_defs = [dist_atom for dist_atom in dist_atoms if dist_atom != 'Cen']
+    selections = dict((dist_atom, distances.choose_select_atoms(dist_atom)(residues))
+                      for dist_atom in atom_defs
+                      )
+    union = np.zeros(len(residues.coords), dtype = bool)
+    for selected in selections.values():
+        union |= selected
+    coords, offsets = residues.get_coords(union)
+    atom_masks = dict()
+    for (dist_atom, selected) in selections.iteritems():
+        if selected[union].all():
+            atom_masks[dist_atom] = None
+        else:
+            atom_masks[dist_atom] = selected[union]
+
+    centroids = None
+    if 'Cen' in dist_atoms:
+        centroids = distances.get_sidechain_centroids(residues)[0]
+
+    return residues, coords, offsets, atom_masks, centroids
+
+def slice_prepared_chain(prep, start, stop):
+    ''' Returns residues start to stop - 1 of a chain from prepare_chain()
+
+    '''
+
+    (residues, coords, offsets, atom_masks, centroids) = prep
+    ends = np.append(offsets[1:], len(coords))
+    atom_slice = slice(offsets[start], ends[stop - 1])
+    block_masks = dict((dist_atom, mask if mask is None else mask[atom_slice])
+                       for (dist_atom, mask) in atom_masks.iteritems()
+                       )
+    if centroids is not None:
+        centroids = centroids[start:stop]
+
+    return (residues.get_residue_range(start, stop), coords[atom_slice],
+            offsets[start:stop] - offsets[start], block_masks, centroids
             )
 
-def make_interchain_pairs(chain_a, chain_b):
-    ''' Return a generator over pairs of residues in two chains.
+def calc_distance_matrices(prep_a, prep_b, dist_atoms):
+    ''' Get a residue-by-residue distance matrix for each distance definition
+
+        prep_a, prep_b: tuples returned by prepare_chain()
+        dist_atoms: list of distance definitions
+
+        Atom-atom distances are computed once for all atom-based definitions.
 
-        chain_a, chain_b: Bio.PDB.Chain entity
+        Returns a list of numpy.ndarrays, one per definition
 
     '''
 
-    res_a_g = get_residues(chain_a)
-    res_b_g = get_residues(chain_b)
-    return product(res_a_g, res_b_g)
+    (res_a, coords_a, offsets_a, masks_a, centroids_a) = prep_a
+    (res_b, coords_b, offsets_b, masks_b, centroids_b) = prep_b
 
-def make_intrachain_pairs(chain):
-    ''' Return a generator over pairs of residues in a chain
+    atom_defs = [dist_atom for dist_atom in dist_atoms if dist_atom != 'Cen']
+    dist_mats = dict()
+    if atom_defs:
+        atom_masks = [(masks_a[dist_atom], masks_b[dist_atom]) for dist_atom in atom_defs]
+        dist_mats.update(zip(atom_defs,
+                             distances.calc_min_distances_multi(coords_a, offsets_a,
+                                                                coords_b, offsets_b,
+                                                                atom_masks
+                                                                )
+                             ))
+    if 'Cen' in dist_atoms:
+        dist_mats['Cen'] = distances.calc_min_distances(centroids_a,
+                                                        np.arange(len(centroids_a)),
+                                                        centroids_b,
+                                                        np.arange(len(centroids_b))
+                                                        )
 
-        chain: Bio.PDB.Chain entity
+    return [dist_mats[dist_atom] for dist_atom in dist_atoms]
+
+def calc_pair_distance_lists(prep_a, prep_b, dist_atoms, idx_a, idx_b):
+    ''' Get distances for selected pairs of residues for each distance definition
+
+        prep_a, prep_b: tuples returned by prepare_chain()
+        dist_atoms: list of distance definitions
+        idx_a, idx_b: index arrays over residues in prep_a and prep_b
+
+        Only the selected pairs are computed (see distances.calc_pair_min_distances()).
+
+        Returns a list of numpy.ndarrays, one per definition
 
     '''
 
-    return combinations(get_residues(chain), r = 2)
+    (res_a, coords_a, offsets_a, masks_a, centroids_a) = prep_a
+    (res_b, coords_b, offsets_b, masks_b, centroids_b) = prep_b
 
-def get_distances(res_pairs, get_coords):
-    ''' Get distances for all pairs of residues between two chains
+    atom_defs = [dist_atom for dist_atom in dist_atoms if dist_atom != 'Cen']
+    pair_dists = dict()
+    if atom_defs:
+        atom_masks = [(masks_a[dist_atom], masks_b[dist_atom]) for dist_atom in atom_defs]
+        pair_dists.update(zip(atom_defs,
+                              distances.calc_pair_min_distances(coords_a, offsets_a,
+                                                                coords_b, offsets_b,
+                                                                idx_a, idx_b, atom_masks
+                                                                )
+                              ))
+    if 'Cen' in dist_atoms:
+        pair_dists['Cen'] = distances.calc_pair_min_distances(centroids_a,
+                                                              np.arange(centroids_a.shape[-2]),
+                                                              centroids_b,
+                                                              np.arange(centroids_b.shape[-2]),
+                                                              idx_a, idx_b
+                                                              )[0]
 
-        res_pairs: generator over tuples ((res_a, res_b), ...)
-        get_coords: function to get residue coordinates
+    return [pair_dists[dist_atom] for dist_atom in dist_atoms]
 
-        Returns a list over 5-tuples: [(resn_a, resn_b, aa_a, aa_b, dist), ...]
+def calc_contact_lists(prep_a, prep_b, dist_atoms, cutoff):
+    ''' Get residue pairs within cutoff for each distance definition
+
+        prep_a, prep_b: tuples returned by prepare_chain()
+        dist_atoms: list of distance definitions
+        cutoff: maximum distance (in Angstroms)
+
+        Returns a list of (idx_a, idx_b, dists) tuples, one per definition
 
     '''
 
-    return [
-            (res_a.id[1], res_b.id[1],
-             distances.calc_residue_distance(res_a, res_b, get_coords),
-             SeqUtils.seq1(res_a.resname), SeqUtils.seq1(res_b.resname)
-             )
-            for (res_a, res_b)
-            in res_pairs
-            ]
+    (res_a, coords_a, offsets_a, masks_a, centroids_a) = prep_a
+    (res_b, coords_b, offsets_b, masks_b, centroids_b) = prep_b
 
+    contacts = list()
+    for dist_atom in dist_atoms:
+        if dist_atom == 'Cen':
+            contacts += [distances.calc_contacts(centroids_a, np.arange(len(centroids_a)),
+                                                 centroids_b, np.arange(len(centroids_b)),
+                                                 cutoff
+                                                 )]
+            continue
+        sel_a = (coords_a, offsets_a)
+        sel_b = (coords_b, offsets_b)
+        if masks_a[dist_atom] is not None:
+            sel_a = distances.select_coords(coords_a, offsets_a, masks_a[dist_atom])
+        if masks_b[dist_atom] is not None:
+            sel_b = distances.select_coords(coords_b, offsets_b, masks_b[dist_atom])
+        contacts += [distances.calc_contacts(sel_a[0], sel_a[1], sel_b[0], sel_b[1], cutoff)]
 
-if __name__ == "__main__":
-    options = parse_cmd_line(sys.argv[1:])
-    structure = pdb_aux.open_pdb(options['pdb_file'])
-    model = structure[0]
-    get_coords = distances.choose_get_coords(options['dist_atoms'])
-
-    if 'chainR' in options:
-        res_pairs = make_interchain_pairs(model[options['chainL']],
-                                         model[options['chainR']]
-                                         )
+    return contacts
+
+def dist_colnames(dist_atoms):
+    ''' Returns distance column names for a list of distance definitions
+
+        A single definition keeps the name 'Distance'
+
+    '''
+
+    if len(dist_atoms) == 1:
+        return ['Distance']
+    return ['Distance_' + dist_atom for dist_atom in dist_atoms]
+
+def calc_pair_distances(prep_a, prep_b, dist_atoms, intrachain, cutoff = None,
+                        first_row = 0, min_sep = 0, pair_resns = None):
+    ''' Get distances for all pairs of residues between two prepared chains
+
+        prep_a, prep_b: tuples returned by prepare_chain()
+        dist_atoms: list of distance definitions
+        intrachain: if True, prep_a and prep_b are the same chain and only
+                    pairs with the left residue before the right are kept
+        cutoff: if not None, only get pairs within cutoff distance (in Angstroms)
+                of each other by any definition. Every definition's distance
+                is kept for those pairs, even if beyond cutoff
+        first_row: with intrachain, prep_a may be a block of residues in
+                   prep_b starting at residue first_row (see iter_distance_blocks())
+        min_sep, pair_resns: skip pairs before computing distances
+                             (see select_pairs())
+
+        Returns a pandas.DataFrame with columns:
+            Left_resn, Right_resn, <one column per definition>, Left_AA, Right_AA
+        (see dist_colnames())
+
+    '''
+
+    res_a = prep_a[0]
+    res_b = prep_b[0]
+
+    if cutoff is not None and pair_resns is None:
+        contacts = calc_contact_lists(prep_a, prep_b, dist_atoms, cutoff)
+        if intrachain:
+            contacts = [(idx_a[idx_a + first_row < idx_b],
+                         idx_b[idx_a + first_row < idx_b],
+                         dists[idx_a + first_row < idx_b]
+                         )
+                        for (idx_a, idx_b, dists) in contacts
+                        ]
+
+        # residue pairs in contact by any definition, in row-major order
+        pair_keys = [idx_a * len(res_b) + idx_b for (idx_a, idx_b, dists) in contacts]
+        all_keys = np.unique(np.concatenate(pair_keys))
+        idx_a, idx_b = np.divmod(all_keys, len(res_b))
+        dists_by_def = list()
+        for (keys, (_, _, dists)) in zip(pair_keys, contacts):
+            def_dists = np.full(len(all_keys), np.nan, dtype = np.float32)
+            def_dists[np.searchsorted(all_keys, keys)] = dists
+            dists_by_def += [def_dists]
+
+        if intrachain and min_sep > 0:
+            far = np.abs(res_a.resnums[idx_a] - res_b.resnums[idx_b]) >= min_sep
+            idx_a = idx_a[far]
+            idx_b = idx_b[far]
+            dists_by_def = [dists[far] for dists in dists_by_def]
+
+        # pairs within cutoff by one definition get the other distances too
+        for (dist_atom, dists) in zip(dist_atoms, dists_by_def):
+            beyond = np.isnan(dists)
+            if beyond.any():
+                dists[beyond] = calc_pair_distance_lists(prep_a, prep_b, [dist_atom],
+                                                         idx_a[beyond], idx_b[beyond]
+                                                         )[0]
+    elif pair_resns is None and not (intrachain and min_sep > 0):
+        idx_a, idx_b = select_pairs(res_a, res_b, intrachain, first_row)
+        dists_by_def = [dist_mat[idx_a, idx_b]
+                        for dist_mat
+                        in calc_distance_matrices(prep_a, prep_b, dist_atoms)
+                        ]
     else:
-        res_pairs = make_intrachain_pairs(model[options['chainL']])
-
-    dists = get_distances(res_pairs, get_coords)
-    dists_df = pd.DataFrame(dists,
-                            columns = ['Left_resn', 'Right_resn',
-                                       'Distance',
-                                       'Left_AA', 'Right_AA'
-                                       ]
+        # only compute distances for the selected pairs
+        idx_a, idx_b = select_pairs(res_a, res_b, intrachain, first_row,
+                                    min_sep, pair_resns
+                                    )
+        dists_by_def = calc_pair_distance_lists(prep_a, prep_b, dist_atoms,
+                                                idx_a, idx_b
+                                                )
+        if cutoff is not None:
+            within = np.zeros(len(idx_a), dtype = bool)
+            for dists in dists_by_def:
+                within |= dists <= cutoff
+            idx_a = idx_a[within]
+            idx_b = idx_b[within]
+            dists_by_def = [dists[within] for dists in dists_by_def]
+
+    colnames = dist_colnames(dist_atoms)
+    dists_df = pd.DataFrame(dict([('Left_resn', res_a.resnums[idx_a]),
+                                  ('Right_resn', res_b.resnums[idx_b]),
+                                  ('Left_AA', res_a.aas[idx_a]),
+                                  ('Right_AA', res_b.aas[idx_b])
+                                  ] + zip(colnames, dists_by_def)
+                                 ),
+                            columns = ['Left_resn', 'Right_resn'] + colnames +
+                                      ['Left_AA', 'Right_AA']
                             )
 
-    if 'mapL' in options:
-        lmap = tab_aux.load_map(options['mapL'], 'Left')  # Assumes "Column" is 1st column in header
+    return dists_df
+
+def get_distances(chain_a, chain_b, dist_atoms, cutoff = None, min_sep = 0,
+                  pair_resns = None):
+    ''' Get distances for all pairs of residues within a chain or between two chains
+
+        chain_a, chain_b: CompactStructures over one chain
+                          *If chain_b is None, get intrachain distances*
+        dist_atoms: list of distance definitions, eg. ['Cb', 'NoH']
+                    (see distances.DIST_ATOMS)
+        cutoff: if not None, only get pairs within cutoff distance (in Angstroms)
+        min_sep: for intrachain distances, minimum residue number separation
+        pair_resns: if not None, a tuple (left resnums, right resnums) of the
+                    only pairs to get distances for
+
+        Returns a pandas.DataFrame with columns:
+            Left_resn, Right_resn, <one column per definition>, Left_AA, Right_AA
+
+    '''
+
+    prep_a = prepare_chain(chain_a, dist_atoms)
+    if chain_b is None:
+        return calc_pair_distances(prep_a, prep_a, dist_atoms, True, cutoff,
+                                   min_sep = min_sep, pair_resns = pair_resns
+                                   )
+
+    return calc_pair_distances(prep_a, prepare_chain(chain_b, dist_atoms),
+                               dist_atoms, False, cutoff, pair_resns = pair_resns
+                               )
+
+def iter_distance_blocks(chain_a, chain_b, dist_atoms, block_size, cutoff = None,
+                         min_sep = 0, pair_resns = None):
+    ''' Get distances in blocks of left residues
+
+        chain_a, chain_b, dist_atoms, cutoff, min_sep, pair_resns:
+            see get_distances()
+        block_size: number of left residues per block, at least 1
+
+        Only one block of distances is held in memory at a time.
+
+        Returns a generator over pandas.DataFrames like get_distances()
+
+    '''
+
+    if block_size < 1:
+        raise ValueError('block_size must be at least 1, got %s' % block_size)
+
+    prep_a = prepare_chain(chain_a, dist_atoms)
+    if chain_b is None:
+        prep_b = prep_a
+    else:
+        prep_b = prepare_chain(chain_b, dist_atoms)
+    n_res_a = len(prep_a[0])
+
+    for start in xrange(0, n_res_a, block_size):
+        stop = min(start + block_size, n_res_a)
+        block_a = slice_prepared_chain(prep_a, start, stop)
+        yield calc_pair_distances(block_a, prep_b, dist_atoms, chain_b is None,
+                                  cutoff, first_row = start, min_sep = min_sep,
+                                  pair_resns = pair_resns
+                                  )
+
+def get_distance_matrices(chain_a, chain_b, dist_atoms, cutoff = None,
+                          min_sep = 0, pair_resns = None):
+    ''' Get residue-by-residue distance matrices within a chain or between two chains
+
+        chain_a, chain_b, dist_atoms, cutoff, min_sep, pair_resns:
+            see get_distances()
+            *pairs beyond cutoff or skipped by min_sep or pair_resns are NaN*
+
+        Intrachain matrices hold every pair (in both orders), not only pairs
+        in get_distances().
+
+        Returns a tuple (res_a, res_b, dist_mats) where res_a and res_b are
+        CompactStructures over the structural residues in rows and columns
+        and dist_mats is a list with one matrix per definition
+
+    '''
+
+    prep_a = prepare_chain(chain_a, dist_atoms)
+    if chain_b is None:
+        prep_b = prep_a
+    else:
+        prep_b = prepare_chain(chain_b, dist_atoms)
+    res_a = prep_a[0]
+    res_b = prep_b[0]
+
+    if pair_resns is not None or (chain_b is None and min_sep > 0):
+        idx_a, idx_b = select_pairs(res_a, res_b, chain_b is None,
+                                    min_sep = min_sep, pair_resns = pair_resns
+                                    )
+        dist_mats = list()
+        for dists in calc_pair_distance_lists(prep_a, prep_b, dist_atoms, idx_a, idx_b):
+            dist_mat = np.full((len(res_a), len(res_b)), np.nan, dtype = np.float32)
+            if cutoff is not None:
+                dists = np.where(dists <= cutoff, dists, np.nan)
+            dist_mat[idx_a, idx_b] = dists
+            if chain_b is None:
+                dist_mat[idx_b, idx_a] = dists
+            dist_mats += [dist_mat]
+    elif cutoff is None:
+        dist_mats = calc_distance_matrices(prep_a, prep_b, dist_atoms)
+    else:
+        dist_mats = list()
+        for (idx_a, idx_b, dists) in calc_contact_lists(prep_a, prep_b, dist_atoms, cutoff):
+            dist_mat = np.full((len(res_a), len(res_b)), np.nan, dtype = np.float32)
+            dist_mat[idx_a, idx_b] = dists
+            dist_mats += [dist_mat]
+
+    return res_a, res_b, dist_mats
+
+def same_atoms(prep, ref):
+    ''' Returns True if two prepared chains have the same residues and atoms
+
+        prep, ref: tuples returned by prepare_chain()
+
+    '''
+
+    return (np.array_equal(prep[0].resnums, ref[0].resnums)
+            and np.array_equal(prep[0].atom_names, ref[0].atom_names)
+            and np.array_equal(prep[2], ref[2])
+            )
+
+def stack_prepared_chains(preps):
+    ''' Stack coordinates of prepared chains with the same atoms
+
+        preps: list of tuples returned by prepare_chain() (see same_atoms())
+
+        Returns a tuple like prepare_chain() with coords and centroids of
+        shape (n_models, n, 3)
+
+    '''
+
+    (residues, coords, offsets, atom_masks, centroids) = preps[0]
+    coords = np.array([prep[1] for prep in preps])
+    if centroids is not None:
+        centroids = np.array([prep[4] for prep in preps])
+
+    return residues, coords, offsets, atom_masks, centroids
+
+def update_ensemble_stats(stats, pairs, dists_by_def, contact_cutoff):
+    ''' Add distances from one or more models to per-pair ensemble statistics
+
+        stats: dict of accumulators from get_ensemble_distances()
+        pairs: index or boolean mask over pairs in stats
+        dists_by_def: list of numpy.ndarrays with shape (n_models, n_pairs),
+                      one per distance definition
+        contact_cutoff: distance (in Angstroms) counted as a contact
+
+    '''
+
+    stats['n_models'][pairs] += dists_by_def[0].shape[0]
+    for (i, dists) in enumerate(dists_by_def):
+        stats['min'][i][pairs] = np.fmin(stats['min'][i][pairs], dists.min(axis = 0))
+        stats['sum'][i][pairs] += dists.sum(axis = 0, dtype = np.float64)
+        stats['contacts'][i][pairs] += (dists <= contact_cutoff).sum(axis = 0)
+
+def get_ensemble_distances(models, chain_id_a, chain_id_b, dist_atoms,
+                           contact_cutoff = 8.0, cutoff = None, min_sep = 0,
+                           pair_resns = None, batch_models = 16):
+    ''' Aggregate distances over many models of a structure (eg. NMR ensembles)
+
+        models: iterable over CompactStructures, one per model
+                (see coevo.pdb_aux.iter_pdb_models())
+        chain_id_a, chain_id_b: left and right chain ids
+                                *If chain_id_b is None, get intrachain distances*
+        dist_atoms, min_sep, pair_resns: see get_distances()
+        contact_cutoff: distance (in Angstroms) counted as a contact
+        cutoff: if not None, only keep pairs with a minimum distance within
+                cutoff by any definition
+        batch_models: number of models with the same atoms to get distances
+                      for at once
+
+        Pairs are taken from the first model. Models are read one at a time
+        and only per-pair running statistics are kept, never a model's full
+        distance table. Consecutive models with the same atoms as the first
+        model are stacked and computed together. Other models are matched to
+        the first model by residue number, and pairs missing a residue are
+        not counted for that model. Models without the chains are skipped.
+
+        Returns a pandas.DataFrame with columns:
+            Left_resn, Right_resn, Min_<col>..., Mean_<col>...,
+            Frac_<col>..., N_Models, Left_AA, Right_AA
+        where <col> is a distance column (see dist_colnames()) and Frac_
+        columns, named with Contact in place of Distance, hold the fraction
+        of models with a contact
+
+    '''
+
+    intrachain = chain_id_b is None
+    ref_a = ref_b = None
+    batch = list()
+    for model in models:
+        if chain_id_a not in model.chain_slices:
+            continue
+        if not intrachain and chain_id_b not in model.chain_slices:
+            continue
+        prep_a = prepare_chain(model.get_chain(chain_id_a), dist_atoms)
+        if intrachain:
+            prep_b = prep_a
+        else:
+            prep_b = prepare_chain(model.get_chain(chain_id_b), dist_atoms)
+
+        if ref_a is None:
+            ref_a, ref_b = prep_a, prep_b
+            idx_a, idx_b = select_pairs(ref_a[0], ref_b[0], intrachain,
+                                        min_sep = min_sep, pair_resns = pair_resns
+                                        )
+            stats = {'n_models': np.zeros(len(idx_a), dtype = int),
+                     'min': [np.full(len(idx_a), np.inf, dtype = np.float32)
+                             for dist_atom in dist_atoms],
+                     'sum': [np.zeros(len(idx_a)) for dist_atom in dist_atoms],
+                     'contacts': [np.zeros(len(idx_a), dtype = int)
+                                  for dist_atom in dist_atoms]
+                     }
+
+        if same_atoms(prep_a, ref_a) and same_atoms(prep_b, ref_b):
+            batch += [(prep_a, prep_b)]
+        else:
+            model_a = find_residues(prep_a[0].resnums, ref_a[0].resnums)[idx_a]
+            model_b = find_residues(prep_b[0].resnums, ref_b[0].resnums)[idx_b]
+            found = (model_a >= 0) & (model_b >= 0)
+            dists_by_def = calc_pair_distance_lists(prep_a, prep_b, dist_atoms,
+                                                    model_a[found], model_b[found]
+                                                    )
+            update_ensemble_stats(stats, found,
+                                  [dists[np.newaxis] for dists in dists_by_def],
+                                  contact_cutoff
+                                  )
+
+        if len(batch) == batch_models:
+            update_ensemble_stack(stats, batch, intrachain, dist_atoms,
+                                  idx_a, idx_b, contact_cutoff
+                                  )
+            batch = list()
+
+    if ref_a is None:
+        raise KeyError('no model has chain(s) %s'
+                       % ', '.join(chain_id for chain_id in (chain_id_a, chain_id_b)
+                                   if chain_id is not None)
+                       )
+    if batch:
+        update_ensemble_stack(stats, batch, intrachain, dist_atoms,
+                              idx_a, idx_b, contact_cutoff
+                              )
+
+    res_a = ref_a[0]
+    res_b = ref_b[0]
+    colnames = dist_colnames(dist_atoms)
+    columns = [('Left_resn', res_a.resnums[idx_a]),
+               ('Right_resn', res_b.resnums[idx_b])
+               ]
+    columns += [('Min_' + col, mins) for (col, mins) in zip(colnames, stats['min'])]
+    columns += [('Mean_' + col, sums / stats['n_models'])
+                for (col, sums) in zip(colnames, stats['sum'])
+                ]
+    columns += [('Frac_' + col.replace('Distance', 'Contact'),
+                 contacts / stats['n_models'].astype(float)
+                 )
+                for (col, contacts) in zip(colnames, stats['contacts'])
+                ]
+    columns += [('N_Models', stats['n_models']),
+                ('Left_AA', res_a.aas[idx_a]),
+                ('Right_AA', res_b.aas[idx_b])
+                ]
+    dists_df = pd.DataFrame(OrderedDict(columns))
+
+    if cutoff is not None:
+        within = np.zeros(len(dists_df), dtype = bool)
+        for mins in stats['min']:
+            within |= mins <= cutoff
+        dists_df = dists_df[within].reset_index(drop = True)
+
+    return dists_df
+
+def update_ensemble_stack(stats, batch, intrachain, dist_atoms, idx_a, idx_b,
+                          contact_cutoff):
+    ''' Add a batch of models with the same atoms to ensemble statistics
+
+        batch: list of (prep_a, prep_b) tuples from prepare_chain()
+        other arguments: see get_ensemble_distances() and update_ensemble_stats()
+
+    '''
+
+    stack_a = stack_prepared_chains([preps[0] for preps in batch])
+    if intrachain:
+        stack_b = stack_a
+    else:
+        stack_b = stack_prepared_chains([preps[1] for preps in batch])
+    update_ensemble_stats(stats, slice(None),
+                          calc_pair_distance_lists(stack_a, stack_b, dist_atoms,
+                                                   idx_a, idx_b
+                                                   ),
+                          contact_cutoff
+                          )
+
+def map_resns(resns, map_fn):
+    ''' Map resnums to alignment columns using a column-to-resnum map file
+
+        Returns a numpy.ndarray of columns, -1 where resnum is not in the map
+
+    '''
+
+    map_df = tab_aux.load_map(map_fn)
+    resn_to_col = dict(zip(map_df['resn'], map_df['Column']))
+
+    return np.array([resn_to_col.get(resn, -1) for resn in resns], dtype = int)
+
+def write_dist_matrices(prefix, res_a, res_b, dist_mats, dist_atoms,
+                        mapL_fn = None, mapR_fn = None):
+    ''' Write distance matrices and resnum, AA, and column vectors in binary format
+
+        prefix: output filename prefix (see coevo.tab_aux.distmat)
+        res_a, res_b, dist_mats: from get_distance_matrices()
+        dist_atoms: list of distance definitions. With more than one, each
+                    matrix is written under <prefix>.<definition>
+        mapL_fn, mapR_fn: column-to-resnum map filenames, or None
+
+    '''
+
+    index_vectors = {'Left_resn': res_a.resnums, 'Right_resn': res_b.resnums,
+                     'Left_AA': res_a.aas, 'Right_AA': res_b.aas
+                     }
+    if mapL_fn is not None:
+        index_vectors['Left_Column'] = map_resns(res_a.resnums, mapL_fn)
+    if mapR_fn is not None:
+        index_vectors['Right_Column'] = map_resns(res_b.resnums, mapR_fn)
+
+    if len(dist_atoms) == 1:
+        tab_aux.save_dist_matrix(prefix, dist_mats[0], index_vectors)
+    else:
+        for (dist_atom, dist_mat) in zip(dist_atoms, dist_mats):
+            tab_aux.save_dist_matrix(prefix + '.' + dist_atom, dist_mat, index_vectors)
+
+def parse_chain_pairs(pairs_str, struct):
+    ''' Parse --pairs value into a list of (left chain id, right chain id)
+
+        pairs_str: 'L:R,L:R,...' or 'all' for every pair of different chains
+        struct: CompactStructure, used to list chains for 'all'
+
+        Raises ValueError for entries without exactly two chain ids.
+
+    '''
+
+    if pairs_str == 'all':
+        chain_ids = sorted(struct.chain_slices,
+                           key = lambda chain_id: struct.chain_slices[chain_id].start
+                           )
+        return [(chain_ids[i], chain_ids[j])
+                for i in xrange(len(chain_ids))
+                for j in xrange(i + 1, len(chain_ids))
+                ]
+
+    chain_pairs = [tuple(pair.split(':')) for pair in pairs_str.split(',')]
+    for (pair, chain_pair) in zip(pairs_str.split(','), chain_pairs):
+        if len(chain_pair) != 2 or '' in chain_pair:
+            raise ValueError('chain pair "%s" is not L:R' % pair)
+
+    return chain_pairs
+
+def get_pair_distances(struct, chain_pairs, dist_atoms, cutoff = None,
+                       min_sep = 0, pair_masks = None):
+    ''' Get distances for many chain pairs, extracting each chain only once
+
+        struct: CompactStructure holding all chains in chain_pairs
+        chain_pairs: list of (left chain id, right chain id)
+                     *Identical ids get intrachain distances*
+        dist_atoms, cutoff, min_sep: see get_distances()
+        pair_masks: if not None, dict from chain pair to pair_resns
+                    (see get_distances())
+
+        Returns a generator over ((chain_id_a, chain_id_b), dists_df)
+
+    '''
+
+    prepped = dict()
+    for (chain_id_a, chain_id_b) in chain_pairs:
+        for chain_id in (chain_id_a, chain_id_b):
+            if chain_id not in prepped:
+                prepped[chain_id] = prepare_chain(struct.get_chain(chain_id),
+                                                  dist_atoms
+                                                  )
+        yield ((chain_id_a, chain_id_b),
+               calc_pair_distances(prepped[chain_id_a], prepped[chain_id_b],
+                                   dist_atoms, chain_id_a == chain_id_b, cutoff,
+                                   min_sep = min_sep,
+                                   pair_resns = (pair_masks or {}).get((chain_id_a, chain_id_b))
+                                   )
+               )
+
+def load_maps(mapL_fn = None, mapR_fn = None):
+    ''' Load column-to-resnum maps for left and right chains
+
+        mapL_fn, mapR_fn: filenames of column-to-resnum maps, or None
+
+        Returns a tuple (lmap, rmap) of pandas.DataFrames (or None)
+
+    '''
+
+    lmap = rmap = None
+    if mapL_fn is not None:
+        lmap = tab_aux.load_map(mapL_fn, 'Left')  # Assumes "Column" is 1st column in header
+    if mapR_fn is not None:
+        rmap = tab_aux.load_map(mapR_fn, 'Right')
+
+    return lmap, rmap
+
+def load_pair_mask(pair_fn, lmap = None, rmap = None):
+    ''' Load pairs to get distances for from a tab delimited file
+
+        pair_fn: file with a header, pairs in the first two columns
+                 (eg. a score file indexed by Left_Column, Right_Column)
+        lmap, rmap: column-to-resnum maps from load_maps(), used when the
+                    pair column names contain 'Column'. Pairs with an
+                    unmapped column are dropped
+
+        Returns a tuple (left resnums, right resnums) of numpy.ndarrays
+
+    '''
+
+    pair_index = tab_aux.load_pairtab(pair_fn).index
+    sides = list()
+    mapped = np.ones(len(pair_index), dtype = bool)
+    for (level, (side, map_df)) in enumerate((('Left', lmap), ('Right', rmap))):
+        ids = pair_index.get_level_values(level).values.astype(int)
+        if 'Column' in str(pair_index.names[level]):
+            if map_df is None:
+                raise ValueError('%s pairs are alignment columns, but no %s map was given'
+                                 % (pair_fn, side.lower())
+                                 )
+            col_to_resn = dict(zip(map_df[side + '_Column'], map_df[side + '_resn']))
+            mapped &= np.array([col in col_to_resn for col in ids], dtype = bool)
+            ids = np.array([col_to_resn.get(col, 0) for col in ids], dtype = int)
+        sides += [ids]
+
+    return sides[0][mapped], sides[1][mapped]
+
+def map_and_index(dists_df, lmap = None, rmap = None):
+    ''' Convert resnums to alignment columns (if maps are given) and set index
+
+        dists_df: pandas.DataFrame from get_distances()
+        lmap, rmap: column-to-resnum maps for each chain from load_maps()
+
+        Returns a pandas.DataFrame indexed by resnums or columns
+
+    '''
+
+    if lmap is not None:
         dists_df = tab_aux.convert_col(dists_df, lmap,
                                        from_col = 'Left_resn',
                                        to_col = 'Left_Column'
                                        )
-    if 'mapR' in options:
-        rmap = tab_aux.load_map(options['mapR'], 'Right')
+    if rmap is not None:
         dists_df = tab_aux.convert_col(dists_df, rmap,
                                        from_col = 'Right_resn',
                                        to_col = 'Right_Column'
@@ -180,10 +1074,303 @@ if __name__ == "__main__":
     indices = [col
                for col
                in dists_df.columns
-               if col in ('Left_resn', 'Right_resn',
+               if col in ('Left_Chain', 'Right_Chain',
+                          'Left_resn', 'Right_resn',
                           'Left_Column', 'Right_Column'
                           )
                ]
     dists_df.set_index(indices, inplace = True)
-    dists_df.to_csv(sys.stdout, sep = '\t', header = True, float_format = '%.6f')
 
+    return dists_df
+
+def write_dists(dists_df, out_fh, header = True):
+    ''' Write distances as tab delimited
+
+    '''
+
+    dists_df.to_csv(out_fh, sep = '\t', header = header, float_format = '%.6f')
+
+def write_chain_pair_dists(pdb_file, chain_id_a, chain_id_b, mapL_fn, mapR_fn,
+                           options, out_fh):
+    ''' Write distances for one chain (or chain pair) in one pdb file
+
+        pdb_file: pdb filename
+        chain_id_a, chain_id_b: left and right chain ids
+                                *If chain_id_b is None, get intrachain distances*
+        mapL_fn, mapR_fn: column-to-resnum map filenames, or None
+        options: dict from parse_cmd_line()
+        out_fh: open file handle to write to
+
+        With options['block_size'], distances are computed, mapped and
+        written one block of left residues at a time (see iter_distance_blocks()).
+        With options['ensemble'], distances are aggregated over all models
+        read one at a time with the fast reader (see get_ensemble_distances()).
+
+        Returns the number of rows written
+
+    '''
+
+    chain_ids = [chain_id for chain_id in (chain_id_a, chain_id_b) if chain_id is not None]
+    lmap, rmap = load_maps(mapL_fn, mapR_fn)
+    pair_resns = None
+    if 'pair_file' in options:
+        pair_resns = load_pair_mask(options['pair_file'], lmap, rmap)
+
+    if 'ensemble' in options:
+        # always streamed: Bio.PDB.PDBParser would hold every model at once
+        models = pdb_aux.iter_pdb_models(pdb_file, chain_ids, fast_pdb = True)
+        dist_blocks = [get_ensemble_distances(models, chain_id_a, chain_id_b,
+                                              options['dist_atoms'], options['contact'],
+                                              options.get('cutoff'), options['min_sep'],
+                                              pair_resns
+                                              )]
+    else:
+        struct = pdb_aux.load_pdb_compact(pdb_file,
+                                          fast_pdb = 'fast_pdb' in options,
+                                          use_cache = 'no_cache' not in options,
+                                          chain_ids = chain_ids
+                                          )
+        chain_a = struct.get_chain(chain_id_a)
+        if chain_id_b is None:
+            chain_b = None
+        else:
+            chain_b = struct.get_chain(chain_id_b)
+
+        if 'block_size' in options:
+            dist_blocks = iter_distance_blocks(chain_a, chain_b,
+                                               options['dist_atoms'], options['block_size'],
+                                               options.get('cutoff'), options['min_sep'],
+                                               pair_resns
+                                               )
+        else:
+            dist_blocks = [get_distances(chain_a, chain_b,
+                                         options['dist_atoms'],
+                                         options.get('cutoff'), options['min_sep'],
+                                         pair_resns
+                                         )]
+
+    n_rows = 0
+    header = True
+    for dists_df in dist_blocks:
+        dists_df = map_and_index(dists_df, lmap, rmap)
+        write_dists(dists_df, out_fh, header = header)
+        n_rows += len(dists_df)
+        header = False
+
+    return n_rows
+
+def read_manifest(manifest_fn, out_dir):
+    ''' Read batch jobs from a tab delimited manifest
+
+        manifest_fn: filename of manifest with rows of
+                     pdb_file, chainL, chainR, mapL, mapR [, out_file]
+        out_dir: directory for output files without an out_file
+
+        Skips blank lines, lines starting with '#' and a header row starting
+        with 'pdb_file'. Empty fields or '-' are set to None. Default output
+        files are named <pdb id>.<chains>[.<map names>].tsv
+
+        Raises ValueError if two jobs write to the same output file.
+
+        Returns a list of (line number, job dict)
+
+    '''
+
+    fields = ('pdb_file', 'chainL', 'chainR', 'mapL', 'mapR', 'out_file')
+    jobs = list()
+    out_lines = dict()  # normalized out_file -> line number
+    for (line_num, line) in enumerate(open(manifest_fn), 1):
+        vals = line.rstrip('\r\n').split('\t')
+        if vals[0] in ('', 'pdb_file') or vals[0].startswith('#'):
+            continue
+        vals = [val.strip() for val in vals]
+        vals = [val if val not in ('', '-') else None for val in vals]
+        job = dict(zip(fields, vals + [None] * (len(fields) - len(vals))))
+        if job['out_file'] is None:
+            pdb_id = os.path.basename(job['pdb_file']).split('.')[0]
+            chains = '_'.join(chain for chain in (job['chainL'], job['chainR']) if chain)
+            out_name = '%s.%s' % (pdb_id, chains)
+            map_names = [os.path.splitext(os.path.basename(map_fn))[0]
+                         for map_fn in (job['mapL'], job['mapR']) if map_fn
+                         ]
+            if map_names:
+                out_name += '.' + '_'.join(map_names)
+            job['out_file'] = os.path.join(out_dir, out_name + '.tsv')
+        out_key = os.path.normpath(os.path.abspath(job['out_file']))
+        if out_key in out_lines:
+            raise ValueError('manifest lines %d and %d both write to "%s", set out_file'
+                             % (out_lines[out_key], line_num, job['out_file'])
+                             )
+        out_lines[out_key] = line_num
+        jobs += [(line_num, job)]
+
+    return jobs
+
+def run_batch_job(line_job_options):
+    ''' Run one batch job in a worker process and write its output
+
+        line_job_options: tuple of (line number, job dict, options)
+
+        Output is written to <out_file>.tmp, which replaces out_file only
+        when the job succeeds.
+
+        Returns a tuple (line number, job dict, rows written, seconds, error)
+        where error is None on success
+
+    '''
+
+    (line_num, job, options) = line_job_options
+    start = time.time()
+    tmp_fn = job['out_file'] + '.tmp'  # out_files are unique (see read_manifest())
+    try:
+        with open(tmp_fn, 'w') as out_fh:
+            n_rows = write_chain_pair_dists(job['pdb_file'], job['chainL'], job['chainR'],
+                                            job['mapL'], job['mapR'], options, out_fh
+                                            )
+        os.rename(tmp_fn, job['out_file'])
+    except Exception as err:
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        return (line_num, job, 0, time.time() - start, '%s: %s' % (type(err).__name__, err))
+
+    return (line_num, job, n_rows, time.time() - start, None)
+
+def run_batch(jobs, options):
+    ''' Run batch jobs in a bounded pool of worker processes
+
+        jobs: list from read_manifest()
+        options: dict from parse_cmd_line()
+
+        Reports failed rows and a throughput summary to stderr.
+
+        Returns the number of failed jobs
+
+    '''
+
+    start = time.time()
+    pool = multiprocessing.Pool(options['processes'])
+    n_failed = 0
+    n_rows = 0
+    job_seconds = 0.0
+    for (line_num, job, rows, seconds, err) in pool.imap_unordered(
+                                                   run_batch_job,
+                                                   [(line_num, job, options)
+                                                    for (line_num, job) in jobs]
+                                                   ):
+        job_seconds += seconds
+        if err is None:
+            n_rows += rows
+        else:
+            n_failed += 1
+            print >>sys.stderr, 'Failed manifest line %d (%s): %s' % (line_num, job['pdb_file'], err)
+    pool.close()
+    pool.join()
+
+    wall_seconds = time.time() - start
+    print >>sys.stderr, (
+                         'Batch summary: %d jobs, %d succeeded, %d failed\n'
+                         '  %d processes, %.2f s wall time, %.2f s in jobs\n'
+                         '  %.2f jobs/s, %.0f distances/s'
+                         ) % (len(jobs), len(jobs) - n_failed, n_failed,
+                              options['processes'], wall_seconds, job_seconds,
+                              len(jobs) / wall_seconds, n_rows / wall_seconds
+                              )
+
+    return n_failed
+
+
+if __name__ == "__main__":
+    options = parse_cmd_line(sys.argv[1:])
+    if 'batch' in options:
+        try:
+            jobs = read_manifest(options['batch'], options['out_dir'])
+        except ValueError as err:
+            sys.exit('Error: %s' % err)
+        if run_batch(jobs, options) > 0:
+            sys.exit(1)
+    elif 'pairs' in options:
+        if options['pairs'] == 'all':
+            chain_ids = None
+        else:
+            chain_ids = set(options['pairs'].replace(',', ':').split(':'))
+        struct = pdb_aux.load_pdb_compact(options['pdb_file'],
+                                          fast_pdb = 'fast_pdb' in options,
+                                          use_cache = 'no_cache' not in options,
+                                          chain_ids = chain_ids
+                                          )
+        chain_pairs = parse_chain_pairs(options['pairs'], struct)
+        if options['maps'] and ('out_prefix' not in options or 'min_dists' in options):
+            # combined tables need the same (column or resnum) index for every pair
+            unmapped = sorted(set(chain_id for chain_pair in chain_pairs
+                                  for chain_id in chain_pair) - set(options['maps'])
+                              )
+            if unmapped:
+                sys.exit('Error: --map given for some chains but not for %s. '
+                         'Map every chain, or none, unless writing each pair with --out_prefix'
+                         % ', '.join(unmapped)
+                         )
+        pair_masks = None
+        if 'pair_file' in options:
+            pair_masks = dict(((chain_id_a, chain_id_b),
+                               load_pair_mask(options['pair_file'],
+                                              *load_maps(options['maps'].get(chain_id_a),
+                                                         options['maps'].get(chain_id_b)
+                                                         )
+                                              ))
+                              for (chain_id_a, chain_id_b) in chain_pairs
+                              )
+        pair_dists = get_pair_distances(struct, chain_pairs, options['dist_atoms'],
+                                        options.get('cutoff'), options['min_sep'],
+                                        pair_masks
+                                        )
+        dists_dfs = list()
+        for ((chain_id_a, chain_id_b), dists_df) in pair_dists:
+            if 'out_prefix' not in options and 'min_dists' not in options:
+                dists_df.insert(0, 'Left_Chain', chain_id_a)
+                dists_df.insert(1, 'Right_Chain', chain_id_b)
+            lmap, rmap = load_maps(options['maps'].get(chain_id_a),
+                                   options['maps'].get(chain_id_b)
+                                   )
+            dists_df = map_and_index(dists_df, lmap, rmap)
+            if 'out_prefix' in options:
+                write_dists(dists_df, '%s.%s_%s.tsv' % (options['out_prefix'],
+                                                        chain_id_a, chain_id_b
+                                                        )
+                            )
+            if 'out_prefix' not in options or 'min_dists' in options:
+                dists_dfs += [dists_df]
+
+        if 'min_dists' in options:
+            write_dists(tab_aux.get_min_dists(*dists_dfs), sys.stdout)
+        elif 'out_prefix' not in options:
+            write_dists(pd.concat(dists_dfs), sys.stdout)
+    elif 'npy' in options:
+        struct = pdb_aux.load_pdb_compact(options['pdb_file'],
+                                          fast_pdb = 'fast_pdb' in options,
+                                          use_cache = 'no_cache' not in options
+                                          )
+        if 'chainR' in options:
+            chain_b = struct.get_chain(options['chainR'])
+        else:
+            chain_b = None
+
+        pair_resns = None
+        if 'pair_file' in options:
+            pair_resns = load_pair_mask(options['pair_file'],
+                                        *load_maps(options.get('mapL'), options.get('mapR'))
+                                        )
+        res_a, res_b, dist_mats = get_distance_matrices(struct.get_chain(options['chainL']),
+                                                        chain_b, options['dist_atoms'],
+                                                        options.get('cutoff'),
+                                                        options['min_sep'], pair_resns
+                                                        )
+        write_dist_matrices(options['npy'], res_a, res_b, dist_mats,
+                            options['dist_atoms'],
+                            options.get('mapL'), options.get('mapR')
+                            )
+    else:
+        write_chain_pair_dists(options['pdb_file'],
+                               options['chainL'], options.get('chainR'),
+                               options.get('mapL'), options.get('mapR'),
+                               options, sys.stdout
+                               )
@@ -8,13 +8,25 @@
     alignment may cover discontinuous domains starting in an arbitrary
     position in the reference sequence.
 
+    Can map many chains in one process (--batch). Jobs are read from a tab
+    delimited manifest with columns:
+
+        chain_id  pdb_file  aln_file  [refid]  [out_file]
+
+    Empty fields or '-' leave an option unset. Each pdb file and alignment is
+    parsed once, and chains with identical sequences (eg. chains C and D in
+    3DGE) are aligned once per alignment, up to --jobs alignments at a time.
+    One mapping file is written per row. Failures are reported per row.
+
 '''
 
+import os
 import sys
 import getopt
 
 from Bio import SeqRecord, Align, AlignIO
 
+import coevo.cache as cache
 import coevo.pdb_aux as pdb_aux
 import coevo.aln_aux as aln_aux
 import coevo.aln_aux.wrappers as aln_wraps
@@ -33,25 +45,54 @@ def parse_cmd_line(args):
 
     '''
 
-    optlist, args = getopt.getopt(args, 'hr:i',
+    optlist, args = getopt.getopt(args, 'hr:ij:',
                                   ['help',
                                    'refid=',
                                    'int_aln',
-                                   'user_aln'
+                                   'user_aln',
+                                   'fast_pdb',
+                                   'no_cache',
+                                   'batch=',
+                                   'out_dir=',
+                                   'jobs=',
+                                   'aln_timeout=',
+                                   'aln_stdin'
                                    ]
                                   )
     options = dict()
     usage = (
-             'usage: %s [ options ] chain_id pdb_file aln.fa\n\n'
+             'usage: %s [ options ] chain_id pdb_file aln.fa\n'
+             '       %s [ options ] --batch manifest\n\n'
              'Options:\n'
              '-h, --help           print this help and exit\n'
              '-r, --refid REFID    map using given reference seq id in alignment\n'
-             '-i, --int_aln        use internal global aligner\n'
-             '                     (ignored if -r|--refid is not specified)\n'
+             '-i, --int_aln        use internal global aligner (pairwise, or to the\n'
+             '                     alignment profile without -r|--refid). Runs\n'
+             '                     in-process: no temporary files or subprocesses\n'
              '--user_aln           use user defined aligners\n'
-             '                     See: PROFILE_ALIGNER_CMD and PAIR_ALIGNER_CMD\n\n'
-
-             ) % sys.argv[0]
+             '                     See: PROFILE_ALIGNER_CMD and PAIR_ALIGNER_CMD\n'
+             '--fast_pdb           read ATOM records directly instead of using\n'
+             '                     Bio.PDB.PDBParser\n'
+             '--no_cache           do not reuse or save parsed structures,\n'
+             '                     alignments, and maps\n'
+             '                     See: coevo.cache (COEVO_CACHE_DIR and\n'
+             '                     COEVO_CACHE_MAX_BYTES set its location and size)\n'
+             '--batch MANIFEST     map the jobs listed in MANIFEST instead of a\n'
+             '                     single chain\n'
+             '--out_dir DIR        with --batch, directory for mapping files\n'
+             '                     without an out_file (default: .), named\n'
+             '                     ALN-PDB-CHAIN[-REFID].tsv\n'
+             '-j, --jobs N         with --batch, run up to N aligners at once\n'
+             '                     (default: 1)\n'
+             '--aln_timeout SEC    with --user_aln, kill aligners running longer\n'
+             '                     than SEC seconds\n'
+             '--aln_stdin          with --user_aln, feed the chain sequence to the\n'
+             '                     aligner on stdin (first %%s is /dev/stdin)\n'
+             '                     instead of writing a temporary file\n\n'
+
+             ) % (sys.argv[0], sys.argv[0])
+    options['out_dir'] = '.'
+    options['n_jobs'] = 1
 
     # Read command line
     for opt, val in optlist:
@@ -63,6 +104,23 @@ def parse_cmd_line(args):
             options['user_aln'] = True
         if opt in ('-i', '--int_aln'):
             options['int_aln'] = True
+        if opt == '--fast_pdb':
+            options['fast_pdb'] = True
+        if opt == '--no_cache':
+            options['no_cache'] = True
+        if opt == '--batch':
+            options['batch'] = val
+        if opt == '--out_dir':
+            options['out_dir'] = val
+        if opt in ('-j', '--jobs'):
+            options['n_jobs'] = int(val)
+        if opt == '--aln_timeout':
+            options['aln_timeout'] = float(val)
+        if opt == '--aln_stdin':
+            options['aln_stdin'] = True
+
+    if 'batch' in options:
+        return options
 
     if len(args) != 3:
         print >>sys.stderr, 'wrong number of arguments'
@@ -112,18 +170,7 @@ def col_to_resn(aln, chain_seqr, aln_ref, chain_ref_id):
 
     # 1. map aln column to aln_ref columns
     aln_len = aln.get_alignment_length()
-    aln_ref_len = aln_ref.get_alignment_length()
-    js = 0  # first column in aln_ref to start checking
-    i_j = list()
-    for i in xrange(aln_len):
-        if str(set(aln[:, i])) != '-':
-            # all-gap columns in original alignment result in ambiguous mapping
-            # so we skip them
-            for j in xrange(js, aln_ref_len):
-                if aln_ref[:, j] == aln[:, i]:
-                    i_j += [(i, j)]
-                    js = j + 1
-                    break
+    i_j = aln_aux.map_columns(aln, aln_ref)
 
     if len(i_j) != aln_len:
         print >>sys.stderr, 'Warning: some original alignment columns were skipped while mapping!'
@@ -140,50 +187,354 @@ def col_to_resn(aln, chain_seqr, aln_ref, chain_ref_id):
 
     return col_resn_aa
 
+def choose_aligner(options, refid = None):
+    ''' Choose an aligner function from options
 
-if __name__ == "__main__":
-    options = parse_cmd_line(sys.argv[1:])
-    aln = AlignIO.read(options['aln.fa'], format = "fasta")
-    structure = pdb_aux.open_pdb(options['pdb_file'])
-    model = structure[0]
-    chain = model[options['chain_id']]
-    chain_seqr = pdb_aux.Chain_to_SeqRecord(chain)
+        options: dict from parse_cmd_line()
+        refid: if not None, choose a pairwise aligner instead of a profile aligner
+
+        Returns an aligner function, or None for the internal aligner
+
+    '''
+
+    if 'user_aln' in options:
+        ex_aln_cmd = PAIR_ALIGNER_CMD if refid is not None else PROFILE_ALIGNER_CMD
+        return aln_wraps.make_external_aligner(ex_aln_cmd,
+                                               timeout = options.get('aln_timeout'),
+                                               use_stdin = 'aln_stdin' in options
+                                               )
+    if 'int_aln' in options:
+        return None
+    if refid is not None:
+        return aln_wraps.needle_align
+
+    return aln_wraps.muscle_profile_align
+
+def align_chain(chain_seqr_m, aln, aln_fn, options, refid = None):
+    ''' Align a chain sequence to an alignment or to a sequence in it
+
+        chain_seqr_m: chain SeqRecord with a mangled id (see mangle_id())
+        aln: alignment read from aln_fn (not used with refid)
+        aln_fn: alignment filename, for external profile aligners
+        options: dict from parse_cmd_line(), selects the aligner and caching
+        refid: if not None, pairwise align to this sequence in aln_fn. Only
+               this sequence is read, through an index of aln_fn (see
+               coevo.aln_aux.IndexedFasta)
+
+        Returns a tuple (aln_ref, aln_to_map) for col_to_resn(): aln_ref is
+        the aligned result and aln_to_map holds the rows of aln it contains
+
+    '''
+
+    ex_aligner = choose_aligner(options, refid)
+    use_cache = 'no_cache' not in options
+    if refid is not None:
+        # align chain to reference in alignment
+        aln_fa = aln_aux.IndexedFasta(aln_fn)
+        if refid not in aln_fa:
+            aln_fa.close()
+            raise ValueError("refid <%s> not in reference alignment %s" % (refid, aln_fn))
+        ref_seqr = aln_fa[refid]
+        aln_fa.close()
+        aln_ref = aln_wraps.pair_align_SeqRecords(chain_seqr_m, ref_seqr, ex_aligner,
+                                                  use_cache = use_cache
+                                                  )
+
+        return aln_ref, Align.MultipleSeqAlignment([ref_seqr])
+
+    # align chain to alignment
+    aln_ref = aln_wraps.profile_align_SeqRecord_to_fa(chain_seqr_m, aln_fn, ex_aligner,
+                                                      use_cache = use_cache, aln = aln
+                                                      )
+
+    return aln_ref, aln
+
+def map_cache_key(chain_seqr, options, refid, aln_hash):
+    ''' Returns the cache key of a column-to-resnum map
+
+        chain_seqr: chain sequence annotated with resnums
+        options, refid: see align_chain()
+        aln_hash: hash of the alignment file (see coevo.cache.hash_file())
+
+    '''
+
+    return cache.make_key('col_to_resn', aln_wraps.CACHE_VERSION,
+                          aln_wraps.aligner_id(choose_aligner(options, refid)), refid,
+                          str(chain_seqr.seq), chain_seqr.letter_annotations['resnum'],
+                          aln_hash
+                          )
+
+def read_map(map_fn):
+    ''' Read a column-to-resnum map written by write_map()
+
+        Raises ValueError if the file is empty or a row is malformed.
+
+        Returns col_resn_aa: list of (column number, resnum, amino acid) tuples
+
+    '''
+
+    with open(map_fn) as map_fh:
+        if not map_fh.readline():
+            raise ValueError('no header')
+        return [(int(col), int(resn), aa)
+                for (col, resn, aa) in (line.rstrip('\n').split('\t') for line in map_fh)
+                ]
+
+def read_cached_map(key):
+    ''' Returns the column-to-resnum map cached under key, or None
+
+        Unreadable cache files count as not cached (see coevo.cache.cache_load()).
+
+    '''
+
+    return cache.cache_load(key, '.tsv', read_map)
+
+def cached_map(chain_seqr, aln_fn, options, refid, map_func):
+    ''' Returns a cached column-to-resnum map, or computes and caches it
+
+        chain_seqr: chain sequence annotated with resnums
+        aln_fn, options, refid: see align_chain()
+        map_func: function with no arguments that returns col_resn_aa like
+                  col_to_resn()
+
+        Maps are keyed by the chain sequence and resnums, a hash of aln_fn,
+        refid, and the aligner (see coevo.cache). Cache hits skip reading the
+        alignment and aligning. Not used with --no_cache.
+
+        Returns col_resn_aa: list of (column number, resnum, amino acid) tuples
+
+    '''
+
+    if 'no_cache' in options:
+        return map_func()
+
+    key = map_cache_key(chain_seqr, options, refid, cache.hash_file(aln_fn))
+    col_resn_aa = read_cached_map(key)
+    if col_resn_aa is None:
+        col_resn_aa = map_func()
+        cache.cache_store(key, '.tsv', lambda fh: write_map(col_resn_aa, fh))
+
+    return col_resn_aa
+
+def map_chain(chain_seqr, aln, aln_fn, options, refid = None):
+    ''' Map alignment columns to resnums in a chain
+
+        chain_seqr: chain sequence annotated with resnums
+        aln: alignment read from aln_fn, or None to read it here (if needed)
+        aln_fn, options, refid: see align_chain()
+
+        Returns col_resn_aa: list of (column number, resnum, amino acid) tuples
+
+    '''
+
+    if aln is None and refid is None:
+        aln = AlignIO.read(aln_fn, format = "fasta")
     chain_seqr_m = SeqRecord.SeqRecord(chain_seqr.seq,
                                        id = mangle_id(chain_seqr.id),
                                        name = '', description = ''
                                        )
+    aln_ref, aln_to_map = align_chain(chain_seqr_m, aln, aln_fn, options, refid)
 
-    if 'refid' in options:
-        # align chain to reference in alignment
-        aln_l = [ seqr for seqr in aln if seqr.id == options['refid'] ]
-        if len(aln_l) < 1:
-            print >>sys.stderr, "refid <%s> not in reference alignment %s" % \
-                                (options['refid'], options['aln.fa'])
-            sys.exit(1)
-        ref_seqr = aln_l[0]
-        if 'user_aln' in options:
-            ex_aligner = aln_wraps.make_external_aligner(PAIR_ALIGNER_CMD)
-        elif 'int_aln' in options:
-            ex_aligner = None
-        else:
-            ex_aligner = aln_wraps.needle_align
-        aln_ref = aln_wraps.pair_align_SeqRecords(chain_seqr_m, ref_seqr, ex_aligner)
-        col_resn_aa = col_to_resn(Align.MultipleSeqAlignment([ref_seqr]),
-                                  chain_seqr, aln_ref, chain_seqr_m.id
-                                  )
-    else:
-        # align chain to alignment
-        if 'user_aln' in options:
-            ex_aligner = aln_wraps.make_external_aligner(PROFILE_ALIGNER_CMD)
-        else:
-            ex_aligner = aln_wraps.muscle_profile_align
-        aln_ref = aln_wraps.profile_align_SeqRecord_to_fa(chain_seqr_m,
-                                                    options['aln.fa'],
-                                                    ex_aligner
-                                                    )
-        col_resn_aa = col_to_resn(aln, chain_seqr, aln_ref, chain_seqr_m.id)
-
-    print '\t'.join(['Column', 'resn', 'AA'])
+    return col_to_resn(aln_to_map, chain_seqr, aln_ref, chain_seqr_m.id)
+
+def write_map(col_resn_aa, out_fh):
+    ''' Write column-to-resnum map as tab delimited
+
+    '''
+
+    print >>out_fh, '\t'.join(['Column', 'resn', 'AA'])
     for c_r_a in col_resn_aa:
-        print '\t'.join(map(str, c_r_a))
+        print >>out_fh, '\t'.join(map(str, c_r_a))
+
+def read_manifest(manifest_fn, out_dir):
+    ''' Read batch jobs from a tab delimited manifest
+
+        manifest_fn: filename of manifest with rows of
+                     chain_id, pdb_file, aln_file [, refid [, out_file]]
+        out_dir: directory for output files without an out_file
+
+        Skips blank lines, lines starting with '#' and a header row starting
+        with 'chain_id'. Empty fields or '-' are set to None. The default
+        out_file is <out_dir>/<alignment name>-<pdb name>-<chain_id>[-<refid>].tsv
+        (eg. RR-3DGE-C.tsv for RR.fa and 3DGE.pdb).
+
+        Rows without a pdb_file or aln_file, or writing to the same out_file
+        as an earlier row, get an 'error' (a ValueError) in their job dict,
+        to be reported as failed rows.
+
+        Returns a list of (line number, job dict)
+
+    '''
+
+    fields = ('chain_id', 'pdb_file', 'aln_file', 'refid', 'out_file')
+    jobs = list()
+    out_lines = dict()  # normalized out_file -> line number
+    for (line_num, line) in enumerate(open(manifest_fn), 1):
+        vals = line.rstrip('\r\n').split('\t')
+        if vals[0] in ('', 'chain_id') or vals[0].startswith('#'):
+            continue
+        vals = [val.strip() for val in vals]
+        vals = [val if val not in ('', '-') else None for val in vals]
+        job = dict(zip(fields, vals + [None] * (len(fields) - len(vals))))
+        jobs += [(line_num, job)]
+
+        missing = [field for field in ('pdb_file', 'aln_file') if job[field] is None]
+        if missing:
+            job['error'] = ValueError('missing %s' % ', '.join(missing))
+            continue
+        if job['out_file'] is None:
+            names = [os.path.basename(job['aln_file']).split('.')[0],
+                     os.path.basename(job['pdb_file']).split('.')[0],
+                     job['chain_id']
+                     ]
+            if job['refid'] is not None:
+                names += [job['refid'].replace(os.sep, '_')]
+            job['out_file'] = os.path.join(out_dir, '-'.join(names) + '.tsv')
+        out_key = os.path.normpath(os.path.abspath(job['out_file']))
+        if out_key in out_lines:
+            job['error'] = ValueError('out_file "%s" is also written by manifest line %d'
+                                      % (job['out_file'], out_lines[out_key])
+                                      )
+            continue
+        out_lines[out_key] = line_num
+
+    return jobs
+
+def report_failure(line_num, job, err):
+    ''' Report a failed batch job to stderr
+
+    '''
+
+    print >>sys.stderr, 'Failed manifest line %d (%s %s): %s: %s' % (
+                            line_num, job['pdb_file'], job['chain_id'],
+                            type(err).__name__, err)
+
+def run_batch(jobs, options):
+    ''' Map batch jobs in this process, parsing and aligning as little as possible
+
+        jobs: list from read_manifest()
+        options: dict from parse_cmd_line()
+
+        Each pdb file and alignment is parsed once (alignments only for jobs
+        without a refid). Alignments are keyed by chain sequence, so
+        identical chains are aligned once per alignment (and refid). Each
+        chain still gets its own resnums. Maps found in the on-disk cache
+        (see map_cache_key()) skip parsing the alignment and aligning.
+
+        Jobs are read first, then the distinct chains are aligned
+        options['n_jobs'] at a time (see coevo.aln_aux.map_concurrent()),
+        then the maps are written.
+
+        Reports failed rows and a summary to stderr.
+
+        Returns the number of failed jobs
+
+    '''
+
+    structures = dict()  # pdb_file -> CompactStructure
+    alns = dict()  # aln_file -> alignment
+    aln_hashes = dict()  # aln_file -> hash of its contents
+    aln_keys = list()  # (chain sequence, aln_file, refid) to align, in order
+    to_align = dict()  # (chain sequence, aln_file, refid) -> mangled chain SeqRecord
+    pending = list()  # (line_num, job, chain_seqr, map cache key, aln key)
+    n_failed = 0
+    for (line_num, job) in jobs:
+        try:
+            if 'error' in job:
+                raise job['error']
+            if job['pdb_file'] not in structures:
+                structures[job['pdb_file']] = pdb_aux.load_pdb_compact(job['pdb_file'],
+                                                  fast_pdb = 'fast_pdb' in options,
+                                                  use_cache = 'no_cache' not in options
+                                                  )
+            chain = structures[job['pdb_file']].get_chain(job['chain_id'])
+            chain_seqr = pdb_aux.Chain_to_SeqRecord(chain)
+
+            map_key = None
+            if 'no_cache' not in options:
+                if job['aln_file'] not in aln_hashes:
+                    aln_hashes[job['aln_file']] = cache.hash_file(job['aln_file'])
+                map_key = map_cache_key(chain_seqr, options, job['refid'],
+                                        aln_hashes[job['aln_file']]
+                                        )
+                col_resn_aa = read_cached_map(map_key)
+                if col_resn_aa is not None:
+                    with open(job['out_file'], 'w') as out_fh:
+                        write_map(col_resn_aa, out_fh)
+                    continue
+
+            if job['refid'] is None and job['aln_file'] not in alns:
+                alns[job['aln_file']] = AlignIO.read(job['aln_file'], format = "fasta")
+            aln_key = (str(chain_seqr.seq), job['aln_file'], job['refid'])
+            if aln_key not in to_align:
+                aln_keys += [aln_key]
+                to_align[aln_key] = SeqRecord.SeqRecord(chain_seqr.seq,
+                                                        id = mangle_id(chain_seqr.id),
+                                                        name = '', description = ''
+                                                        )
+            pending += [(line_num, job, chain_seqr, map_key, aln_key)]
+        except Exception as err:
+            n_failed += 1
+            report_failure(line_num, job, err)
+
+    results = aln_aux.map_concurrent(align_chain,
+                                     [(to_align[aln_key], alns.get(aln_key[1]), aln_key[1],
+                                       options, aln_key[2])
+                                      for aln_key in aln_keys
+                                      ],
+                                     options['n_jobs']
+                                     )
+    aligned = dict(zip(aln_keys, results))
+
+    for (line_num, job, chain_seqr, map_key, aln_key) in pending:
+        try:
+            if isinstance(aligned[aln_key], Exception):
+                raise aligned[aln_key]
+            (aln_ref, aln_to_map) = aligned[aln_key]
+            col_resn_aa = col_to_resn(aln_to_map, chain_seqr, aln_ref, to_align[aln_key].id)
+            if map_key is not None:
+                cache.cache_store(map_key, '.tsv', lambda fh: write_map(col_resn_aa, fh))
+            with open(job['out_file'], 'w') as out_fh:
+                write_map(col_resn_aa, out_fh)
+        except Exception as err:
+            n_failed += 1
+            report_failure(line_num, job, err)
+
+    print >>sys.stderr, (
+                         'Batch summary: %d jobs, %d succeeded, %d failed\n'
+                         '  %d pdb files, %d alignments, %d chain alignments'
+                         ) % (len(jobs), len(jobs) - n_failed, n_failed,
+                              len(structures), len(alns), len(aligned)
+                              )
+
+    return n_failed
+
+
+if __name__ == "__main__":
+    options = parse_cmd_line(sys.argv[1:])
+    if 'batch' in options:
+        jobs = read_manifest(options['batch'], options['out_dir'])
+        if run_batch(jobs, options) > 0:
+            sys.exit(1)
+        sys.exit(0)
+
+    structure = pdb_aux.load_pdb_compact(options['pdb_file'],
+                                         fast_pdb = 'fast_pdb' in options,
+                                         use_cache = 'no_cache' not in options,
+                                         chain_ids = [options['chain_id']]
+                                         )
+    chain = structure.get_chain(options['chain_id'])
+    chain_seqr = pdb_aux.Chain_to_SeqRecord(chain)
 
+    try:
+        col_resn_aa = cached_map(chain_seqr, options['aln.fa'], options,
+                                 options.get('refid'),
+                                 lambda: map_chain(chain_seqr, None, options['aln.fa'],
+                                                   options, options.get('refid')
+                                                   )
+                                 )
+    except (ValueError, RuntimeError) as err:
+        print >>sys.stderr, err
+        sys.exit(1)
+
+    write_map(col_resn_aa, sys.stdout)
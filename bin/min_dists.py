@@ -6,6 +6,8 @@
 
     Eg. chain A in 3DGE makes contacts with a pair of identical chains C and D
 
+    Takes any number of distance tables, eg. for homo-oligomers
+
 '''
 
 import sys
@@ -23,13 +25,12 @@ def load_dists(fn):
 
 if __name__ == '__main__':
     if len(sys.argv) < 3:
-        print >>sys.stderr, 'usage: %s dists1 dists2 > mindists' % sys.argv[0]
+        print >>sys.stderr, 'usage: %s dists1 dists2 [dists3 ...] > mindists' % sys.argv[0]
         sys.exit(1)
 
-    df1 = load_dists(sys.argv[1])
-    df2 = load_dists(sys.argv[2])
+    dfs = [load_dists(fn) for fn in sys.argv[1:]]
 
-    dfmin = tab_aux.get_min_dists(df1, df2)
+    dfmin = tab_aux.get_min_dists(*dfs)
     dfmin.to_csv(sys.stdout, header = True, index = True,
                  sep = '\t', float_format = '%.6f'
                  )
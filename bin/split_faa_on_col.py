@@ -4,24 +4,32 @@
         col: 1,2,3,...,N,N+1,...,K
               <--Left--| |--Right-->
 
+    Splits at several columns if given as a comma separated list, eg.
+    N1,N2 writes three fastas (columns 1-N1, N1+1-N2, N2+1-K).
+
+    - Streams: reads one record at a time and writes all outputs in one pass
+
 '''
 
 import sys
-from Bio import AlignIO
+
+from coevo.aln_aux.formatting import split_fasta_columns
 
 if __name__ == '__main__':
-    if len(sys.argv) != 5:
+    if len(sys.argv) < 5 or len(sys.argv) != sys.argv[2].count(',') + 5:
         print >>sys.stderr, 'usage: %s aln.fa nth_col left.fa right.fa' % sys.argv[0]
+        print >>sys.stderr, '       %s aln.fa nth_col1,nth_col2,... out1.fa out2.fa ...' % sys.argv[0]
         sys.exit(1)
 
-    aln = AlignIO.read(sys.argv[1], format = "fasta")
-    nth_col = int(sys.argv[2])
-    left_fn = sys.argv[3]
-    right_fn = sys.argv[4]
-
-    left_aln = aln[:,:nth_col]
-    right_aln = aln[:,nth_col:]
-
-    print >>open(left_fn, 'w'), left_aln.format('fasta'),
-    print >>open(right_fn, 'w'), right_aln.format('fasta'),
+    cols = [int(col) for col in sys.argv[2].split(',')]
+    out_fhs = [open(out_fn, 'w') for out_fn in sys.argv[3:]]
 
+    try:
+        with open(sys.argv[1]) as fh:
+            split_fasta_columns(fh, cols, out_fhs)
+    except ValueError as err:
+        print >>sys.stderr, err
+        sys.exit(1)
+    finally:
+        for out_fh in out_fhs:
+            out_fh.close()
@@ -1 +1,11 @@
 from .aux import pop_row, make_tmp_fa, ungap_SeqRecord, annotate_positions
+from .aux import encode_alignment, get_ids, map_columns
+from .compact import CompactAlignment, MultipleSeqAlignment_to_CompactAlignment
+from .compact import CompactAlignment_to_MultipleSeqAlignment
+from .aligner import global_align, align_SeqRecords, profile_align_SeqRecord
+from .runner import run_aligner_cmd, map_concurrent
+from .faidx import IndexedFasta, build_fasta_index, load_fasta_index
+from .mi import encode_columns, column_entropies, joint_entropies, score_alignments
+from .reweight import identity_counts, sequence_weights
+from .collapse import collapse_duplicates, collapse_fasta, read_id_map
+from .collapse import count_representatives, expand_values
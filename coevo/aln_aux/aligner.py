@@ -0,0 +1,297 @@
+#!/usr/bin/env python
+''' aligner.py -- in-process global aligner for sequences and profiles
+
+    Needleman-Wunsch with affine gaps (Gotoh), vectorized over the columns of
+    each row of the dynamic programming matrix. A gap of length n scores
+    -(gapopen + (n - 1) * gapextend), like needle and Bio.pairwise2.
+
+    Aligns a sequence to another sequence, or a sequence to a profile built
+    from an alignment (like muscle -profile, but the alignment's columns are
+    kept as they are). Nothing is written to disk and no subprocess is run.
+
+'''
+
+import numpy as np
+from Bio import Align
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from Bio.SubsMat import MatrixInfo
+
+from .aux import encode_alignment, ungap_SeqRecord
+
+__author__ = 'Aram Avila-Herrera'
+
+def make_score_matrix(matrix_info = MatrixInfo.blosum62):
+    ''' Builds a substitution score matrix indexed by encoded letters
+
+        matrix_info: dict from letter pairs to scores, with one of (a, b) and
+                     (b, a) present, like Bio.SubsMat.MatrixInfo matrices
+
+        Letters missing from matrix_info score like 'X' (or 0 without 'X').
+        Lowercase letters score like uppercase.
+
+        Returns a tuple (letter_idx, scores):
+            letter_idx: numpy.ndarray mapping each byte to a row of scores
+            scores: numpy.ndarray of float64 with shape (n_letters, n_letters)
+
+    '''
+
+    letters = sorted(set(a for (a, b) in matrix_info) | set(b for (a, b) in matrix_info))
+    scores = np.zeros((len(letters) + 1, len(letters) + 1))  # last row: unknown
+    for ((a, b), score) in matrix_info.iteritems():
+        scores[letters.index(a), letters.index(b)] = score
+        scores[letters.index(b), letters.index(a)] = score
+
+    letter_idx = np.full(256, len(letters), dtype = np.intp)
+    for (i, letter) in enumerate(letters):
+        letter_idx[ord(letter)] = i
+        letter_idx[ord(letter.lower())] = i
+    if 'X' in letters:
+        scores[-1] = scores[letters.index('X')]
+        scores[:, -1] = scores[:, letters.index('X')]
+
+    return letter_idx, scores
+
+BLOSUM62 = make_score_matrix(MatrixInfo.blosum62)
+
+def encode_seq(seq, letter_idx):
+    ''' Returns a numpy.ndarray of score matrix rows for letters in seq
+
+    '''
+
+    return letter_idx[np.frombuffer(str(seq), dtype = np.uint8)]
+
+def align_scores(pair_scores, gapopen = 10.0, gapextend = 0.5,
+                 penalize_end_gaps = True):
+    ''' Global alignment from a matrix of position-position scores
+
+        pair_scores: numpy.ndarray with shape (n, m), score of aligning
+                     position i of the first sequence to position j of the
+                     second (a sequence or profile columns)
+        gapopen, gapextend: gap penalties (positive)
+        penalize_end_gaps: if False, leading and trailing gaps are free
+
+        Requires gapopen >= gapextend, so a gap is never closed and reopened
+        next to itself.
+
+        Returns a tuple (idx_a, idx_b, score): idx_a and idx_b are
+        numpy.ndarrays over alignment columns with the aligned positions in
+        each sequence, -1 for gaps
+
+    '''
+
+    n, m = pair_scores.shape
+    if gapopen < gapextend:
+        raise ValueError('gapopen must be at least gapextend')
+
+    if n == 0 or m == 0:
+        # one end gap over the other sequence
+        gap_len = n + m
+        score = 0.0
+        if gap_len > 0 and penalize_end_gaps:
+            score = -(gapopen + (gap_len - 1) * gapextend)
+        return (np.where(np.arange(gap_len) < n, np.arange(gap_len), -1),
+                np.where(np.arange(gap_len) < m, np.arange(gap_len), -1),
+                score
+                )
+
+    # gap costs by column (gaps in the second sequence, E moves down a column)
+    # and by row (gaps in the first sequence, F moves along a row)
+    col_open = np.full(m + 1, gapopen)
+    col_ext = np.full(m + 1, gapextend)
+    row_open = np.full(n + 1, gapopen)
+    row_ext = np.full(n + 1, gapextend)
+    if not penalize_end_gaps:
+        col_open[[0, m]] = col_ext[[0, m]] = 0.0
+        row_open[[0, n]] = row_ext[[0, n]] = 0.0
+
+    cols = np.arange(m + 1)
+    h_from = np.zeros((n + 1, m + 1), dtype = np.int8)  # 0: diagonal, 1: E, 2: F
+    e_extends = np.zeros((n + 1, m + 1), dtype = bool)
+    f_start = np.zeros((n + 1, m + 1), dtype = np.intp)
+
+    # first row: a gap in the first sequence
+    h_prev = np.zeros(m + 1)
+    h_prev[1:] = -(row_open[0] + (cols[1:] - 1) * row_ext[0])
+    h_from[0, 1:] = 2
+    e_prev = np.full(m + 1, -np.inf)
+
+    for i in xrange(1, n + 1):
+        # E: gap in the second sequence, coming down from row i - 1
+        e_open = h_prev - col_open
+        e_ext = e_prev - col_ext
+        e_extends[i] = e_ext > e_open
+        e_cur = np.maximum(e_open, e_ext)
+
+        h_cur = np.empty(m + 1)
+        h_cur[0] = e_cur[0]
+        h_from[i, 0] = 1
+        diag = h_prev[:-1] + pair_scores[i - 1]
+        h_cur[1:] = np.maximum(diag, e_cur[1:])
+        h_from[i, 1:] = np.where(e_cur[1:] > diag, 1, 0)
+
+        # F: gap in the first sequence, from the best start k < j in row i
+        #    F[j] = max_k (H[k] + k * ext) - open - (j - 1) * ext
+        starts = h_cur + cols * row_ext[i]
+        best = np.maximum.accumulate(starts)
+        best_k = np.maximum.accumulate(np.where(starts == best, cols, 0))
+        f_cur = best[:-1] - row_open[i] - cols[:-1] * row_ext[i]
+        use_f = f_cur > h_cur[1:]
+        h_cur[1:] = np.where(use_f, f_cur, h_cur[1:])
+        h_from[i, 1:][use_f] = 2
+        f_start[i, 1:] = best_k[:-1]
+
+        h_prev = h_cur
+        e_prev = e_cur
+
+    # trace back from the last cell
+    idx_a = list()
+    idx_b = list()
+    i, j = n, m
+    state = 0
+    while i > 0 or j > 0:
+        if state == 0:
+            state = h_from[i, j]
+            if state == 0:
+                i -= 1
+                j -= 1
+                idx_a += [i]
+                idx_b += [j]
+        elif state == 1:
+            state = 1 if e_extends[i, j] else 0
+            i -= 1
+            idx_a += [i]
+            idx_b += [-1]
+        else:
+            k = f_start[i, j]
+            idx_a += [-1] * (j - k)
+            idx_b += range(j - 1, k - 1, -1)
+            j = k
+            state = 0
+
+    return (np.array(idx_a[::-1], dtype = np.intp),
+            np.array(idx_b[::-1], dtype = np.intp),
+            h_prev[m]
+            )
+
+def gapped(seq, idx):
+    ''' Returns seq with gaps where idx is -1 (see align_scores())
+
+    '''
+
+    letters = np.frombuffer(str(seq), dtype = np.uint8)
+    if len(letters) == 0:
+        return '-' * len(idx)
+
+    return np.where(idx >= 0, letters[idx], ord('-')).astype(np.uint8).tostring()
+
+def global_align(seq_a, seq_b, gapopen = 10.0, gapextend = 0.5,
+                 penalize_end_gaps = True, score_matrix = BLOSUM62):
+    ''' Globally align two ungapped sequences
+
+        seq_a, seq_b: sequences as str (or Bio.Seq.Seq)
+        gapopen, gapextend, penalize_end_gaps: see align_scores()
+        score_matrix: tuple from make_score_matrix() [default = BLOSUM62]
+
+        Defaults match the internal aligner of pair_align_SeqRecords()
+        (Bio.pairwise2.align.globalds() with BLOSUM62, -10.0, -0.5).
+
+        Returns a tuple (aligned_a, aligned_b, score)
+
+    '''
+
+    letter_idx, scores = score_matrix
+    pair_scores = scores[encode_seq(seq_a, letter_idx)][:, encode_seq(seq_b, letter_idx)]
+    idx_a, idx_b, score = align_scores(pair_scores, gapopen, gapextend,
+                                       penalize_end_gaps
+                                       )
+
+    return gapped(seq_a, idx_a), gapped(seq_b, idx_b), score
+
+def make_profile_scores(seq, aln_mat, score_matrix = BLOSUM62):
+    ''' Scores each position of a sequence against each column of an alignment
+
+        seq: ungapped sequence as str
+        aln_mat: encoded alignment (see coevo.aln_aux.encode_alignment())
+        score_matrix: tuple from make_score_matrix()
+
+        A column's score is the mean substitution score over its sequences,
+        with gaps scoring 0.
+
+        Returns a numpy.ndarray with shape (len(seq), n_columns)
+
+    '''
+
+    letter_idx, scores = score_matrix
+    n_letters = len(scores)
+    n_seqs, n_cols = aln_mat.shape
+
+    # letter counts per column, gaps excluded
+    aln_idx = letter_idx[aln_mat]
+    not_gap = (aln_mat != ord('-')) & (aln_mat != ord('.'))
+    col_idx = np.broadcast_to(np.arange(n_cols), aln_mat.shape)
+    counts = np.bincount((col_idx * n_letters + aln_idx)[not_gap],
+                         minlength = n_cols * n_letters
+                         ).reshape(n_cols, n_letters)
+    freqs = counts / float(max(n_seqs, 1))
+
+    return scores[encode_seq(seq, letter_idx)].dot(freqs.T)
+
+def align_SeqRecords(seqr_a, seqr_b, gapopen = 10.0, gapextend = 0.5,
+                     penalize_end_gaps = True, score_matrix = BLOSUM62):
+    ''' Globally align two SeqRecords with global_align()
+
+        Gaps in the input sequences are removed first.
+
+        Returns a MultipleSeqAlignment object with rows seqr_a, seqr_b
+
+    '''
+
+    seqr_a = ungap_SeqRecord(seqr_a)
+    seqr_b = ungap_SeqRecord(seqr_b)
+    aligned_a, aligned_b, score = global_align(str(seqr_a.seq), str(seqr_b.seq),
+                                               gapopen, gapextend,
+                                               penalize_end_gaps, score_matrix
+                                               )
+
+    return Align.MultipleSeqAlignment([
+               SeqRecord(Seq(aligned_a), id = seqr_a.id, name = seqr_a.name,
+                         description = seqr_a.description),
+               SeqRecord(Seq(aligned_b), id = seqr_b.id, name = seqr_b.name,
+                         description = seqr_b.description)
+               ])
+
+def profile_align_SeqRecord(seqr, aln, gapopen = 10.0, gapextend = 0.5,
+                            penalize_end_gaps = True, score_matrix = BLOSUM62):
+    ''' Align a SeqRecord to an alignment, keeping the alignment's columns
+
+        seqr: SeqRecord to align (gaps are removed first)
+        aln: a Bio.Align.MultipleSeqAlignment object
+        gapopen, gapextend, penalize_end_gaps: see align_scores()
+        score_matrix: see make_profile_scores()
+
+        Alignment columns are never split or merged. Residues of seqr that do
+        not align to a column get a new all-gap column in aln.
+
+        Returns a MultipleSeqAlignment object with seqr first, then the rows
+        of aln, like muscle_profile_align()
+
+    '''
+
+    seq = str(seqr.seq).replace('-', '')
+    aln_mat = encode_alignment(aln)
+    idx_seq, idx_col, score = align_scores(make_profile_scores(seq, aln_mat, score_matrix),
+                                           gapopen, gapextend, penalize_end_gaps
+                                           )
+
+    out_mat = np.full((len(aln), len(idx_col)), ord('-'), dtype = np.uint8)
+    out_mat[:, idx_col >= 0] = aln_mat[:, idx_col[idx_col >= 0]]
+
+    rows = [SeqRecord(Seq(gapped(seq, idx_seq)), id = seqr.id, name = seqr.name,
+                      description = seqr.description)]
+    rows += [SeqRecord(Seq(out_mat[i].tostring()), id = row.id, name = row.name,
+                       description = row.description)
+             for (i, row) in enumerate(aln)
+             ]
+
+    return Align.MultipleSeqAlignment(rows)
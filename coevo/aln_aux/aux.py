@@ -6,13 +6,18 @@
 import sys
 
 import tempfile
+from bisect import bisect_left
 from Bio import SeqIO, Align
 from copy import deepcopy
 
+import numpy as np
+
+from .compact import CompactAlignment
+
 def pop_row(aln, seqid):
     ''' Pop a row from an alignment by sequence id
 
-        aln: a Bio.Align.MultipleSeqAlignment object
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
         seqid: id of Bio.SeqRecord.SeqRecord to pop from aln
 
         Returns a tuple containing the popped SeqRecord and a
@@ -20,6 +25,9 @@ def pop_row(aln, seqid):
 
     '''
 
+    if isinstance(aln, CompactAlignment):
+        return aln.pop_row(seqid)
+
     aln_d = SeqIO.to_dict(aln)
     seq = aln_d[seqid]
     del aln_d[seqid]
@@ -30,18 +38,14 @@ def pop_row(aln, seqid):
 def annotate_positions(seqrec):
     ''' Adds position numbering to a SeqRecord
         
+        Positions count non-gap letters from 0. Gaps get '-'.
+
     '''
 
-    pos_list = list()
-    pos = 0
-    for aa in seqrec.seq:
-        if aa == '-':
-            pos_list += ['-']
-        else:
-            pos_list += [pos]
-            pos += 1
+    not_gap = np.frombuffer(str(seqrec.seq), dtype = np.uint8) != ord('-')
+    pos = np.where(not_gap, np.cumsum(not_gap) - 1, -1).tolist()
 
-    seqrec.letter_annotations['pos'] = pos_list
+    seqrec.letter_annotations['pos'] = [p if p >= 0 else '-' for p in pos]
 
     return seqrec
 
@@ -69,3 +73,83 @@ def make_tmp_fa(seqrec):
 
     return tmp_fh
 
+def encode_alignment(aln):
+    ''' Encodes an alignment as a matrix of bytes
+
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
+
+        Returns a numpy.ndarray of uint8 with shape (n_seqs, aln_length)
+        *For a CompactAlignment, its matrix is returned without copying*
+
+    '''
+
+    if isinstance(aln, CompactAlignment):
+        return aln.aln_mat
+
+    aln_len = aln.get_alignment_length()
+    aln_mat = np.empty((len(aln), aln_len), dtype = np.uint8)
+    for (i, seqr) in enumerate(aln):
+        aln_mat[i] = np.frombuffer(str(seqr.seq), dtype = np.uint8)
+
+    return aln_mat
+
+def get_ids(aln):
+    ''' Returns the sequence ids of an alignment's rows, in order
+
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
+
+    '''
+
+    if isinstance(aln, CompactAlignment):
+        return aln.ids
+
+    return [seqr.id for seqr in aln]
+
+def map_columns(aln, aln_ref):
+    ''' Maps columns in aln to identical columns in aln_ref
+
+        aln, aln_ref: Bio.Align.MultipleSeqAlignment or CompactAlignment
+                      objects with the same sequences in the same order
+                      (different ids only get a warning).
+                      aln_ref is aln with extra columns inserted (eg. aln
+                      aligned to another sequence, with that sequence popped)
+
+        Both alignments are encoded as byte matrices and each column is
+        hashed once, so mapping takes time linear in alignment size. Each aln
+        column maps to the first identical aln_ref column after the previous
+        match, so the mapping is monotonic. All-gap columns in aln are
+        ambiguous and are skipped.
+
+        Returns a list of (aln column, aln_ref column) tuples
+
+    '''
+
+    if len(aln) != len(aln_ref):
+        raise ValueError('alignments must have the same number of sequences')
+    if get_ids(aln) != get_ids(aln_ref):
+        # eg. ids renamed by an external aligner, rows are still compared in order
+        print >>sys.stderr, 'Warning: map_columns(): sequence ids differ between alignments'
+
+    aln_cols = np.ascontiguousarray(encode_alignment(aln).T)
+    ref_cols = np.ascontiguousarray(encode_alignment(aln_ref).T)
+
+    # aln_ref columns by content, in increasing order
+    ref_col_idx = dict()
+    for (j, col) in enumerate(ref_cols):
+        ref_col_idx.setdefault(col.tostring(), list()).append(j)
+
+    all_gap = (aln_cols == ord('-')).all(axis = 1)
+    i_j = list()
+    js = 0  # first column in aln_ref to start checking
+    for (i, col) in enumerate(aln_cols):
+        if all_gap[i]:
+            continue
+        ref_js = ref_col_idx.get(col.tostring())
+        if ref_js is None:
+            continue
+        k = bisect_left(ref_js, js)
+        if k < len(ref_js):
+            i_j += [(i, ref_js[k])]
+            js = ref_js[k] + 1
+
+    return i_j
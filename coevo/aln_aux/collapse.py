@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+''' collapse.py -- collapse exact duplicate sequences in alignments
+
+    Each set of identical rows is kept once, as its first sequence (the
+    representative), with a count of how many rows it stands for. An id map
+    from every original id to its representative's id makes this
+    reversible, like make_strict_phylip_id_map() and replace_ids().
+
+    Consumers that take per-sequence weights give the same results on the
+    collapsed alignment with the counts as weights, eg.
+
+        coevo.aln_aux.score_alignments(collapsed, weights = counts)
+        coevo.aln_aux.sequence_weights(collapsed, counts = counts)
+
+'''
+
+import numpy as np
+
+from .compact import CompactAlignment, MultipleSeqAlignment_to_CompactAlignment
+from .formatting import iter_fasta_alignment, format_fasta
+
+__author__ = 'Aram Avila-Herrera'
+
+def collapse_duplicates(aln):
+    ''' Collapses identical rows of an alignment
+
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
+
+        Rows are hashed as whole byte strings. Representatives keep the order
+        of their first occurrence. Without columns, all rows collapse into
+        the first.
+
+        Returns a tuple (collapsed, counts, id_map):
+            collapsed: CompactAlignment of the representatives
+            counts: numpy.ndarray of int, rows each representative stands for
+            id_map: list of (original id, representative id) tuples, in the
+                    original order
+
+    '''
+
+    caln = MultipleSeqAlignment_to_CompactAlignment(aln)
+    aln_mat = np.ascontiguousarray(caln.aln_mat)
+    if aln_mat.shape[1] == 0:
+        # no columns: every row is a duplicate of the first
+        n_rows = len(aln_mat)
+        first = np.zeros(min(n_rows, 1), dtype = np.intp)
+        inverse = np.zeros(n_rows, dtype = np.intp)
+        counts = np.array([n_rows] * len(first), dtype = np.intp)
+    else:
+        rows = aln_mat.view(np.dtype((np.void, aln_mat.shape[1]))).ravel()
+        uniq, first, inverse, counts = np.unique(rows, return_index = True,
+                                                 return_inverse = True,
+                                                 return_counts = True
+                                                 )
+
+    order = np.argsort(first, kind = 'mergesort')  # representatives by first occurrence
+    rep_rows = first[order]
+    new_idx = np.empty_like(order)
+    new_idx[order] = np.arange(len(order))
+
+    collapsed = CompactAlignment(aln_mat[rep_rows], [caln.ids[i] for i in rep_rows],
+                                 [caln.descriptions[i] for i in rep_rows]
+                                 )
+    id_map = [(seqid, caln.ids[rep_rows[new_idx[k]]])
+              for (seqid, k) in zip(caln.ids, inverse)
+              ]
+
+    return collapsed, counts[order], id_map
+
+def collapse_fasta(fh, out_fh, map_fh = None):
+    ''' Collapses identical sequences of an aligned fasta, one record at a time
+
+        fh: open file handle with aligned fasta
+        out_fh: open file handle for the representatives, in fasta format
+        map_fh: open file handle for the tab delimited id map
+                (original id, representative id), or None
+
+        Representatives are written as they are first seen. Only one copy of
+        each distinct sequence is kept in memory.
+
+        Returns a dict from representative id to count
+
+    '''
+
+    rep_ids = dict()  # sequence -> representative id
+    counts = dict()  # representative id -> count
+    for (title, seq) in iter_fasta_alignment(fh, titles = True):
+        seqid = (title.split(None, 1) or [''])[0]
+        if seq not in rep_ids:
+            rep_ids[seq] = seqid
+            counts[seqid] = 0
+            out_fh.write(format_fasta(title, seq))
+        counts[rep_ids[seq]] += 1
+        if map_fh is not None:
+            print >>map_fh, '%s\t%s' % (seqid, rep_ids[seq])
+
+    return counts
+
+def read_id_map(map_fh):
+    ''' Reads an id map written by collapse_fasta()
+
+        Returns a list of (original id, representative id) tuples
+
+    '''
+
+    return [tuple(line.rstrip('\r\n').split('\t')[:2]) for line in map_fh if line.strip()]
+
+def count_representatives(id_map, rep_ids):
+    ''' Counts the rows each representative stands for
+
+        id_map: list of (original id, representative id) tuples
+        rep_ids: representative ids, eg. in the order of the collapsed
+                 alignment
+
+        Returns a numpy.ndarray of int aligned with rep_ids
+
+    '''
+
+    counts = dict((rep_id, 0) for rep_id in rep_ids)
+    for (seqid, rep_id) in id_map:
+        counts[rep_id] += 1
+
+    return np.array([counts[rep_id] for rep_id in rep_ids], dtype = int)
+
+def expand_values(rep_values, id_map):
+    ''' Copies per-representative values back to every original sequence
+
+        rep_values: dict from representative id to a value (eg. a weight)
+        id_map: list of (original id, representative id) tuples
+
+        Returns a list of (original id, value) tuples, in id_map order
+
+    '''
+
+    return [(seqid, rep_values[rep_id]) for (seqid, rep_id) in id_map]
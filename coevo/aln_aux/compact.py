@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+''' compact.py -- compact array-backed representation of alignments
+
+'''
+
+import numpy as np
+from Bio import Align
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+__author__ = 'Aram Avila-Herrera'
+
+GAP_CHARS = '-.'
+
+class CompactAlignment(object):
+    ''' Holds an alignment as a matrix of bytes with an index of sequence ids
+
+        aln_mat: uint8 matrix with shape (n_seqs, n_cols), one letter per byte
+        ids: sequence ids, one per row
+        descriptions: sequence descriptions, one per row
+        row_index: dict from sequence id to row number
+
+        Iterating gives SeqRecords, and len() and get_alignment_length() work
+        like Bio.Align.MultipleSeqAlignment, so code that only reads rows
+        accepts either. Rows and columns returned by get_row() and
+        get_columns() are views, not copies.
+
+    '''
+
+    def __init__(self, aln_mat, ids, descriptions = None):
+
+        self.ids = list(ids)
+        aln_mat = np.asarray(aln_mat, dtype = np.uint8)
+        if aln_mat.ndim != 2:  # flat bytes, eg. from a buffer
+            aln_mat = aln_mat.reshape(len(self.ids), -1 if self.ids else 0)
+        if len(aln_mat) != len(self.ids):
+            raise ValueError('need one sequence id per row')
+        self.aln_mat = aln_mat
+        if descriptions is None:
+            descriptions = [''] * len(self.ids)
+        self.descriptions = list(descriptions)
+        self.row_index = dict((seqid, i) for (i, seqid) in enumerate(self.ids))
+        if len(self.row_index) != len(self.ids):
+            raise ValueError('sequence ids must be unique')
+
+    def __len__(self):
+        ''' Returns the number of sequences
+
+        '''
+
+        return len(self.ids)
+
+    def __iter__(self):
+        ''' Generates a SeqRecord for each row
+
+        '''
+
+        for i in xrange(len(self)):
+            yield self.get_SeqRecord(i)
+
+    def get_alignment_length(self):
+        ''' Returns the number of columns
+
+        '''
+
+        return self.aln_mat.shape[1]
+
+    def get_row(self, seqid):
+        ''' Returns the row of seqid as a numpy.ndarray view
+
+        '''
+
+        return self.aln_mat[self.row_index[seqid]]
+
+    def get_SeqRecord(self, i):
+        ''' Returns row number i as a SeqRecord
+
+        '''
+
+        return SeqRecord(Seq(self.aln_mat[i].tostring()), id = self.ids[i],
+                         name = self.ids[i], description = self.descriptions[i]
+                         )
+
+    def get_column(self, j):
+        ''' Returns column j as a numpy.ndarray view over rows
+
+        '''
+
+        return self.aln_mat[:, j]
+
+    def get_columns(self, start, stop):
+        ''' Returns a CompactAlignment over columns start to stop - 1
+
+            The returned matrix is a view, not a copy.
+
+        '''
+
+        return CompactAlignment(self.aln_mat[:, start:stop], self.ids,
+                                self.descriptions
+                                )
+
+    def pop_row(self, seqid):
+        ''' Pop a row by sequence id
+
+            The row is found through row_index in O(1), then the other rows
+            are copied once into a new matrix (O(N*L)), keeping their order.
+            Consumers read aln_mat as one matrix, so removing rows lazily
+            would only delay that copy.
+
+            Returns a tuple containing the popped SeqRecord and a
+            CompactAlignment without seqid's row
+
+        '''
+
+        i = self.row_index[seqid]
+        keep = np.ones(len(self), dtype = bool)
+        keep[i] = False
+
+        return (self.get_SeqRecord(i),
+                CompactAlignment(self.aln_mat[keep],
+                                 self.ids[:i] + self.ids[i + 1:],
+                                 self.descriptions[:i] + self.descriptions[i + 1:]
+                                 ))
+
+    def gap_mask(self):
+        ''' Returns a boolean numpy.ndarray, True where aln_mat holds a gap
+
+        '''
+
+        return np.in1d(self.aln_mat, np.frombuffer(GAP_CHARS, dtype = np.uint8)
+                       ).reshape(self.aln_mat.shape)
+
+    def position_map(self):
+        ''' Maps each cell to its position in the ungapped sequence of its row
+
+            Returns a numpy.ndarray of int with shape (n_seqs, n_cols), with
+            0-based ungapped positions and -1 at gaps
+
+        '''
+
+        not_gap = ~self.gap_mask()
+
+        return np.where(not_gap, np.cumsum(not_gap, axis = 1) - 1, -1)
+
+def MultipleSeqAlignment_to_CompactAlignment(aln):
+    ''' Generates a CompactAlignment from a Bio.Align.MultipleSeqAlignment
+
+        Returns a CompactAlignment
+
+    '''
+
+    if isinstance(aln, CompactAlignment):
+        return aln
+
+    aln_mat = np.empty((len(aln), aln.get_alignment_length()), dtype = np.uint8)
+    for (i, seqr) in enumerate(aln):
+        aln_mat[i] = np.frombuffer(str(seqr.seq), dtype = np.uint8)
+
+    return CompactAlignment(aln_mat, [seqr.id for seqr in aln],
+                            [seqr.description for seqr in aln]
+                            )
+
+def CompactAlignment_to_MultipleSeqAlignment(caln):
+    ''' Generates a Bio.Align.MultipleSeqAlignment from a CompactAlignment
+
+        Returns a MultipleSeqAlignment object
+
+    '''
+
+    return Align.MultipleSeqAlignment(list(caln))
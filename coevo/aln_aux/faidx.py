@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+''' faidx.py -- random access to fasta files through an index
+
+    The index is the samtools faidx format (<fasta>.fai), one tab delimited
+    line per sequence:
+
+        name  length  offset  linebases  linewidth
+
+    offset is the byte offset of the sequence's first letter, linebases the
+    letters per line and linewidth the bytes per line (including the
+    newline). Every line of a sequence but the last must be the same length.
+
+    Sequences are read from a memory map of the fasta file, so fetching one
+    sequence or a range of columns touches only the bytes it needs.
+
+'''
+
+import os
+import sys
+import mmap
+import tempfile
+from collections import OrderedDict
+
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+
+from .. import cache
+
+__author__ = 'Aram Avila-Herrera'
+
+def build_fasta_index(fa_fn):
+    ''' Indexes a fasta file
+
+        fa_fn: fasta filename
+
+        Raises ValueError for repeated names, or for lines of a sequence
+        (other than the last) that differ in length.
+
+        Returns an OrderedDict from name to (length, offset, linebases,
+        linewidth), in file order
+
+    '''
+
+    index = OrderedDict()
+    name = None
+    pos = 0
+    with open(fa_fn, 'rb') as fh:
+        for line in fh:
+            line_len = len(line)
+            if line.startswith('>'):
+                if name is not None:
+                    index[name] = (length, offset, linebases or 0, linewidth or 0)
+                name = (line[1:].split(None, 1) or [''])[0]
+                if name in index:
+                    raise ValueError('Repeated name "%s" in %s' % (name, fa_fn))
+                length = 0
+                offset = pos + line_len
+                linebases = linewidth = None
+                last_line = False
+            elif name is not None:
+                bases = len(line.rstrip('\r\n'))
+                if linewidth is None:
+                    linebases, linewidth = bases, line_len
+                elif last_line and bases > 0 or bases > linebases:
+                    raise ValueError('Different line length in sequence "%s" in %s'
+                                     % (name, fa_fn))
+                elif line_len != linewidth:
+                    last_line = True
+                length += bases
+            pos += line_len
+    if name is not None:
+        index[name] = (length, offset, linebases or 0, linewidth or 0)
+
+    return index
+
+def write_fasta_index(index, fh):
+    ''' Writes an index from build_fasta_index() in .fai format
+
+    '''
+
+    for (name, entry) in index.iteritems():
+        print >>fh, '\t'.join([name] + map(str, entry))
+
+def read_fasta_index(fai_fn):
+    ''' Reads an index in .fai format
+
+        Returns an OrderedDict like build_fasta_index()
+
+    '''
+
+    index = OrderedDict()
+    with open(fai_fn) as fh:
+        for line in fh:
+            vals = line.rstrip('\r\n').split('\t')
+            index[vals[0]] = tuple(int(val) for val in vals[1:5])
+
+    return index
+
+def index_matches_file(index, fa_fn, fa_size, max_tail = 4096):
+    ''' Checks that an index ends where the sequences of a fasta file do
+
+        index: index from build_fasta_index() or read_fasta_index()
+        fa_fn: fasta filename
+        fa_size: size of fa_fn in bytes
+        max_tail: most bytes allowed after the last sequence letter
+
+        Only whitespace (eg. the last newline) may follow the last letter
+        of the last indexed sequence.
+
+        Returns True if the index fits the file
+
+    '''
+
+    end = 0
+    if index:
+        (length, offset, linebases, linewidth) = index[next(reversed(index))]
+        end = offset
+        if length > 0:
+            end += ((length - 1) // linebases) * linewidth + (length - 1) % linebases + 1
+    if not 0 <= fa_size - end <= max_tail:
+        return False
+    with open(fa_fn, 'rb') as fh:
+        fh.seek(end)
+        return fh.read(fa_size - end).strip() == ''
+
+def load_fasta_index(fa_fn, use_cache = True):
+    ''' Loads the index of a fasta file, building it if needed
+
+        fa_fn: fasta filename
+        use_cache: if <fa_fn>.fai can not be written, keep the index in
+                   the on-disk cache instead (see coevo.cache), keyed by the
+                   path, size and modification time of fa_fn
+
+        An existing <fa_fn>.fai is used if it is newer than fa_fn and ends
+        where fa_fn does (see index_matches_file()). Otherwise the index is
+        built and saved to <fa_fn>.fai.
+
+        Returns an OrderedDict like build_fasta_index()
+
+    '''
+
+    fai_fn = fa_fn + '.fai'
+    fa_stat = os.stat(fa_fn)
+    if os.path.exists(fai_fn) and os.path.getmtime(fai_fn) >= fa_stat.st_mtime:
+        index = read_fasta_index(fai_fn)
+        if index_matches_file(index, fa_fn, fa_stat.st_size):
+            return index
+        print >>sys.stderr, 'Warning: index "%s" does not match "%s", rebuilding' % (fai_fn, fa_fn)
+
+    key = cache.make_key('faidx', os.path.abspath(fa_fn), fa_stat.st_size, fa_stat.st_mtime)
+    if use_cache:
+        index = cache.cache_load(key, '.fai', read_fasta_index)
+        if index is not None:
+            return index
+
+    index = build_fasta_index(fa_fn)
+    try:
+        tmp_fh = tempfile.NamedTemporaryFile(dir = os.path.dirname(os.path.abspath(fa_fn)),
+                                             suffix = '.fai', delete = False
+                                             )
+        write_fasta_index(index, tmp_fh)
+        tmp_fh.close()
+        os.rename(tmp_fh.name, fai_fn)
+    except (IOError, OSError) as err:
+        print >>sys.stderr, 'Warning: could not write index "%s": %s' % (fai_fn, err)
+        if use_cache:
+            cache.cache_store(key, '.fai', lambda fh: write_fasta_index(index, fh))
+
+    return index
+
+class IndexedFasta(object):
+    ''' Reads sequences from a fasta file by id, through a memory map
+
+        fa_fn: fasta filename
+        index: index from load_fasta_index() [default = load it]
+
+        Works like a read-only dict from ids to SeqRecords (like
+        Bio.SeqIO.index()). Ids are in file order. Call close() when done.
+
+    '''
+
+    def __init__(self, fa_fn, index = None):
+
+        self.fa_fn = fa_fn
+        if index is None:
+            index = load_fasta_index(fa_fn)
+        self.index = index
+        self._fh = open(fa_fn, 'rb')
+        if os.fstat(self._fh.fileno()).st_size > 0:
+            self._mm = mmap.mmap(self._fh.fileno(), 0, access = mmap.ACCESS_READ)
+        else:
+            self._mm = ''
+
+    def __len__(self):
+        ''' Returns the number of sequences
+
+        '''
+
+        return len(self.index)
+
+    def __contains__(self, seqid):
+
+        return seqid in self.index
+
+    def __iter__(self):
+
+        return iter(self.index)
+
+    def keys(self):
+        ''' Returns the sequence ids in file order
+
+        '''
+
+        return self.index.keys()
+
+    def __getitem__(self, seqid):
+
+        return self.get_SeqRecord(seqid)
+
+    def get_seq(self, seqid, start = 0, stop = None):
+        ''' Returns letters start to stop - 1 (eg. alignment columns) of seqid as str
+
+            start, stop: 0-based, like slicing. stop = None reads to the end
+
+        '''
+
+        (length, offset, linebases, linewidth) = self.index[seqid]
+        (start, stop, step) = slice(start, stop).indices(length)
+        if stop <= start:
+            return ''
+
+        def byte_pos(i):
+            return offset + (i // linebases) * linewidth + i % linebases
+
+        return self._mm[byte_pos(start):byte_pos(stop - 1) + 1].replace('\n', '').replace('\r', '')
+
+    def get_title(self, seqid):
+        ''' Returns the header line of seqid, without '>'
+
+            Trailing whitespace is stripped, like Bio.SeqIO's fasta parser.
+
+        '''
+
+        offset = self.index[seqid][1]
+        head_end = self._mm.rfind('\n', 0, offset)
+        head_start = self._mm.rfind('\n', 0, head_end) + 1
+
+        return self._mm[head_start + 1:head_end].rstrip()
+
+    def get_SeqRecord(self, seqid, start = 0, stop = None):
+        ''' Returns seqid as a SeqRecord like Bio.SeqIO's fasta parser
+
+            start, stop: see get_seq()
+
+        '''
+
+        return SeqRecord(Seq(self.get_seq(seqid, start, stop)), id = seqid,
+                         name = seqid, description = self.get_title(seqid)
+                         )
+
+    def close(self):
+        ''' Closes the memory map and file
+
+        '''
+
+        if self._mm != '':
+            self._mm.close()
+        self._fh.close()
@@ -1,8 +1,23 @@
 #!/usr/bin/env python
 ''' formatting.py -- utilities for formatting sequence alignments
 
+    Converters named write_* stream aligned fasta record by record, so
+    memory does not grow with alignment size (phylip converters keep only
+    the short truncated ids, to reject repeats).
+
 '''
 
+import sys
+import shutil
+import tempfile
+
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.AlignIO.PhylipIO import sanitize_name
+
+from .faidx import IndexedFasta
+
+PHYLIP_ID_WIDTH = 10
+
 def make_strict_phylip_id_map(seqids):
     ''' Maps strict phylip ids to original ids
     
@@ -35,3 +50,215 @@ def replace_ids(aln, id_map):
     
     return aln
 
+
+def iter_fasta_alignment(fh, titles = False):
+    ''' Reads an aligned fasta file one record at a time
+
+        fh: open file handle
+        titles: yield whole header lines (without '>') instead of ids
+
+        Only the current record is held in memory.
+
+        Raises ValueError if the sequences differ in length, or if there are
+        none.
+
+        Returns a generator of tuples: ((seqid, seq), ...)
+
+    '''
+
+    aln_len = None
+    for (title, seq) in SimpleFastaParser(fh):
+        if aln_len is None:
+            aln_len = len(seq)
+        elif len(seq) != aln_len:
+            raise ValueError('Sequences must all be the same length')
+        yield title if titles else (title.split(None, 1) or [''])[0], seq
+
+    if aln_len is None:
+        raise ValueError('No records found in handle')
+
+def write_psicov(records, out_fh):
+    ''' Writes sequences in PSICOV format, one per line, without ids
+
+        records: iterable of (seqid, seq) tuples, eg. from iter_fasta_alignment()
+        out_fh: open file handle
+
+        Lines are written as records are read.
+
+        Returns the number of sequences written
+
+    '''
+
+    n_seqs = 0
+    for (seqid, seq) in records:
+        out_fh.write(seq + '\n')
+        n_seqs += 1
+
+    return n_seqs
+
+def format_phylip_row(seqid, seq, names, id_len = 8):
+    ''' Formats a sequence as a line of sequential strict phylip
+
+        seqid, seq: sequence id and sequence
+        names: set of names already used, updated in place
+        id_len: ids are truncated to id_len characters, then cleaned and
+                padded to 10 like Bio.AlignIO's phylip-sequential writer
+
+        Raises ValueError for empty sequences, dots, or repeated names.
+
+        Returns the formatted line
+
+    '''
+
+    name = sanitize_name(seqid[:id_len], PHYLIP_ID_WIDTH)
+    if name in names:
+        raise ValueError('Repeated name %r (originally %r), possibly due to truncation'
+                         % (name, seqid))
+    names.add(name)
+    if len(seq) == 0:
+        raise ValueError('Non-empty sequences are required')
+    if '.' in seq:
+        raise ValueError('PHYLIP format no longer allows dots in sequence')
+
+    return name.ljust(PHYLIP_ID_WIDTH) + seq + '\n'
+
+def write_phylip_two_pass(fh, out_fh, id_len = 8):
+    ''' Converts aligned fasta to sequential strict phylip, reading fh twice
+
+        fh: open, seekable file handle with aligned fasta
+        out_fh: open file handle
+        id_len: see format_phylip_row()
+
+        The first pass counts and checks sequences for the header. The second
+        pass writes them.
+
+    '''
+
+    names = set()
+    n_seqs = 0
+    for (seqid, seq) in iter_fasta_alignment(fh):
+        format_phylip_row(seqid, seq, names, id_len)
+        n_seqs += 1
+        aln_len = len(seq)
+
+    fh.seek(0)
+    out_fh.write(' %i %s\n' % (n_seqs, aln_len))
+    names = set()
+    for (seqid, seq) in iter_fasta_alignment(fh):
+        out_fh.write(format_phylip_row(seqid, seq, names, id_len))
+
+def write_phylip_spooled(fh, out_fh, id_len = 8, spool_dir = None):
+    ''' Converts aligned fasta to sequential strict phylip in one pass
+
+        fh: open file handle with aligned fasta (eg. a pipe)
+        out_fh: open file handle
+        id_len: see format_phylip_row()
+        spool_dir: directory for the temporary spool file [default = tempfile's]
+
+        Formatted lines are spooled to a temporary file while counting, then
+        copied to out_fh after the header. Nothing is written to out_fh if
+        the input is invalid.
+
+    '''
+
+    spool_fh = tempfile.TemporaryFile(dir = spool_dir)
+    names = set()
+    n_seqs = 0
+    for (seqid, seq) in iter_fasta_alignment(fh):
+        spool_fh.write(format_phylip_row(seqid, seq, names, id_len))
+        n_seqs += 1
+        aln_len = len(seq)
+
+    spool_fh.seek(0)
+    out_fh.write(' %i %s\n' % (n_seqs, aln_len))
+    shutil.copyfileobj(spool_fh, out_fh)
+    spool_fh.close()
+
+def is_seekable(fh):
+    ''' Returns True if fh is at its start and can be rewound there
+        (eg. a file, not a pipe)
+
+    '''
+
+    try:
+        fh.seek(0, 1)
+        return fh.tell() == 0
+    except (IOError, OSError, AttributeError):
+        return False
+
+def format_fasta(title, seq, width = 60):
+    ''' Formats a fasta record like Bio.SeqIO's fasta writer
+
+        title: header line without '>'
+        seq: sequence, wrapped every width letters
+
+        Returns the formatted record
+
+    '''
+
+    lines = ['>' + title] + [seq[i:i + width] for i in xrange(0, len(seq), width)]
+
+    return '\n'.join(lines) + '\n'
+
+def split_fasta_columns(fh, cols, out_fhs):
+    ''' Splits an aligned fasta at columns, one record at a time
+
+        fh: open file handle with aligned fasta
+        cols: increasing column numbers to split at. Output i gets columns
+              cols[i - 1] + 1 to cols[i] (1-based), like aln[:, :nth_col]
+              and aln[:, nth_col:] for one column
+        out_fhs: len(cols) + 1 open file handles, left to right
+
+        All outputs are written in a single pass over fh.
+
+        Returns the number of sequences written
+
+    '''
+
+    if len(out_fhs) != len(cols) + 1:
+        raise ValueError('need %d outputs for %d split columns' % (len(cols) + 1, len(cols)))
+    if list(cols) != sorted(cols):
+        raise ValueError('split columns must be increasing')
+
+    bounds = [None] + list(cols) + [None]
+    n_seqs = 0
+    for (title, seq) in iter_fasta_alignment(fh, titles = True):
+        for (i, out_fh) in enumerate(out_fhs):
+            out_fh.write(format_fasta(title, seq[bounds[i]:bounds[i + 1]]))
+        n_seqs += 1
+
+    return n_seqs
+
+def join_fastas(fa_fns, out_fh):
+    ''' Joins aligned fastas horizontally by sequence id, one record at a time
+
+        fa_fns: fasta filenames, left to right. The first is read in order;
+                the others are read through indices (see IndexedFasta)
+        out_fh: open file handle
+
+        Sequence ids must be exact and unique within each fasta. Sequences
+        of the first fasta missing from any other are skipped and reported to
+        stderr. Headers are kept if they agree in every fasta, like adding
+        SeqRecords.
+
+        Returns the number of sequences written
+
+    '''
+
+    others = [IndexedFasta(fa_fn) for fa_fn in fa_fns[1:]]
+    n_seqs = 0
+    with open(fa_fns[0]) as fh:
+        for (title, seq) in SimpleFastaParser(fh):
+            seqid = (title.split(None, 1) or [''])[0]
+            if not all(seqid in other for other in others):
+                print >>sys.stderr, 'skipping: %s' % seqid
+                continue
+            if any(other.get_title(seqid) != title for other in others):
+                title = seqid + ' <unknown description>'
+            seq = ''.join([seq] + [other.get_seq(seqid) for other in others])
+            out_fh.write(format_fasta(title, seq))
+            n_seqs += 1
+    for other in others:
+        other.close()
+
+    return n_seqs
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+''' mi.py -- mutual information scores computed from alignments
+
+    Scores pairs of alignment columns like infCalc, without running it:
+
+        Left_Entropy, Right_Entropy   H(X), H(Y)
+        Joint_Entropy                 H(X, Y)
+        MI                            H(X) + H(Y) - H(X, Y)
+        VI                            H(X, Y) - MI
+        MIminh                        MI / min(H(X), H(Y))
+        MIj                           MI / H(X, Y)
+        MIapc                         MI - MI(X, .) * MI(., Y) / MI(., .)
+                                      (average product correction)
+
+    Gaps count as a symbol. Entropies are in bits by default.
+
+    Columns are encoded as small integers and the joint histograms of many
+    column pairs are counted with one numpy.bincount() per block.
+
+'''
+
+import numpy as np
+import pandas as pd
+
+from .aux import encode_alignment
+
+__author__ = 'Aram Avila-Herrera'
+
+STAT_NAMES = ('Left_Entropy', 'Right_Entropy', 'Joint_Entropy',
+              'MI', 'VI', 'MIminh', 'MIj', 'MIapc')
+
+def encode_columns(aln):
+    ''' Encodes an alignment as a matrix of symbol numbers
+
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
+
+        Returns a tuple (codes, n_symbols): codes is a numpy.ndarray of intp
+        with shape (n_seqs, n_cols) and values 0 to n_symbols - 1
+
+    '''
+
+    aln_mat = encode_alignment(aln)
+    symbols, codes = np.unique(aln_mat, return_inverse = True)
+
+    return codes.reshape(aln_mat.shape).astype(np.intp), len(symbols)
+
+def entropy(counts, base = 2):
+    ''' Entropy of histograms along the last axis of counts
+
+        counts: numpy.ndarray of (weighted) counts
+        base: logarithm base [default = 2, bits]
+
+        Returns a numpy.ndarray with the last axis of counts removed
+
+    '''
+
+    counts = np.asarray(counts, dtype = float)
+    total = counts.sum(axis = -1)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        sum_clogc = np.where(counts > 0, counts * np.log(counts), 0.0).sum(axis = -1)
+        ent = np.log(total) - sum_clogc / total
+
+    return ent / np.log(base)
+
+def column_entropies(codes, n_symbols, weights = None, base = 2):
+    ''' Entropy of each column
+
+        codes, n_symbols: see encode_columns()
+        weights: per-sequence weights (eg. from coevo.aln_aux.reweight), or
+                 None to count each sequence once
+        base: see entropy()
+
+        Returns a numpy.ndarray of length n_cols
+
+    '''
+
+    n_seqs, n_cols = codes.shape
+    idx = (codes + np.arange(n_cols) * n_symbols).ravel()
+    counts = np.bincount(idx, weights = None if weights is None else np.repeat(weights, n_cols),
+                         minlength = n_cols * n_symbols
+                         )
+
+    return entropy(counts.reshape(n_cols, n_symbols), base)
+
+def joint_entropies(codes_a, n_symbols_a, codes_b, n_symbols_b,
+                    weights = None, base = 2, block_size = 2**22):
+    ''' Joint entropy of each pair of columns
+
+        codes_a, n_symbols_a: left alignment (see encode_columns())
+        codes_b, n_symbols_b: right alignment with the same sequences in
+                              the same order
+        weights, base: see column_entropies()
+        block_size: about how many array elements to count at once. Blocks
+                    are split over left columns, and over right columns
+                    when one left column is too big. A single column pair
+                    still takes max(n_seqs, n_symbols_a * n_symbols_b)
+
+        Returns a numpy.ndarray with shape (n_cols_a, n_cols_b)
+
+    '''
+
+    n_seqs, n_a = codes_a.shape
+    n_b = codes_b.shape[1]
+    n_joint = n_symbols_a * n_symbols_b
+    pair_size = max(n_seqs, n_joint, 1)  # elements per column pair
+    n_cols_b = max(1, min(n_b, block_size // pair_size))
+    n_rows = max(1, block_size // (n_cols_b * pair_size))
+
+    joint_ent = np.empty((n_a, n_b))
+    for b_start in xrange(0, n_b, n_cols_b):
+        b_stop = min(b_start + n_cols_b, n_b)
+        n_block_b = b_stop - b_start
+        b_offsets = codes_b[:, b_start:b_stop] + np.arange(n_block_b) * n_joint
+        for start in xrange(0, n_a, n_rows):
+            stop = min(start + n_rows, n_a)
+            n_pairs = (stop - start) * n_block_b
+            idx = (codes_a[:, start:stop, None] * n_symbols_b + b_offsets[:, None, :]
+                   + (np.arange(stop - start) * n_block_b * n_joint)[None, :, None]
+                   )
+            counts = np.bincount(idx.ravel(),
+                                 weights = None if weights is None else np.repeat(weights, n_pairs),
+                                 minlength = n_pairs * n_joint
+                                 )
+            counts = counts.reshape(stop - start, n_block_b, n_joint)
+            joint_ent[start:stop, b_start:b_stop] = entropy(counts, base)
+
+    return joint_ent
+
+def apc(mi_mat, intra = False):
+    ''' Average product correction of an MI matrix
+
+        mi_mat: numpy.ndarray with shape (n_cols_a, n_cols_b)
+        intra: if True, mi_mat is square over one alignment and its diagonal
+               is left out of the averages
+
+        Returns MI - MI(i, .) * MI(., j) / MI(., .)
+
+    '''
+
+    if intra:
+        off_diag = ~np.eye(len(mi_mat), dtype = bool)
+        n = len(mi_mat)
+        row_mean = np.where(off_diag, mi_mat, 0.0).sum(axis = 1) / max(n - 1, 1)
+        col_mean = row_mean
+        all_mean = mi_mat[off_diag].mean() if n > 1 else 0.0
+    else:
+        row_mean = mi_mat.mean(axis = 1)
+        col_mean = mi_mat.mean(axis = 0)
+        all_mean = mi_mat.mean()
+
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        return mi_mat - np.outer(row_mean, col_mean) / all_mean
+
+def score_alignments(left_aln, right_aln = None, weights = None, base = 2,
+                     suff = '', block_size = 2**22):
+    ''' Scores pairs of columns with MI statistics (see STAT_NAMES)
+
+        left_aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object
+        right_aln: alignment with the same sequences (eg. paired proteins) in
+                   the same order, or None to score pairs of left_aln columns
+                   (Left_Column < Right_Column)
+        weights: per-sequence weights, or None (see column_entropies())
+        base: logarithm base [default = 2, bits]
+        suff: appended to stat names, like coevo.scores.Format
+        block_size: see joint_entropies()
+
+        Columns count from 0. Undefined ratios (eg. MIminh of a constant
+        column) are NaN.
+
+        Returns a pandas.DataFrame indexed by Left_Column, Right_Column, like
+        coevo.scores.Format.load()
+
+    '''
+
+    codes_a, n_symbols_a = encode_columns(left_aln)
+    if right_aln is None:
+        codes_b, n_symbols_b = codes_a, n_symbols_a
+    else:
+        codes_b, n_symbols_b = encode_columns(right_aln)
+        if len(codes_b) != len(codes_a):
+            raise ValueError('alignments must have the same number of sequences')
+    if weights is not None:
+        weights = np.asarray(weights, dtype = float)
+        if len(weights) != len(codes_a):
+            raise ValueError('need one weight per sequence')
+
+    ent_a = column_entropies(codes_a, n_symbols_a, weights, base)
+    ent_b = column_entropies(codes_b, n_symbols_b, weights, base)
+    joint_ent = joint_entropies(codes_a, n_symbols_a, codes_b, n_symbols_b,
+                                weights, base, block_size
+                                )
+    left_ent = np.repeat(ent_a[:, None], len(ent_b), axis = 1)
+    right_ent = np.repeat(ent_b[None, :], len(ent_a), axis = 0)
+    mi_mat = left_ent + right_ent - joint_ent
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        stats = (left_ent, right_ent, joint_ent, mi_mat, joint_ent - mi_mat,
+                 mi_mat / np.minimum(left_ent, right_ent), mi_mat / joint_ent,
+                 apc(mi_mat, intra = right_aln is None)
+                 )
+
+    if right_aln is None:
+        idx_l, idx_r = np.triu_indices(len(ent_a), 1)
+    else:
+        idx_l, idx_r = [idx.ravel() for idx in np.indices(mi_mat.shape)]
+
+    idx_colnames = ['Left_Column', 'Right_Column']
+    stat_names = [name + suff for name in STAT_NAMES]
+    df = pd.DataFrame(dict([('Left_Column', idx_l), ('Right_Column', idx_r)]
+                           + [(name, stat[idx_l, idx_r])
+                              for (name, stat) in zip(stat_names, stats)]),
+                      columns = idx_colnames + stat_names
+                      )
+    df.set_index(idx_colnames, inplace = True)
+
+    return df
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+''' reweight.py -- sequence weights from pairwise sequence identity
+
+    A sequence's weight is 1 / (number of sequences more than threshold
+    identical to it, itself included), as in DCA methods. Identity is the
+    fraction of alignment columns with the same letter, where gaps count as
+    a letter: gap-to-gap columns are identical.
+    Rows can stand for several identical sequences (see
+    coevo.aln_aux.collapse), given their multiplicities.
+
+    All pairs are compared, but in blocks of rows: the identity counts of a
+    block are accumulated one column at a time with uint8 comparisons, so
+    memory stays at about block_rows**2 counters. Blocks of rows can run in
+    a pool of worker processes.
+
+'''
+
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from .aux import encode_alignment
+
+__author__ = 'Aram Avila-Herrera'
+
+WORKER_ALN_T = None  # transposed alignment matrix, set in worker processes
+WORKER_MULT = None  # row multiplicities, set in worker processes
+
+def count_block_neighbors(aln_t, mult, start, stop, min_matches, block_rows):
+    ''' Counts close pairs between rows start to stop - 1 and rows from start on
+
+        aln_t: transposed alignment matrix, shape (n_cols, n_seqs)
+        mult: numpy.ndarray of int with the multiplicity of each row
+        start, stop: block of rows (sequences)
+        min_matches: pairs with more than this many identical columns are close
+        block_rows: number of rows compared at once
+
+        Each pair is counted for both of its sequences, once, weighted by
+        the multiplicity of the other sequence.
+
+        Returns a numpy.ndarray of length n_seqs with counts to add
+
+    '''
+
+    n_seqs = aln_t.shape[1]
+    counts = np.zeros(n_seqs, dtype = np.intp)
+    for j_start in xrange(start, n_seqs, block_rows):
+        j_stop = min(j_start + block_rows, n_seqs)
+        matches = np.zeros((stop - start, j_stop - j_start), dtype = np.uint32)
+        for col in aln_t:
+            matches += col[start:stop, None] == col[None, j_start:j_stop]
+        close = matches > min_matches
+
+        counts[start:stop] += close.dot(mult[j_start:j_stop])
+        if j_start != start:  # the diagonal block already holds both orders
+            counts[j_start:j_stop] += mult[start:stop].dot(close)
+
+    return counts
+
+def init_worker(aln_t, mult):
+    ''' Stores the alignment matrix and multiplicities in a worker process
+
+    '''
+
+    global WORKER_ALN_T, WORKER_MULT
+    WORKER_ALN_T = aln_t
+    WORKER_MULT = mult
+
+def count_worker_block(args):
+    ''' Runs count_block_neighbors() on the worker's alignment matrix
+
+    '''
+
+    return count_block_neighbors(WORKER_ALN_T, WORKER_MULT, *args)
+
+def identity_counts(aln, threshold = 0.8, n_workers = 1, block_rows = 2048,
+                    counts = None):
+    ''' Counts the sequences more than threshold identical to each sequence
+
+        aln: a Bio.Align.MultipleSeqAlignment or CompactAlignment object, or
+             an encoded alignment matrix (see encode_alignment())
+        threshold: pairs with a fraction of identical columns (gap-to-gap
+                   included) strictly above threshold are counted, and
+                   identical sequences always are [default = 0.8]
+        n_workers: number of worker processes, each taking blocks of rows
+                   [default = 1, no pool]. None uses every CPU
+        block_rows: number of rows compared at once. Memory is about
+                    4 * block_rows**2 bytes per process
+        counts: number of sequences each row stands for (eg. from
+                coevo.aln_aux.collapse_duplicates()), or None for one each
+
+        Returns a numpy.ndarray of int with the count of each sequence,
+        itself and its duplicates included
+
+    '''
+
+    aln_mat = aln if isinstance(aln, np.ndarray) else encode_alignment(aln)
+    aln_t = np.ascontiguousarray(aln_mat.T)
+    n_cols, n_seqs = aln_t.shape
+    if counts is None:
+        mult = np.ones(n_seqs, dtype = np.intp)
+    else:
+        mult = np.asarray(counts, dtype = np.intp)
+    # integer, robust to rounding. Identical rows (and each row itself) always count
+    min_matches = min(int(np.floor(threshold * n_cols + 1e-9)), n_cols - 1)
+    blocks = [(start, min(start + block_rows, n_seqs), min_matches, block_rows)
+              for start in xrange(0, n_seqs, block_rows)
+              ]
+
+    if n_workers is None:
+        n_workers = cpu_count()
+    if n_workers <= 1 or len(blocks) <= 1:
+        block_counts = [count_block_neighbors(aln_t, mult, *block) for block in blocks]
+    else:
+        pool = Pool(min(n_workers, len(blocks)), init_worker, (aln_t, mult))
+        try:
+            block_counts = pool.map(count_worker_block, blocks, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return np.sum(block_counts, axis = 0, dtype = np.intp) if blocks else np.zeros(0, dtype = np.intp)
+
+def sequence_weights(aln, threshold = 0.8, n_workers = 1, block_rows = 2048,
+                     counts = None):
+    ''' Weights each sequence by 1 / number of sequences more than threshold identical
+
+        aln, threshold, n_workers, block_rows, counts: see identity_counts()
+
+        Identity counts every column with the same symbol in both sequences,
+        so columns where both have a gap count as identical. A pair at
+        exactly threshold identity is not counted.
+
+        The weights sum to the effective number of sequences. They can be
+        passed to coevo.aln_aux.score_alignments() and column_entropies().
+        With counts, each row's weight covers all of its duplicates (the
+        weight of one copy times counts), so the results match the
+        uncollapsed alignment.
+
+        Returns a numpy.ndarray of float
+
+    '''
+
+    weights = 1.0 / identity_counts(aln, threshold, n_workers, block_rows, counts)
+    if counts is not None:
+        weights *= counts
+
+    return weights
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+''' runner.py -- run external aligners, many at a time
+
+    Aligner commands run as subprocesses. Their fasta output is parsed as it
+    is read from the pipe, so it is never held in memory as one string.
+    Input can be fed to the command's stdin instead of a temporary file.
+
+    map_concurrent() runs jobs in a pool of threads. The threads only wait
+    on subprocesses, so up to n_workers aligners run at once on separate
+    cores while the Python side does little work.
+
+'''
+
+import threading
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from subprocess import Popen, PIPE
+
+from Bio import AlignIO
+
+__author__ = 'Aram Avila-Herrera'
+
+def feed_stdin(proc, input_fa):
+    ''' Writes input_fa to proc's stdin and closes it
+
+        Runs in its own thread, so a command that writes output before it
+        has read all of its input does not block.
+
+    '''
+
+    try:
+        proc.stdin.write(input_fa)
+    except IOError:
+        pass  # command exited without reading everything
+    finally:
+        proc.stdin.close()
+
+def run_aligner_cmd(cmd, input_fa = None, timeout = None):
+    ''' Runs an aligner command and parses the fasta alignment on its stdout
+
+        cmd: command as a list of arguments
+        input_fa: fasta text to write to the command's stdin, or None
+        timeout: seconds to wait before killing the command, or None
+
+        Raises RuntimeError if the command times out or exits with an error.
+
+        Returns a MultipleSeqAlignment object
+
+    '''
+
+    proc = Popen(cmd, stdin = PIPE if input_fa is not None else None,
+                 stdout = PIPE
+                 )
+    if input_fa is not None:
+        writer = threading.Thread(target = feed_stdin, args = (proc, input_fa))
+        writer.daemon = True
+        writer.start()
+
+    timed_out = threading.Event()
+    def kill():
+        # returncode is set once wait() reaps the command. Checking it
+        # (rather than poll()) leaves reaping to wait() alone
+        if proc.returncode is None:
+            timed_out.set()
+            try:
+                proc.kill()
+            except OSError:
+                pass  # exited since
+    timer = threading.Timer(timeout, kill) if timeout is not None else None
+    if timer is not None:
+        timer.daemon = True
+        timer.start()
+
+    try:
+        exaln = AlignIO.read(proc.stdout, format = 'fasta')
+        parse_err = None
+    except ValueError as err:
+        exaln = None
+        parse_err = err
+    finally:
+        proc.stdout.close()
+        proc.wait()
+        if timer is not None:
+            timer.cancel()
+
+    if timed_out.is_set() and proc.returncode < 0:  # killed by a signal
+        raise RuntimeError('aligner timed out after %g s: %s' % (timeout, ' '.join(cmd)))
+    if proc.returncode != 0:
+        raise RuntimeError('aligner exited with status %d: %s' % (proc.returncode,
+                                                                  ' '.join(cmd)))
+    if parse_err is not None:
+        raise parse_err
+
+    return exaln
+
+def call_job(func_args):
+    ''' Calls func(*args), returning exceptions instead of raising them
+
+    '''
+
+    func, args = func_args
+    try:
+        return func(*args)
+    except Exception as err:
+        return err
+
+def map_concurrent(func, args_list, n_workers = None):
+    ''' Calls func on each tuple of arguments, n_workers calls at a time
+
+        func: function to call, eg. one that runs an aligner
+        args_list: list of argument tuples
+        n_workers: number of concurrent calls [default = number of CPUs]
+
+        With n_workers = 1, calls are made in order in this thread.
+
+        Returns a list with the result of each call, in the order of
+        args_list. Calls that raised an exception have the exception object
+        as their result.
+
+    '''
+
+    if n_workers is None:
+        n_workers = cpu_count()
+    jobs = [(func, args) for args in args_list]
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [call_job(job) for job in jobs]
+
+    pool = ThreadPool(min(n_workers, len(jobs)))
+    try:
+        return pool.map(call_job, jobs, chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
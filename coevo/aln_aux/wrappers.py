@@ -4,46 +4,100 @@
 '''
 
 from os import remove
-from subprocess import Popen, PIPE
 from StringIO import StringIO
 
-from Bio import Align, AlignIO
+from Bio import AlignIO
 from Bio.Align.Applications import MuscleCommandline
 from Bio.Emboss.Applications import NeedleCommandline
-from Bio.pairwise2 import align
-from Bio.SubsMat import MatrixInfo
 
+from .. import cache
 from .aux import make_tmp_fa, ungap_SeqRecord
+from .aligner import align_SeqRecords, profile_align_SeqRecord
+from .runner import run_aligner_cmd
 
+CACHE_VERSION = 1  # bump when aligners or their output change
 
-def make_external_aligner(EX_ALN_CMD):
+
+def make_external_aligner(EX_ALN_CMD, timeout = None, use_stdin = False):
     ''' Returns a function to align to fasta files with an external aligner.
 
         EX_ALN_CMD: command line containing two '%s' formatting operators
+        timeout: seconds to wait for the aligner before killing it, or None
+        use_stdin: feed the first input to the aligner's stdin (as
+                   /dev/stdin) instead of writing a temporary file. The
+                   aligner must read its first input in one pass
 
         For example:
                     'muscle -profile -in1 %s -in2 %s -out /dev/stdout'
                     'needle -auto -asequence %s -bsequence %s -stdout -aformat3 fasta'
 
+        The aligner's output is parsed as it is read (see
+        coevo.aln_aux.runner.run_aligner_cmd()).
+
     '''
 
     def ex_aligner(fa1, fa2):
         ''' Aligns sequences in two fasta files with an external aligner
 
             fa1, fa2: filenames of fasta files to align
+                      *With use_stdin, fa1 is a SeqRecord instead*
 
             Returns a MultipleSeqAlignment object
 
         '''
 
+        if use_stdin:
+            input_fa = fa1.format('fasta')
+            fa1 = '/dev/stdin'
+        else:
+            input_fa = None
         cmd = (EX_ALN_CMD % (fa1, fa2)).split()
-        cmd_sout = Popen(cmd, stdout=PIPE).communicate()[0]  # watch out for large alignments
-        exaln = AlignIO.read(StringIO(cmd_sout), format = "fasta")
 
-        return exaln
+        return run_aligner_cmd(cmd, input_fa, timeout)
+
+    ex_aligner.cmd = EX_ALN_CMD  # identifies the aligner in cache keys
+    ex_aligner.use_stdin = use_stdin
 
     return ex_aligner
 
+def aligner_id(ex_aligner):
+    ''' Returns a string identifying an aligner (and its settings) for cache keys
+
+        ex_aligner: aligner function, or None for the internal aligner
+
+    '''
+
+    if ex_aligner is None:
+        return 'internal'
+    if hasattr(ex_aligner, 'cmd'):
+        return 'cmd:' + ex_aligner.cmd
+
+    return '%s.%s' % (ex_aligner.__module__, ex_aligner.__name__)
+
+def cached_alignment(key, align_func):
+    ''' Returns a cached alignment, or computes and caches it
+
+        key: cache key from coevo.cache.make_key()
+        align_func: function with no arguments that returns a
+                    MultipleSeqAlignment object
+
+        Alignments are cached in fasta format (see coevo.cache).
+
+        Returns a MultipleSeqAlignment object
+
+    '''
+
+    exaln = cache.cache_load(key, '.fa',
+                             lambda cache_fn: AlignIO.read(cache_fn, format = 'fasta')
+                             )
+    if exaln is not None:
+        return exaln
+
+    exaln = align_func()
+    cache.cache_store(key, '.fa', lambda fh: AlignIO.write(exaln, fh, 'fasta'))
+
+    return exaln
+
 def muscle_profile_align(fa1, fa2):
     ''' Uses muscle to profile-align two fastas
 
@@ -81,48 +135,99 @@ def needle_align(fa1, fa2, gapopen = 10.0, gapextend = 0.5):
 
     return exaln
 
-def profile_align_SeqRecord_to_fa(seqr, aln_fn, ex_aligner = muscle_profile_align):
+def profile_align_SeqRecord_to_fa(seqr, aln_fn, ex_aligner = muscle_profile_align,
+                                  use_cache = False, aln = None):
     ''' Profile align SeqRecord to alignment in fasta file using external aligner.
 
         seqr: SeqRecord to profile-align
         aln_fn: filename of fasta to profile-align
         ex_aligner: helper function that profile-aligns sequences in two files
-        
+                    *If ex_aligner is None, use internal aligner*
+        use_cache: reuse results saved in the on-disk cache (see coevo.cache),
+                   keyed by seqr's id and sequence, a hash of aln_fn, and the
+                   aligner. Cache hits do not run the aligner
+        aln: the alignment in aln_fn if already read, so the internal
+             aligner does not read it again
+
+        Internal aligner:
+            coevo.aln_aux.aligner.profile_align_SeqRecord() with BLOSUM62
+            and default gap penalties (gapopen = 10.0, gapextend = 0.5).
+            No temporary files or subprocesses are used.
+
         Returns a MultipleSeqAlignment object
 
     '''
 
+    if use_cache:
+        key = cache.make_key('profile_align', CACHE_VERSION, aligner_id(ex_aligner),
+                             seqr.id, str(seqr.seq), cache.hash_file(aln_fn)
+                             )
+        return cached_alignment(key, lambda: profile_align_SeqRecord_to_fa(seqr, aln_fn,
+                                                                           ex_aligner,
+                                                                           aln = aln
+                                                                           ))
+
+    if ex_aligner is None:
+        if aln is None:
+            aln = AlignIO.read(aln_fn, format = 'fasta')
+        return profile_align_SeqRecord(seqr, aln)
+
+    if getattr(ex_aligner, 'use_stdin', False):
+        return ex_aligner(seqr, aln_fn)
+
     tmp_fa = make_tmp_fa(seqr)
-    exaln = ex_aligner(tmp_fa.name, aln_fn)
-    remove(tmp_fa.name)
+    try:
+        exaln = ex_aligner(tmp_fa.name, aln_fn)
+    finally:
+        remove(tmp_fa.name)
 
     return exaln
 
-def pair_align_SeqRecords(seqr_a, seqr_b, ex_aligner = needle_align):
+def pair_align_SeqRecords(seqr_a, seqr_b, ex_aligner = needle_align,
+                          use_cache = False):
     ''' Pairwise align two SeqRecords using external or internal aligner.
 
         seqr_a, seqr_b: SeqRecords to align
         ex_aligner: helper function that aligns sequences in two files
                     *If ex_aligner is None, use internal aligner*
+        use_cache: reuse results saved in the on-disk cache (see coevo.cache),
+                   keyed by ids and sequences of seqr_a and seqr_b, and the
+                   aligner. Cache hits do not run the aligner
 
         Internal aligner:
+            coevo.aln_aux.aligner.align_SeqRecords(), scores like
             Bio.pairwise2.align.globalds() with Bio.SubsMat.MatrixInfo.Blosum62
-            and default gap penalties (gapopen = -10.0, gapextend = -0.5)
+            and default gap penalties (gapopen = -10.0, gapextend = -0.5).
+            No temporary files or subprocesses are used.
 
         Returns a MultipleSeqAlignment object
 
     '''
 
+    if use_cache:
+        key = cache.make_key('pair_align', CACHE_VERSION, aligner_id(ex_aligner),
+                             seqr_a.id, str(seqr_a.seq), seqr_b.id, str(seqr_b.seq)
+                             )
+        return cached_alignment(key, lambda: pair_align_SeqRecords(seqr_a, seqr_b,
+                                                                   ex_aligner
+                                                                   ))
+
     if ex_aligner is None:
-        inaln = align.globalds(ungap_SeqRecord(seqr_a), ungap_SeqRecord(seqr_b),
-                               MatrixInfo.blosum62, -10.0, -0.5)
-        exaln = Align.MultipleSeqAlignment(inaln[0][:2])
+        exaln = align_SeqRecords(seqr_a, seqr_b)
+    elif getattr(ex_aligner, 'use_stdin', False):
+        tmp_ref_fa = make_tmp_fa(ungap_SeqRecord(seqr_b))
+        try:
+            exaln = ex_aligner(ungap_SeqRecord(seqr_a), tmp_ref_fa.name)
+        finally:
+            remove(tmp_ref_fa.name)
     else:
         tmp_fa = make_tmp_fa(ungap_SeqRecord(seqr_a))
         tmp_ref_fa = make_tmp_fa(ungap_SeqRecord(seqr_b))
-        exaln = ex_aligner(tmp_fa.name, tmp_ref_fa.name)
-        remove(tmp_fa.name)
-        remove(tmp_ref_fa.name)
+        try:
+            exaln = ex_aligner(tmp_fa.name, tmp_ref_fa.name)
+        finally:
+            remove(tmp_fa.name)
+            remove(tmp_ref_fa.name)
 
     return exaln
 
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+''' cache.py -- content-addressed on-disk cache for parsed inputs
+
+    Cached files live in a single directory, named by a hash key and a
+    suffix. The directory is kept under a size limit by deleting the least
+    recently used files first.
+
+    Settings can be changed with environment variables:
+        COEVO_CACHE_DIR        cache directory [default = ~/.cache/coevo]
+        COEVO_CACHE_MAX_BYTES  size limit in bytes [default = 1 GiB]
+
+'''
+
+import os
+import sys
+import hashlib
+import zipfile
+import tempfile
+
+__author__ = 'Aram Avila-Herrera'
+
+CACHE_DIR = os.environ.get('COEVO_CACHE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'coevo')
+                           )
+CACHE_MAX_BYTES = int(os.environ.get('COEVO_CACHE_MAX_BYTES', 2**30))
+
+def hash_file(fn, chunk_size = 2**20):
+    ''' Returns sha1 hex digest of the contents of file fn
+
+    '''
+
+    sha = hashlib.sha1()
+    with open(fn, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+def make_key(*parts):
+    ''' Returns sha1 hex digest combining parts (file hashes, settings, etc.)
+
+    '''
+
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def cache_lookup(key, suffix, cache_dir = None):
+    ''' Find a cached file
+
+        key: hash key from make_key()
+        suffix: file name suffix, eg. '.npz'
+        cache_dir: cache directory [default = CACHE_DIR]
+
+        Marks the file as recently used.
+
+        Returns the cached filename, or None if not cached
+
+    '''
+
+    cache_fn = os.path.join(cache_dir or CACHE_DIR, key + suffix)
+    if not os.path.exists(cache_fn):
+        return None
+    try:
+        os.utime(cache_fn, None)
+    except OSError:
+        pass
+
+    return cache_fn
+
+def cache_load(key, suffix, load_func, cache_dir = None):
+    ''' Load a cached file, treating unreadable files as not cached
+
+        key, suffix, cache_dir: see cache_lookup()
+        load_func: function that reads a cached filename and returns its
+                   contents, eg. a parsed structure
+
+        A file that can not be read or parsed (eg. truncated, or evicted
+        after it was found) is reported to stderr and removed, so it is
+        rebuilt and stored again.
+
+        Returns the value from load_func, or None if not cached
+
+    '''
+
+    cache_fn = cache_lookup(key, suffix, cache_dir)
+    if cache_fn is None:
+        return None
+    try:
+        return load_func(cache_fn)
+    except (IOError, OSError, EOFError, ValueError, KeyError, zipfile.BadZipfile) as err:
+        print >>sys.stderr, 'Warning: ignoring unreadable cache file "%s": %s' % (cache_fn, err)
+        try:
+            os.remove(cache_fn)
+        except OSError:
+            pass  # already evicted
+
+    return None
+
+def cache_store(key, suffix, write_func, cache_dir = None, max_bytes = None):
+    ''' Write a file to the cache, then evict old files
+
+        key, suffix, cache_dir: see cache_lookup()
+        write_func: function that writes to an open file handle
+        max_bytes: cache size limit [default = CACHE_MAX_BYTES]
+
+        The file is written to a temporary name and then renamed, so readers
+        never see partial files. Failures to write are reported to stderr
+        and otherwise ignored.
+
+        Returns the cached filename, or None if it could not be written
+
+    '''
+
+    cache_dir = cache_dir or CACHE_DIR
+    cache_fn = os.path.join(cache_dir, key + suffix)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_fh = tempfile.NamedTemporaryFile(dir = cache_dir, suffix = suffix,
+                                             delete = False
+                                             )
+        try:
+            write_func(tmp_fh)
+            tmp_fh.close()
+            os.rename(tmp_fh.name, cache_fn)
+        except:
+            tmp_fh.close()
+            os.remove(tmp_fh.name)
+            raise
+    except (IOError, OSError) as err:
+        print >>sys.stderr, 'Warning: could not write to cache "%s": %s' % (cache_dir, err)
+        return None
+
+    evict_lru(cache_dir, max_bytes)
+
+    return cache_fn
+
+def evict_lru(cache_dir = None, max_bytes = None):
+    ''' Delete least recently used files until cache_dir fits in max_bytes
+
+        cache_dir: cache directory [default = CACHE_DIR]
+        max_bytes: cache size limit [default = CACHE_MAX_BYTES]
+
+    '''
+
+    cache_dir = cache_dir or CACHE_DIR
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+
+    cached = list()
+    for fn in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, fn)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed by someone else
+        cached += [(stat.st_mtime, stat.st_size, path)]
+
+    total_bytes = sum(size for (mtime, size, path) in cached)
+    for (mtime, size, path) in sorted(cached):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total_bytes -= size
@@ -1 +1,4 @@
-from .aux import Chain_to_SeqRecord, open_pdb
+from .aux import Chain_to_SeqRecord, open_pdb, open_pdb_compact
+from .aux import load_pdb_compact, iter_pdb_compact, iter_pdb_models
+from .structure import CompactStructure, Entity_to_CompactStructure
+from .structure import save_CompactStructure, load_CompactStructure
@@ -4,17 +4,23 @@
 '''
 
 import gzip
+from collections import OrderedDict
 from os.path import basename
 from Bio import Seq, SeqRecord, SeqUtils, PDB
 
+from .. import cache
 from .distances import get_nonhet_residues
+from .structure import CompactStructure, Entity_to_CompactStructure
+from .structure import save_CompactStructure, load_CompactStructure
 
 __author__ = "Aram Avila-Herrera"
 
+CACHE_VERSION = 1  # bump when CompactStructure contents change
+
 def Chain_to_SeqRecord(chain):
     ''' Generates a SeqRecord from a Chain entity.
 
-        chain: a Bio.PDB.Chain object
+        chain: a Bio.PDB.Chain object or a CompactStructure over one chain
 
         Keeps only residues with blank flags (eg. no HET residues).
 
@@ -23,17 +29,37 @@ def Chain_to_SeqRecord(chain):
 
     '''
 
-    aas = ''
-    resns = list()
-    for res in get_nonhet_residues(chain):
-        aas += SeqUtils.seq1(res.get_resname())  # get 1-letter resname
-        resns += [res.id[1]]
+    if isinstance(chain, CompactStructure):
+        aas = ''.join(chain.aas)
+        resns = chain.resnums.tolist()
+    else:
+        aas = ''
+        resns = list()
+        for res in get_nonhet_residues(chain):
+            aas += SeqUtils.seq1(res.get_resname())  # get 1-letter resname
+            resns += [res.id[1]]
 
     seqr = SeqRecord.SeqRecord(Seq.Seq(aas), id = chain.id,
                                letter_annotations = {"resnum": resns})
 
     return seqr
 
+def open_pdb_handle(pdb_fn):
+    ''' Opens pdb filename for reading
+
+        If file name ends in '.gz', attempt to open with gzip.open().
+
+        Returns a file handle
+
+    '''
+
+    if pdb_fn.endswith('.gz'):
+            pdb_fh = gzip.open(pdb_fn)
+    else:
+            pdb_fh = open(pdb_fn)
+
+    return pdb_fh
+
 def open_pdb(pdb_fn):
     ''' Loads structure in given pdb filename
 
@@ -45,16 +71,206 @@ def open_pdb(pdb_fn):
 
     '''
 
-    if pdb_fn.endswith('.gz'):
-            pdb_fh = gzip.open(pdb_fn)
-    else:
-            pdb_fh = open(pdb_fn)
+    pdb_fh = open_pdb_handle(pdb_fn)
 
     pdb_id = basename(pdb_fn).split('.')[0]  # set id from filename
     structure = PDB.PDBParser().get_structure(pdb_id, pdb_fh)
 
     return structure
 
+def open_pdb_compact(pdb_fn, chain_ids = None, model_idx = 0):
+    ''' Reads ATOM records in given pdb filename into a CompactStructure
+
+        pdb_fn: filename as a str (may be gzipped, see open_pdb_handle())
+        chain_ids: chain ids to keep. Keeps all chains if None
+        model_idx: index of model to read [default = 0, the first model]
+
+        Streams the file line by line without building Bio.PDB objects and
+        stops reading at the end of the requested model.
+
+        Follows Bio.PDB.PDBParser where it matters for coevo:
+            - HETATM records are skipped (eg. no HET residues)
+            - of atoms with alternate locations, the first one with the
+              highest occupancy is kept
+            - chains and residues are ordered by first appearance
+
+        Returns structure: a CompactStructure
+
+    '''
+
+    for structure in iter_pdb_compact(pdb_fn, chain_ids, model_idxs = [model_idx]):
+        return structure
+
+def iter_pdb_compact(pdb_fn, chain_ids = None, model_idxs = None):
+    ''' Reads each model in given pdb filename into a CompactStructure
+
+        pdb_fn: filename as a str (may be gzipped, see open_pdb_handle())
+        chain_ids: chain ids to keep. Keeps all chains if None
+        model_idxs: indices of models to read. Reads all models if None
+
+        Models (eg. of an NMR ensemble or MD frames) are separated by ENDMDL
+        records. A file without them holds one model. Only one model is held
+        in memory at a time, other models are skipped without parsing, and
+        reading stops after the last requested model.
+
+        Atoms are read like open_pdb_compact()
+
+        Returns a generator over CompactStructures, one per model
+
+    '''
+
+    pdb_id = basename(pdb_fn).split('.')[0]  # set id from filename
+    if model_idxs is not None:
+        model_idxs = set(model_idxs)
+        last_model = max(model_idxs)
+
+    chains = OrderedDict()  # chain_id -> (resseq, icode) -> atom name -> atom
+    current_model = 0
+    has_atoms = False
+    pdb_fh = open_pdb_handle(pdb_fn)
+    for line in pdb_fh:
+        record_type = line[:6]
+        if record_type == 'ENDMDL':
+            if model_idxs is None or current_model in model_idxs:
+                yield _build_compact(chains, pdb_id)
+            if model_idxs is not None and current_model >= last_model:
+                has_atoms = False
+                break
+            chains = OrderedDict()
+            current_model += 1
+            has_atoms = False
+            continue
+        if record_type != 'ATOM  ':
+            continue
+        has_atoms = True
+        if model_idxs is not None and current_model not in model_idxs:
+            continue
+
+        chain_id = line[21]
+        if chain_ids is not None and chain_id not in chain_ids:
+            continue
+
+        name = line[12:16].strip()
+        try:
+            occupancy = float(line[54:60].strip() or 1.0)  # blank or missing: fully occupied
+            resseq = int(line[22:26])
+            coord = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
+        except ValueError:
+            raise ValueError('Malformed ATOM record in %s: %s' % (pdb_fn, line.rstrip('\r\n')))
+        residues = chains.setdefault(chain_id, OrderedDict())
+        res_key = (resseq, line[26])
+        if res_key not in residues:
+            residues[res_key] = (line[17:20].strip(), OrderedDict())
+        atoms = residues[res_key][1]
+        if name in atoms and atoms[name][0] >= occupancy:
+            continue  # keep first altloc with highest occupancy
+        element = line[76:78].strip() or name.lstrip('0123456789')[:1]
+        if name in atoms:
+            atoms[name] = (occupancy, coord, atoms[name][2])
+        else:
+            atoms[name] = (occupancy, coord, element)
+    pdb_fh.close()
+
+    # last model without a closing ENDMDL
+    if has_atoms and (model_idxs is None or current_model in model_idxs):
+        yield _build_compact(chains, pdb_id)
+
+def _build_compact(chains, pdb_id):
+    ''' Builds a CompactStructure from atoms collected by iter_pdb_compact()
+
+    '''
+
+    coords = list()
+    atom_names = list()
+    elements = list()
+    res_starts = [0]
+    resnums = list()
+    resnames = list()
+    res_chain_ids = list()
+    for (chain_id, residues) in chains.iteritems():
+        for ((resseq, icode), (resname, atoms)) in residues.iteritems():
+            for (name, (occupancy, coord, element)) in atoms.iteritems():
+                coords += [coord]
+                atom_names += [name]
+                elements += [element]
+            res_starts += [len(coords)]
+            resnums += [resseq]
+            resnames += [resname]
+            res_chain_ids += [chain_id]
+
+    structure = CompactStructure(coords, atom_names, elements, res_starts,
+                                 resnums, resnames, res_chain_ids, id = pdb_id
+                                 )
+
+    return structure
+
+def iter_pdb_models(pdb_fn, chain_ids = None, fast_pdb = False):
+    ''' Reads each model in given pdb filename as a CompactStructure
+
+        pdb_fn: filename as a str (may be gzipped, see open_pdb_handle())
+        chain_ids: chain ids to keep with fast_pdb. Keeps all chains if None
+        fast_pdb: stream models with iter_pdb_compact() instead of parsing the
+                  whole file with Bio.PDB.PDBParser
+
+        Only with fast_pdb is one model held in memory at a time. Without it,
+        the whole structure is parsed before the first model is returned.
+        Models are not cached (see load_pdb_compact()).
 
+        Returns a generator over CompactStructures, one per model
 
+    '''
+
+    if fast_pdb:
+        for structure in iter_pdb_compact(pdb_fn, chain_ids):
+            yield structure
+        return
+
+    pdb_id = basename(pdb_fn).split('.')[0]  # set id from filename
+    for model in open_pdb(pdb_fn):
+        structure = Entity_to_CompactStructure(model)
+        structure.id = pdb_id
+        yield structure
+
+def load_pdb_compact(pdb_fn, fast_pdb = False, use_cache = True, chain_ids = None):
+    ''' Loads first model in given pdb filename as a CompactStructure
+
+        pdb_fn: filename as a str (may be gzipped, see open_pdb_handle())
+        fast_pdb: parse with open_pdb_compact() instead of Bio.PDB.PDBParser
+        use_cache: reuse parsed structures saved in the on-disk cache
+                   (see coevo.cache)
+        chain_ids: chain ids to keep with fast_pdb when not using the cache.
+                   Cached structures always hold all chains, so they can be
+                   shared by every chain and tool.
+
+        The cache is keyed by a hash of the file's contents and the parser.
+
+        Returns structure: a CompactStructure
 
+    '''
+
+    pdb_id = basename(pdb_fn).split('.')[0]  # set id from filename
+    if fast_pdb:
+        parser = 'open_pdb_compact'
+    else:
+        parser = 'PDBParser'
+
+    if not use_cache:
+        if fast_pdb:
+            return open_pdb_compact(pdb_fn, chain_ids)
+        return Entity_to_CompactStructure(open_pdb(pdb_fn)[0])
+
+    key = cache.make_key('CompactStructure', CACHE_VERSION, parser,
+                         cache.hash_file(pdb_fn)
+                         )
+    structure = cache.cache_load(key, '.npz', load_CompactStructure)
+    if structure is None:
+        if fast_pdb:
+            structure = open_pdb_compact(pdb_fn)
+        else:
+            structure = Entity_to_CompactStructure(open_pdb(pdb_fn)[0])
+        cache.cache_store(key, '.npz',
+                          lambda fh: save_CompactStructure(structure, fh)
+                          )
+    structure.id = pdb_id
+
+    return structure
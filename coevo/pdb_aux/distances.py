@@ -5,10 +5,14 @@
 
 from itertools import product
 
+import numpy as np
 from numpy.linalg import norm
 
 __author__ = 'Aram Avila-Herrera'
 
+BACKBONE_ATOMS = ('N', 'CA', 'C', 'O', 'OXT')
+DIST_ATOMS = ('Cb', 'NoH', 'Any', 'Cen')  # distance definitions
+
 def get_CB_coord(residue):
     ''' Get beta carbon coordinates from residue
 
@@ -52,6 +56,28 @@ def get_allatom_coords(residue):
             in residue.get_list()
             ]
 
+def get_sidechain_centroid_coord(residue):
+    ''' Get centroid of side chain heavy atoms in residue
+
+        residue: a Bio.PDB.Residue
+
+        If residue is a glycine, returns alpha carbon coordinates
+        Returns a list containing one coordinate as a numpy.ndarray of float32
+
+    '''
+
+    if residue.get_resname() == 'GLY':
+        return [residue['CA'].coord]
+
+    coords = [atom.coord
+              for atom
+              in residue.get_list()
+              if atom.get_id() not in BACKBONE_ATOMS
+              and not atom.get_id().startswith('H')
+              ]
+
+    return [np.mean(np.array(coords, dtype = np.float64), axis = 0).astype(np.float32)]
+
 def has_structure_carbon(residue):
     ''' Returns True if residue has a CB (CA if residue is a glycine)
         
@@ -99,10 +125,381 @@ def calc_residue_distance(res_a, res_b, get_coords):
     # We want the smallest atom-atom distance between residues
     return min(atom_distances)
 
+def stack_residue_coords(residues, get_coords):
+    ''' Stack atom coordinates for many residues into a single array
+
+        residues: list of Bio.PDB.Residue entities
+        get_coords: a function that returns atom coordinates for a residue
+
+        Returns a tuple (coords, offsets):
+            coords: numpy.ndarray of float32 with shape (n_atoms, 3)
+            offsets: numpy.ndarray with the index of each residue's first atom
+                     in coords
+
+    '''
+
+    coords = list()
+    offsets = list()
+    for res in residues:
+        offsets += [len(coords)]
+        coords += get_coords(res)
+
+    coords = np.array(coords, dtype = np.float32).reshape(-1, 3)
+    offsets = np.array(offsets, dtype = np.intp)
+
+    return coords, offsets
+
+def select_coords(coords, offsets, atom_mask):
+    ''' Select atoms from stacked coordinates, keeping residue offsets valid
+
+        coords, offsets: see stack_residue_coords()
+        atom_mask: boolean numpy.ndarray over atoms in coords
+
+        Returns a tuple (coords, offsets) with only the selected atoms
+
+    '''
+
+    n_before = np.append(0, np.cumsum(atom_mask))  # selected atoms before each atom
+
+    return coords[atom_mask], n_before[offsets]
+
+def calc_min_distances(coords_a, offsets_a, coords_b, offsets_b,
+                       block_size = 2**22):
+    ''' Get euclidean distances between all pairs of residues in two sets
+
+        coords_a, offsets_a: stacked atom coordinates and residue offsets
+                             (see stack_residue_coords())
+        coords_b, offsets_b: same for the other set of residues
+        block_size: maximum number of atom-atom distances held in memory at once
+
+        Left residues are processed in blocks. Within a block, all atom-atom
+        distances are computed at once and reduced to the smallest distance
+        for each pair of residues, as in calc_residue_distance().
+
+        Returns a numpy.ndarray of float32 with shape (n_res_a, n_res_b)
+
+    '''
+
+    return calc_min_distances_multi(coords_a, offsets_a, coords_b, offsets_b,
+                                    [(None, None)], block_size
+                                    )[0]
+
+def calc_min_distances_multi(coords_a, offsets_a, coords_b, offsets_b,
+                             atom_masks, block_size = 2**22):
+    ''' Get several residue distance matrices from one pass over atom pairs
+
+        coords_a, offsets_a, coords_b, offsets_b, block_size:
+            see calc_min_distances()
+        atom_masks: list of (mask_a, mask_b), boolean numpy.ndarrays over
+                    atoms in coords_a and coords_b. Each matrix only uses
+                    distances between selected atoms. None selects all
+                    atoms. Every residue needs at least one selected atom.
+
+        Atom-atom distances are computed once per block and reduced once per
+        mask, eg. nearest heavy atom and nearest atom distances from the
+        same atoms.
+
+        Returns a list of numpy.ndarrays of float32 with shape (n_res_a, n_res_b)
+
+    '''
+
+    n_res_a = len(offsets_a)
+    dist_mats = [np.empty((n_res_a, len(offsets_b)), dtype = np.float32)
+                 for masks in atom_masks]
+    if dist_mats[0].size == 0:
+        return dist_mats
+
+    ends_a = np.append(offsets_a[1:], len(coords_a))
+    block_atoms = max(1, block_size // len(coords_b))
+
+    start = 0
+    while start < n_res_a:
+        # take as many whole residues as fit in the block (at least one)
+        stop = np.searchsorted(ends_a, offsets_a[start] + block_atoms,
+                               side = 'right')
+        stop = max(stop, start + 1)
+
+        atom_slice = slice(offsets_a[start], ends_a[stop - 1])
+        atoms_a = coords_a[atom_slice]
+        diffs = atoms_a[:, np.newaxis, :] - coords_b[np.newaxis, :, :]
+        atom_dists = np.sqrt((diffs * diffs).sum(axis = 2))
+
+        for ((mask_a, mask_b), dist_mat) in zip(atom_masks, dist_mats):
+            if mask_a is None and mask_b is None:
+                masked_dists = atom_dists
+            elif mask_b is None:
+                masked_dists = np.where(mask_a[atom_slice, np.newaxis], atom_dists, np.inf)
+            elif mask_a is None:
+                masked_dists = np.where(mask_b[np.newaxis, :], atom_dists, np.inf)
+            else:
+                selected = mask_a[atom_slice, np.newaxis] & mask_b[np.newaxis, :]
+                masked_dists = np.where(selected, atom_dists, np.inf)
+
+            # We want the smallest atom-atom distance between residues
+            res_dists = np.minimum.reduceat(masked_dists, offsets_b, axis = 1)
+            dist_mat[start:stop] = np.minimum.reduceat(
+                                       res_dists,
+                                       offsets_a[start:stop] - offsets_a[start],
+                                       axis = 0
+                                       )
+        start = stop
+
+    return dist_mats
+
+def calc_pair_min_distances(coords_a, offsets_a, coords_b, offsets_b,
+                            idx_a, idx_b, atom_masks = None,
+                            block_size = 2**22):
+    ''' Get euclidean distances between selected pairs of residues
+
+        coords_a, offsets_a, coords_b, offsets_b, block_size:
+            see calc_min_distances()
+        idx_a, idx_b: index arrays over residues, one entry per pair
+        atom_masks: see calc_min_distances_multi() [default = all atoms]
+
+        Only atoms of the selected pairs are compared, so excluded pairs
+        cost nothing. At most block_size atom-atom distances are held in
+        memory at a time.
+
+        coords_a and coords_b may have a leading model axis, with shape
+        (n_models, n_atoms, 3), to get distances in many models with the
+        same atoms (eg. an NMR ensemble) at once.
+
+        Returns a list of numpy.ndarrays of float32 with shape (n_pairs,),
+        or (n_models, n_pairs) with a model axis, one per mask
+
+    '''
+
+    if atom_masks is None:
+        atom_masks = [(None, None)]
+    idx_a = np.asarray(idx_a, dtype = np.intp)
+    idx_b = np.asarray(idx_b, dtype = np.intp)
+    models_shape = coords_a.shape[:-2]
+    pair_dists = [np.empty(models_shape + (len(idx_a),), dtype = np.float32)
+                  for masks in atom_masks]
+    if len(idx_a) == 0:
+        return pair_dists
+
+    n_atoms_a = np.diff(np.append(offsets_a, coords_a.shape[-2]))
+    n_atoms_b = np.diff(np.append(offsets_b, coords_b.shape[-2]))
+    pair_sizes = n_atoms_a[idx_a] * n_atoms_b[idx_b]
+    pair_ends = np.cumsum(pair_sizes)
+    block_size = max(1, block_size // int(np.prod(models_shape)))
+
+    start = 0
+    while start < len(idx_a):
+        done = pair_ends[start] - pair_sizes[start]  # atom pairs before block
+        stop = np.searchsorted(pair_ends, done + block_size, side = 'right')
+        stop = max(stop, start + 1)
+
+        # expand each residue pair to all of its atom pairs
+        sizes = pair_sizes[start:stop]
+        starts = np.cumsum(sizes) - sizes
+        pos = np.arange(starts[-1] + sizes[-1]) - np.repeat(starts, sizes)
+        n_b = np.repeat(n_atoms_b[idx_b[start:stop]], sizes)
+        atoms_a = np.repeat(offsets_a[idx_a[start:stop]], sizes) + pos // n_b
+        atoms_b = np.repeat(offsets_b[idx_b[start:stop]], sizes) + pos % n_b
+
+        diffs = coords_a[..., atoms_a, :] - coords_b[..., atoms_b, :]
+        atom_dists = np.sqrt((diffs * diffs).sum(axis = -1))
+
+        for ((mask_a, mask_b), dists) in zip(atom_masks, pair_dists):
+            masked_dists = atom_dists
+            if mask_a is not None:
+                masked_dists = np.where(mask_a[atoms_a], masked_dists, np.inf)
+            if mask_b is not None:
+                masked_dists = np.where(mask_b[atoms_b], masked_dists, np.inf)
+            dists[..., start:stop] = np.minimum.reduceat(masked_dists, starts, axis = -1)
+        start = stop
+
+    return pair_dists
+
+def calc_distance_matrix(residues_a, residues_b, get_coords):
+    ''' Get euclidean distances between all pairs of residues in two lists
+
+        residues_a, residues_b: lists of Bio.PDB.Residue entities
+        get_coords: a function that returns atom coordinates for a residue
+
+        Returns a numpy.ndarray of float32 with shape
+        (len(residues_a), len(residues_b))
+
+    '''
+
+    coords_a, offsets_a = stack_residue_coords(residues_a, get_coords)
+    coords_b, offsets_b = stack_residue_coords(residues_b, get_coords)
+
+    return calc_min_distances(coords_a, offsets_a, coords_b, offsets_b)
+
+def find_atom_neighbors(coords_a, coords_b, cutoff):
+    ''' Find pairs of atoms within cutoff distance using a cell list
+
+        coords_a, coords_b: numpy.ndarrays of atom coordinates, shape (n, 3)
+        cutoff: maximum distance (in Angstroms), must be positive
+
+        Atoms in coords_b are binned into cubic cells with sides of length
+        cutoff, so each atom in coords_a is only compared to atoms in its own
+        cell and the 26 cells around it.
+
+        Returns a tuple of numpy.ndarrays (atom_idx_a, atom_idx_b, distances)
+
+    '''
+
+    if not cutoff > 0:
+        raise ValueError('cutoff must be positive, got %s' % cutoff)
+
+    atom_idx_a = [np.empty(0, dtype = np.intp)]
+    atom_idx_b = [np.empty(0, dtype = np.intp)]
+    atom_dists = [np.empty(0, dtype = np.float32)]
+    if len(coords_a) == 0 or len(coords_b) == 0:
+        return atom_idx_a[0], atom_idx_b[0], atom_dists[0]
+
+    # cell indices start at 1, leaving room for neighbors on all sides
+    origin = np.minimum(coords_a.min(axis = 0), coords_b.min(axis = 0))
+    cells_a = np.floor((coords_a - origin) / cutoff).astype(np.int64) + 1
+    cells_b = np.floor((coords_b - origin) / cutoff).astype(np.int64) + 1
+    n_cells = np.maximum(cells_a.max(axis = 0), cells_b.max(axis = 0)) + 2
+
+    def cell_key(cells):
+        return (cells[:, 0] * n_cells[1] + cells[:, 1]) * n_cells[2] + cells[:, 2]
+
+    order_b = np.argsort(cell_key(cells_b), kind = 'mergesort')
+    sorted_keys_b = cell_key(cells_b)[order_b]
+    all_idx_a = np.arange(len(coords_a))
+
+    for shift in product((-1, 0, 1), repeat = 3):
+        keys_a = cell_key(cells_a + shift)
+        starts = np.searchsorted(sorted_keys_b, keys_a, side = 'left')
+        counts = np.searchsorted(sorted_keys_b, keys_a, side = 'right') - starts
+
+        # expand each atom in coords_a against the atoms in the shifted cell
+        idx_a = np.repeat(all_idx_a, counts)
+        first = np.repeat(starts - (np.cumsum(counts) - counts), counts)
+        idx_b = order_b[first + np.arange(len(idx_a))]
+
+        diffs = coords_a[idx_a] - coords_b[idx_b]
+        dists = np.sqrt((diffs * diffs).sum(axis = 1))
+        close = dists <= cutoff
+
+        atom_idx_a += [idx_a[close]]
+        atom_idx_b += [idx_b[close]]
+        atom_dists += [dists[close]]
+
+    return (np.concatenate(atom_idx_a), np.concatenate(atom_idx_b),
+            np.concatenate(atom_dists))
+
+def calc_contacts(coords_a, offsets_a, coords_b, offsets_b, cutoff):
+    ''' Get residue pairs within cutoff distance of each other
+
+        coords_a, offsets_a: stacked atom coordinates and residue offsets
+                             (see stack_residue_coords())
+        coords_b, offsets_b: same for the other set of residues
+        cutoff: maximum distance (in Angstroms)
+
+        Residue distances are the smallest atom-atom distance, as in
+        calc_min_distances(), but far-apart residues are never compared.
+
+        Returns a tuple of numpy.ndarrays (res_idx_a, res_idx_b, distances),
+        ordered by res_idx_a, then res_idx_b
+
+    '''
+
+    atom_idx_a, atom_idx_b, atom_dists = find_atom_neighbors(coords_a, coords_b,
+                                                             cutoff)
+    if len(atom_dists) == 0:
+        return atom_idx_a, atom_idx_b, atom_dists
+
+    res_idx_a = np.searchsorted(offsets_a, atom_idx_a, side = 'right') - 1
+    res_idx_b = np.searchsorted(offsets_b, atom_idx_b, side = 'right') - 1
+
+    # We want the smallest atom-atom distance between residues
+    pair_keys = res_idx_a * len(offsets_b) + res_idx_b
+    order = np.argsort(pair_keys, kind = 'mergesort')
+    pair_keys = pair_keys[order]
+    starts = np.flatnonzero(np.append(True, pair_keys[1:] != pair_keys[:-1]))
+    res_dists = np.minimum.reduceat(atom_dists[order], starts)
+    res_idx_a, res_idx_b = np.divmod(pair_keys[starts], len(offsets_b))
+
+    return res_idx_a, res_idx_b, res_dists
+
+def select_CB_atoms(struct):
+    ''' Select beta carbon atoms in a CompactStructure
+
+        struct: a coevo.pdb_aux.CompactStructure
+
+        Selects alpha carbons for glycines, like get_CB_coord()
+        Returns a boolean numpy.ndarray over atoms
+
+    '''
+
+    is_gly = np.repeat(struct.resnames == 'GLY', struct.atoms_per_residue())
+
+    return np.where(is_gly, struct.atom_names == 'CA', struct.atom_names == 'CB')
+
+def select_nonH_atoms(struct):
+    ''' Select non-hydrogen atoms in a CompactStructure, like get_nonH_coords()
+
+        Returns a boolean numpy.ndarray over atoms
+
+    '''
+
+    return ~np.char.startswith(struct.atom_names, 'H')
+
+def select_allatom_atoms(struct):
+    ''' Select all atoms in a CompactStructure, like get_allatom_coords()
+
+        Returns a boolean numpy.ndarray over atoms
+
+    '''
+
+    return np.ones(len(struct.atom_names), dtype = bool)
+
+def select_sidechain_atoms(struct):
+    ''' Select side chain heavy atoms in a CompactStructure
+
+        Selects alpha carbons for glycines
+        Returns a boolean numpy.ndarray over atoms
+
+    '''
+
+    is_gly = np.repeat(struct.resnames == 'GLY', struct.atoms_per_residue())
+    is_sidechain = ~np.in1d(struct.atom_names, BACKBONE_ATOMS) & select_nonH_atoms(struct)
+
+    return np.where(is_gly, struct.atom_names == 'CA', is_sidechain)
+
+def get_sidechain_centroids(struct):
+    ''' Get side chain centroids in a CompactStructure,
+        like get_sidechain_centroid_coord()
+
+        Every residue should have at least one side chain heavy atom (or be a
+        glycine with an alpha carbon).
+
+        Returns a tuple (coords, offsets) with one coordinate per residue
+
+    '''
+
+    coords, offsets = struct.get_coords(select_sidechain_atoms(struct))
+    n_atoms = np.diff(np.append(offsets, len(coords)))
+    sums = np.add.reduceat(coords.astype(np.float64), offsets, axis = 0)
+    centroids = (sums / n_atoms[:, np.newaxis]).astype(np.float32)
+
+    return centroids, np.arange(len(centroids), dtype = np.intp)
+
+def has_structure_carbons(struct):
+    ''' Vectorized has_structure_carbon() over residues in a CompactStructure
+
+        Returns a boolean numpy.ndarray over residues
+
+    '''
+
+    n_carbons = np.bincount(struct.residue_index()[select_CB_atoms(struct)],
+                            minlength = len(struct)
+                            )
+
+    return n_carbons > 0
+
 def choose_get_coords(dist_atoms):
     ''' Choose get_coords function from dist_atoms
 
-        dist_atoms: a string 'Cb', 'NoH', or 'Any'
+        dist_atoms: a string 'Cb', 'NoH', 'Any', or 'Cen'
 
         Returns a get_coords function. Defaults to get_CB_coord()
         
@@ -114,5 +511,22 @@ def choose_get_coords(dist_atoms):
         return get_nonH_coords
     if dist_atoms == 'Any':
         return get_allatom_coords
+    if dist_atoms == 'Cen':
+        return get_sidechain_centroid_coord
     return get_CB_coord
 
+def choose_select_atoms(dist_atoms):
+    ''' Choose select_atoms function from dist_atoms
+
+        dist_atoms: a string 'Cb', 'NoH', or 'Any'
+
+        Returns a select_atoms function for CompactStructures, like
+        choose_get_coords(). Defaults to select_CB_atoms()
+
+    '''
+
+    if dist_atoms == 'NoH':
+        return select_nonH_atoms
+    if dist_atoms == 'Any':
+        return select_allatom_atoms
+    return select_CB_atoms
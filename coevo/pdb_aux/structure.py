@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+''' structure.py -- compact array-backed representation of PDB structures
+
+'''
+
+import numpy as np
+from Bio import SeqUtils
+
+from .distances import get_nonhet_residues
+
+__author__ = 'Aram Avila-Herrera'
+
+class CompactStructure(object):
+    ''' Holds the atoms and residues of a structure in contiguous numpy arrays
+
+        Atoms:
+            coords: float32 coordinates, shape (n_atoms, 3)
+            atom_names: atom names (eg. 'CA')
+            elements: element symbols (eg. 'C')
+
+        Residues:
+            res_starts: index of each residue's first atom, followed by n_atoms
+            resnums: residue numbers
+            resnames: 3-letter residue names
+            aas: 1-letter residue names
+            chain_ids: chain id of each residue
+
+        Residues of a chain must be contiguous. chain_slices maps each chain id
+        to a slice over residues.
+
+    '''
+
+    def __init__(self, coords, atom_names, elements, res_starts,
+                 resnums, resnames, chain_ids, aas = None, id = ''):
+
+        self.id = id
+        self.coords = np.asarray(coords, dtype = np.float32).reshape(-1, 3)
+        self.atom_names = np.asarray(atom_names, dtype = 'S4')
+        self.elements = np.asarray(elements, dtype = 'S2')
+        self.res_starts = np.asarray(res_starts, dtype = np.intp)
+        self.resnums = np.asarray(resnums, dtype = int)
+        self.resnames = np.asarray(resnames, dtype = 'S3')
+        self.chain_ids = np.asarray(chain_ids, dtype = 'S1')
+        if aas is None:
+            aas = [SeqUtils.seq1(resname) for resname in self.resnames]
+        self.aas = np.asarray(aas, dtype = 'S1')
+
+        self.chain_slices = dict()
+        for (i, chain_id) in enumerate(self.chain_ids):
+            if chain_id in self.chain_slices:
+                self.chain_slices[chain_id] = slice(self.chain_slices[chain_id].start, i + 1)
+            else:
+                self.chain_slices[chain_id] = slice(i, i + 1)
+
+    def __len__(self):
+        ''' Returns the number of residues
+
+        '''
+
+        return len(self.resnums)
+
+    def atoms_per_residue(self):
+        ''' Returns a numpy.ndarray with the number of atoms in each residue
+
+        '''
+
+        return np.diff(self.res_starts)
+
+    def residue_index(self):
+        ''' Returns a numpy.ndarray with the residue index of each atom
+
+        '''
+
+        return np.repeat(np.arange(len(self)), self.atoms_per_residue())
+
+    def get_chain(self, chain_id):
+        ''' Returns a CompactStructure over residues in chain_id
+
+            Arrays in the returned CompactStructure are views, not copies.
+
+        '''
+
+        res_slice = self.chain_slices[chain_id]
+        chain = self.get_residue_range(res_slice.start, res_slice.stop)
+        chain.id = chain_id
+
+        return chain
+
+    def get_residue_range(self, start, stop):
+        ''' Returns a CompactStructure over residues start to stop - 1
+
+            Arrays in the returned CompactStructure are views, not copies.
+
+        '''
+
+        atom_start = self.res_starts[start]
+        atom_stop = self.res_starts[stop]
+
+        return CompactStructure(self.coords[atom_start:atom_stop],
+                                self.atom_names[atom_start:atom_stop],
+                                self.elements[atom_start:atom_stop],
+                                self.res_starts[start:stop + 1] - atom_start,
+                                self.resnums[start:stop],
+                                self.resnames[start:stop],
+                                self.chain_ids[start:stop],
+                                aas = self.aas[start:stop],
+                                id = self.id
+                                )
+
+    def take_residues(self, res_mask):
+        ''' Returns a CompactStructure with the residues selected by res_mask
+
+            res_mask: boolean numpy.ndarray over residues
+
+        '''
+
+        res_mask = np.asarray(res_mask, dtype = bool)
+        atom_mask = np.repeat(res_mask, self.atoms_per_residue())
+        res_starts = np.append(0, np.cumsum(self.atoms_per_residue()[res_mask]))
+
+        return CompactStructure(self.coords[atom_mask],
+                                self.atom_names[atom_mask],
+                                self.elements[atom_mask],
+                                res_starts,
+                                self.resnums[res_mask],
+                                self.resnames[res_mask],
+                                self.chain_ids[res_mask],
+                                aas = self.aas[res_mask],
+                                id = self.id
+                                )
+
+    def get_coords(self, atom_mask):
+        ''' Get coordinates of selected atoms, grouped by residue
+
+            atom_mask: boolean numpy.ndarray over atoms
+
+            Every residue should have at least one selected atom.
+
+            Returns a tuple (coords, offsets) like
+            coevo.pdb_aux.distances.stack_residue_coords()
+
+        '''
+
+        n_selected = np.bincount(self.residue_index()[atom_mask],
+                                 minlength = len(self)
+                                 )
+        offsets = np.cumsum(n_selected) - n_selected
+
+        return self.coords[atom_mask], offsets.astype(np.intp)
+
+def Entity_to_CompactStructure(entity):
+    ''' Generates a CompactStructure from a Bio.PDB entity.
+
+        entity: a Bio.PDB.Structure, Model, or Chain object
+                *If a Structure, only its first model is used*
+
+        Keeps only residues with blank flags (eg. no HET residues).
+
+        Returns a CompactStructure
+
+    '''
+
+    if entity.level == 'S':
+        entity = entity[0]
+    if entity.level == 'M':
+        chains = entity.get_list()
+    else:
+        chains = [entity]
+
+    coords = list()
+    atom_names = list()
+    elements = list()
+    res_starts = [0]
+    resnums = list()
+    resnames = list()
+    chain_ids = list()
+    for chain in chains:
+        for res in get_nonhet_residues(chain):
+            for atom in res.get_list():
+                coords += [atom.coord]
+                atom_names += [atom.get_id()]
+                elements += [atom.element]
+            res_starts += [len(coords)]
+            resnums += [res.id[1]]
+            resnames += [res.get_resname()]
+            chain_ids += [chain.id]
+
+    return CompactStructure(coords, atom_names, elements, res_starts,
+                            resnums, resnames, chain_ids, id = entity.id
+                            )
+
+def save_CompactStructure(struct, fh):
+    ''' Saves a CompactStructure in numpy .npz format
+
+        struct: a CompactStructure
+        fh: filename or open file handle
+
+    '''
+
+    np.savez(fh, id = np.asarray(str(struct.id)),
+             coords = struct.coords,
+             atom_names = struct.atom_names,
+             elements = struct.elements,
+             res_starts = struct.res_starts,
+             resnums = struct.resnums,
+             resnames = struct.resnames,
+             chain_ids = struct.chain_ids,
+             aas = struct.aas
+             )
+
+def load_CompactStructure(fn):
+    ''' Loads a CompactStructure saved by save_CompactStructure()
+
+        Returns a CompactStructure
+
+    '''
+
+    npz = np.load(fn)
+    struct = CompactStructure(npz['coords'], npz['atom_names'], npz['elements'],
+                              npz['res_starts'], npz['resnums'], npz['resnames'],
+                              npz['chain_ids'], aas = npz['aas'],
+                              id = str(npz['id'])
+                              )
+    npz.close()
+
+    return struct
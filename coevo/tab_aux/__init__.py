@@ -1 +1,2 @@
 from .aux import load_pairtab, load_flattab, get_min_dists, convert_col, load_map
+from .distmat import save_dist_matrix, load_dist_matrix, dist_matrix_to_pairtab
@@ -3,6 +3,9 @@
 
 '''
 
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
 
 def load_pairtab(fn):
@@ -27,27 +30,63 @@ def load_flattab(fn):
 
     return df
 
-def get_min_dists(df1, df2):
+def get_min_dists(*dfs):
     ''' Gets minimum distances for each pair of alignment columns
 
-        df1, df2: pandas.DataFrame indexed by alignment column numbers.
-                  All DataFrame columns are expected to be distances
+        dfs: any number of pandas.DataFrames indexed by pairs of alignment
+             columns (or resnums).
+             All DataFrame columns are expected to be distances
 
-        pandas.concat() should work with multiple distance columns
-                        but doesn't care about index names
+        Pairs are numbered once over all tables and each column is reduced
+        per pair instead of concatenating the tables. Numeric columns are
+        reduced with numpy.fmin, other columns (eg. amino acids) keep their
+        smallest value, like DataFrame.groupby().min(). Repeated pairs,
+        within or across tables, are reduced the same way.
 
-        Returns a pandas.DataFrame
+        Returns a pandas.DataFrame indexed by every pair present in any of dfs,
+        in sorted order (empty, with every column, if all of dfs are empty)
 
     '''
 
-    ## merge only works if there is a single distance column
-    #dist_name = df1.columns[0]
-    #dfmerge = df1.merge(df2, how = 'outer', left_index = True, right_index = True)
-    #dmin = dfmerge.min(axis = 1).to_frame(dist_name)
-
-    index_names = list(df1.index.names)
-    dfcat = pd.concat([df1, df2], keys = ['One', 'Two'], names = ['ChainPair'])
-    dfmin = dfcat.groupby(level = index_names).min().dropna()
+    index_names = list(dfs[0].index.names)
+    colnames = list()
+    for df in dfs:
+        colnames += [col for col in df.columns if col not in colnames]
+
+    if not any(len(df) for df in dfs):
+        index = pd.MultiIndex.from_arrays([[], []], names = index_names)
+        return pd.DataFrame(index = index, columns = colnames)
+
+    # number each distinct pair, in sorted order
+    (left_codes, left_labels), (right_codes, right_labels) = [
+        pd.factorize(np.concatenate([df.index.get_level_values(level).values for df in dfs]),
+                     sort = True
+                     )
+        for level in (0, 1)
+        ]
+    pair_keys, pair_idx = np.unique(left_codes.astype(np.int64) * len(right_labels)
+                                    + right_codes,
+                                    return_inverse = True
+                                    )
+    bounds = np.cumsum([0] + [len(df) for df in dfs])
+    df_pairs = [pair_idx[bounds[i]:bounds[i + 1]] for i in xrange(len(dfs))]
+
+    mins = OrderedDict()
+    for col in colnames:
+        pairs = np.concatenate([idx for (df, idx) in zip(dfs, df_pairs) if col in df])
+        vals = [df[col].values for df in dfs if col in df]
+        if all(np.issubdtype(val.dtype, np.number) for val in vals):
+            mins[col] = np.full(len(pair_keys), np.nan)
+            np.fmin.at(mins[col], pairs, np.concatenate(vals).astype(float))
+        else:
+            col_mins = pd.Series(np.concatenate(vals).astype(object)).groupby(pairs).min()
+            mins[col] = col_mins.reindex(np.arange(len(pair_keys))).values
+
+    index = pd.MultiIndex.from_arrays([left_labels[pair_keys // len(right_labels)],
+                                       right_labels[pair_keys % len(right_labels)]],
+                                      names = index_names
+                                      )
+    dfmin = pd.DataFrame(mins, index = index, columns = colnames).dropna()
 
     return dfmin
 
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+''' distmat.py -- binary residue-by-residue distance matrices
+
+    A distance matrix is saved under a filename prefix as two files:
+
+        <prefix>.dist.npy    float32 matrix, rows are left residues and
+                             columns are right residues
+        <prefix>.index.npz   index vectors for rows ('Left_*') and columns
+                             ('Right_*'), eg. Left_resn, Left_AA, Left_Column
+
+    Alignment column vectors use -1 for residues missing from the map.
+    The matrix can be memory-mapped, so loading it does not copy or parse it.
+
+'''
+
+import numpy as np
+import pandas as pd
+
+def save_dist_matrix(prefix, dist_mat, index_vectors):
+    ''' Saves a distance matrix and its index vectors
+
+        prefix: output filename prefix
+        dist_mat: numpy.ndarray with shape (n_left, n_right)
+        index_vectors: dict from names (eg. 'Left_resn') to numpy.ndarrays,
+                       'Left_*' of length n_left and 'Right_*' of length n_right
+
+    '''
+
+    np.save(prefix + '.dist.npy', np.asarray(dist_mat, dtype = np.float32))
+    np.savez(prefix + '.index.npz', **index_vectors)
+
+def load_dist_matrix(prefix, mmap_mode = 'r'):
+    ''' Loads a distance matrix saved by save_dist_matrix()
+
+        prefix: filename prefix
+        mmap_mode: passed to numpy.load(). 'r' (default) memory-maps the
+                   matrix read-only, None reads it into memory
+
+        Returns a tuple (dist_mat, index_vectors)
+
+    '''
+
+    dist_mat = np.load(prefix + '.dist.npy', mmap_mode = mmap_mode)
+    npz = np.load(prefix + '.index.npz')
+    index_vectors = dict((name, npz[name]) for name in npz.files)
+    npz.close()
+
+    return dist_mat, index_vectors
+
+def dist_matrix_to_pairtab(dist_mat, index_vectors, by = 'resn'):
+    ''' Converts a distance matrix to a long table like get_dists.py output
+
+        dist_mat, index_vectors: see load_dist_matrix()
+        by: 'resn' or 'Column', index vectors to index the table by.
+            With 'Column', residues missing from the maps are dropped
+
+        Every pair in the matrix is kept (for intrachain matrices, both
+        orders and self pairs). NaN distances (eg. pairs beyond a cutoff)
+        are dropped.
+
+        Returns a pandas.DataFrame indexed by Left_<by>, Right_<by>
+
+    '''
+
+    left = index_vectors['Left_' + by]
+    right = index_vectors['Right_' + by]
+    left_keep = np.flatnonzero(left >= 0) if by == 'Column' else np.arange(len(left))
+    right_keep = np.flatnonzero(right >= 0) if by == 'Column' else np.arange(len(right))
+
+    sub_mat = dist_mat[np.ix_(left_keep, right_keep)]
+    idx_l, idx_r = np.nonzero(~np.isnan(sub_mat))
+    idx_l = left_keep[idx_l]
+    idx_r = right_keep[idx_r]
+
+    df = pd.DataFrame({'Left_' + by: left[idx_l],
+                       'Right_' + by: right[idx_r],
+                       'Distance': dist_mat[idx_l, idx_r],
+                       'Left_AA': index_vectors['Left_AA'][idx_l],
+                       'Right_AA': index_vectors['Right_AA'][idx_r]
+                       },
+                      columns = ['Left_' + by, 'Right_' + by,
+                                 'Distance', 'Left_AA', 'Right_AA']
+                      )
+    df.set_index(['Left_' + by, 'Right_' + by], inplace = True)
+
+    return df
@@ -10,6 +10,7 @@ setup(name = 'coevo',
         packages = find_packages(),
         install_requires = ['pandas', 'biopython'],
         scripts = [
+                   'bin/collapse_fasta.py',
                    'bin/fasta_to_phy.py',
                    'bin/fasta_to_psicov.py',
                    'bin/get_dists.py',